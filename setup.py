@@ -199,6 +199,7 @@ KWARGS = OrderedDict(
         'tests': parse_requirements('requirements/tests.txt'),
         'build': parse_requirements('requirements/build.txt'),
         'runtime': parse_requirements('requirements/runtime.txt'),
+        'optional': parse_requirements('requirements/optional.txt'),
     },
     # --- VERSION ---
     # The following settings retreive the version from git.
@@ -9,18 +9,21 @@ import vtool as vt
 import wbia
 from wbia import dtool as dt
 import os
-import torch
-import torchvision.transforms as transforms  # noqa: E402
-from scipy.spatial import distance_matrix
-
-import tqdm
-
-from wbia_pie_v2.default_config import get_default_config
-from wbia_pie_v2.datasets import AnimalNameWbiaDataset  # noqa: E402
-from wbia_pie_v2.metrics import eval_onevsall
-from wbia_pie_v2.models import build_model
-from wbia_pie_v2.utils import read_json, load_pretrained_weights
-from wbia_pie_v2.metrics import pred_light, compute_distance_matrix
+import hashlib
+import contextlib
+import threading
+import time
+import warnings
+
+# Only lightweight modules are imported here, so that registering the plugin
+# when wbia starts does not load torch. The deep learning stack is imported by
+# the functions that compute embeddings and scores, on first use.
+from wbia_pie_v2.inference import (
+    ModelRegistry,
+    EmbeddingCache,
+    EmbeddingStore,
+    SingleFlight,
+)
 
 (print, rrr, profile) = ut.inject2(__name__)
 
@@ -74,17 +77,88 @@ MODELS = {
 }
 
 
-GLOBAL_EMBEDDING_CACHE = {}
+# Embeddings are cached per (aid, config/model fingerprint) under a byte
+# budget, configurable with WBIA_PIE_V2_EMBEDDING_CACHE_MB. Setting
+# WBIA_PIE_V2_EMBEDDING_CACHE_DTYPE=float16 halves the memory per embedding.
+EMBEDDING_CACHE_MB = int(os.environ.get('WBIA_PIE_V2_EMBEDDING_CACHE_MB', 1024))
+EMBEDDING_CACHE_DTYPE = os.environ.get('WBIA_PIE_V2_EMBEDDING_CACHE_DTYPE', 'float32')
+
+GLOBAL_EMBEDDING_CACHE = EmbeddingCache(
+    max_bytes=EMBEDDING_CACHE_MB * 2 ** 20, dtype=EMBEDDING_CACHE_DTYPE
+)
+
+# Concurrent requests (e.g. threads of the wbia web server) for the embedding
+# of the same (aid, fingerprint) share a single computation.
+GLOBAL_EMBEDDING_FLIGHT = SingleFlight()
+
+# Guards the lazily populated GLOBAL_* dicts below. Entries are loaded outside
+# the lock, once across concurrent callers, see _cached
+GLOBAL_CACHES_LOCK = threading.RLock()
+GLOBAL_CACHES_FLIGHT = SingleFlight()
+
+# The torch thread count is process-wide, so calls with a thread budget hold
+# this lock while they run, see _thread_budget
+GLOBAL_THREAD_BUDGET_LOCK = threading.RLock()
+
+# Loaded models are shared by every embedding call in this process. The budget
+# can be changed with the WBIA_PIE_V2_MODEL_BUDGET_MB environment variable.
+MODEL_BUDGET_MB = int(os.environ.get('WBIA_PIE_V2_MODEL_BUDGET_MB', 2048))
+MODEL_REGISTRY = ModelRegistry(max_bytes=MODEL_BUDGET_MB * 2 ** 20)
+
+GLOBAL_CONFIG_CACHE = {}
+
+GLOBAL_EMBEDDING_STORES = {}
+
+# Preprocessed model-input chips can be cached on disk so that re-embedding
+# after a model upgrade skips image decoding. Chips are stored as uint8, which
+# rounds the float preprocessing, so the cache is opt-in: set
+# WBIA_PIE_V2_CHIP_CACHE_MB to its size cap. The default 0 disables it.
+CHIP_CACHE_MB = int(os.environ.get('WBIA_PIE_V2_CHIP_CACHE_MB', 0))
+GLOBAL_CHIP_CACHES = {}
+
+# Set WBIA_PIE_V2_EMBEDDING_SERVER to the socket of a running embedding server
+# (python -m wbia_pie_v2.inference.server) to share its models instead of
+# loading them in this process. The shared secret of the server is read from
+# WBIA_PIE_V2_EMBEDDING_AUTHKEY or WBIA_PIE_V2_EMBEDDING_AUTHKEY_FILE.
+EMBEDDING_SERVER = os.environ.get('WBIA_PIE_V2_EMBEDDING_SERVER')
+GLOBAL_EMBEDDING_CLIENTS = {}
+
+# Concurrent embedding calls are coalesced into batches of cfg.test.batch_size
+# when WBIA_PIE_V2_MICRO_BATCH_WAIT_MS is positive. A call waits at most that
+# long for others to join its batch. 0 disables micro-batching.
+MICRO_BATCH_WAIT_MS = float(os.environ.get('WBIA_PIE_V2_MICRO_BATCH_WAIT_MS', 0))
+GLOBAL_MICRO_BATCHERS = {}
+GLOBAL_MICRO_BATCHERS_LOCK = threading.Lock()
+
+# Worker process pools of sharded CPU inference, see pie_v2_compute_embedding
+GLOBAL_SHARDED_EMBEDDERS = {}
+
+# Galleries of at least WBIA_PIE_V2_ANN_MIN_GALLERY annotations of one species
+# model are searched with a persistent approximate nearest neighbour index,
+# stored next to the embeddings, instead of exhaustively. 0 disables it.
+ANN_MIN_GALLERY = int(os.environ.get('WBIA_PIE_V2_ANN_MIN_GALLERY', 20000))
+GLOBAL_ANN_INDEXES = {}
+
+# An index is saved at most once every WBIA_PIE_V2_ANN_SAVE_INTERVAL seconds,
+# when it has changed. Embeddings added since its last save are added again on
+# the next search if the process exits first.
+ANN_SAVE_INTERVAL = float(os.environ.get('WBIA_PIE_V2_ANN_SAVE_INTERVAL', 300))
+GLOBAL_ANN_SAVES = {}
+
+# CPU batch sizes and thread counts measured by pie_v2_autotune, persisted per
+# (host fingerprint, model) in the app cache directory
+GLOBAL_TUNING_RECORDS = {}
 
 
 @register_ibs_method
-def pie_v2_embedding(ibs, aid_list, config=None, use_depc=True):
+def pie_v2_embedding(ibs, aid_list, config=None, use_depc=True, use_store=True):
     r"""
     Generate embeddings using the Pose-Invariant Embedding (PIE)
     Args:
         ibs (IBEISController): IBEIS / WBIA controller object
         aid_list  (int): annot ids specifying the input
         use_depc (bool): use dependency cache
+        use_store (bool): use the memory-mapped on-disk embedding store
     CommandLine:
         python -m wbia_pie_v2._plugin pie_v2_embedding
     Example:
@@ -121,14 +195,55 @@ def pie_v2_embedding(ibs, aid_list, config=None, use_depc=True):
         >>> assert abs(rank1 - expected_rank1) < 1e-2
 
     """
-    global GLOBAL_EMBEDDING_CACHE
+    species_list = ibs.get_annot_species_texts(aid_list)
+    fingerprint_list = [
+        _embedding_fingerprint(config, species) for species in species_list
+    ]
+
+    found = {}
+    missing_keys = []
+    grouped_aids = ut.group_items(aid_list, fingerprint_list)
+    for fingerprint, aids in grouped_aids.items():
+        found_, missing_ = GLOBAL_EMBEDDING_CACHE.lookup(aids, fingerprint)
+        found.update(found_)
+        missing_keys += [(aid, fingerprint) for aid in ut.unique(missing_)]
+
+    if len(missing_keys) > 0:
+
+        def compute_fn(key_list):
+            return _embed_missing(ibs, key_list, config, use_depc, use_store)
+
+        computed = GLOBAL_EMBEDDING_FLIGHT.run(missing_keys, compute_fn)
+        found.update((aid, emb) for (aid, fingerprint), emb in computed.items())
+
+    embeddings = ut.take(found, aid_list)
+
+    return embeddings
 
-    dirty_aids = []
-    for aid in aid_list:
-        if aid not in GLOBAL_EMBEDDING_CACHE:
-            dirty_aids.append(aid)
 
-    if len(dirty_aids) > 0:
+def _embed_missing(ibs, key_list, config, use_depc, use_store):
+    r"""
+    Read from the embedding store, or compute, the embeddings of (aid,
+    fingerprint) keys missing from the memory cache, and cache them
+    """
+    found = {}
+    dirty_keys = []
+    grouped_aids = ut.group_items(
+        ut.take_column(key_list, 0), ut.take_column(key_list, 1)
+    )
+    for fingerprint, aids in grouped_aids.items():
+        if use_store:
+            store = _get_embedding_store(ibs, fingerprint)
+            stored_embs, is_stored = store.get(aids, ibs.get_annot_visual_uuids(aids))
+            stored_aids = ut.compress(aids, is_stored)
+            GLOBAL_EMBEDDING_CACHE.put(stored_aids, fingerprint, stored_embs)
+            stored_keys = [(aid, fingerprint) for aid in stored_aids]
+            found.update(zip(stored_keys, stored_embs))
+            aids = ut.compress(aids, ~is_stored)
+        dirty_keys += [(aid, fingerprint) for aid in aids]
+
+    if len(dirty_keys) > 0:
+        dirty_aids = ut.take_column(dirty_keys, 0)
         print('Computing %d non-cached embeddings' % (len(dirty_aids), ))
         if use_depc:
             config_map = {'config_path': config}
@@ -138,12 +253,122 @@ def pie_v2_embedding(ibs, aid_list, config=None, use_depc=True):
         else:
             dirty_embeddings = pie_v2_compute_embedding(ibs, dirty_aids, config)
 
-        for dirty_aid, dirty_embedding in zip(dirty_aids, dirty_embeddings):
-            GLOBAL_EMBEDDING_CACHE[dirty_aid] = dirty_embedding
+        dirty_fingerprints = ut.take_column(dirty_keys, 1)
+        grouped_dirty = ut.group_items(
+            list(zip(dirty_aids, dirty_embeddings)), dirty_fingerprints
+        )
+        for fingerprint, items in grouped_dirty.items():
+            aids, embs = zip(*items)
+            embs = np.stack(embs)
+            GLOBAL_EMBEDDING_CACHE.put(aids, fingerprint, embs)
+            if use_store:
+                store = _get_embedding_store(ibs, fingerprint)
+                store.append(aids, embs, ibs.get_annot_visual_uuids(aids))
+        # Embeddings may be stored as float16, but are always returned as float32
+        dirty_embeddings = [np.asarray(emb, dtype=np.float32) for emb in dirty_embeddings]
+        found.update(zip(dirty_keys, dirty_embeddings))
 
-    embeddings = ut.take(GLOBAL_EMBEDDING_CACHE, aid_list)
+    return ut.take(found, key_list)
 
-    return embeddings
+
+@register_ibs_method
+def pie_v2_embedding_cache_stats(ibs):
+    r"""
+    Report hit/miss/eviction counters and memory use of the embedding cache
+    """
+    return GLOBAL_EMBEDDING_CACHE.stats()
+
+
+def _cached(cache, key, load_fn):
+    r"""
+    Get an entry of one of the GLOBAL_* dicts, calling ``load_fn()`` on a miss
+
+    Only the lookup and the insertion hold GLOBAL_CACHES_LOCK, so a slow load
+    (a download, a directory scan, starting processes) does not block lookups
+    of other entries. Concurrent misses of the same entry share one load.
+
+    Example:
+        >>> # ENABLE_DOCTEST
+        >>> import threading
+        >>> import time
+        >>> from wbia_pie_v2 import _plugin
+        >>> cache, loads = {}, []
+        >>> def load_fn():
+        >>>     loads.append(1)
+        >>>     time.sleep(0.2)
+        >>>     return object()
+        >>> results = [None] * 4
+        >>> def call(idx):
+        >>>     results[idx] = _plugin._cached(cache, 'key', load_fn)
+        >>> threads = [threading.Thread(target=call, args=(idx,)) for idx in range(4)]
+        >>> for thread in threads:
+        >>>     thread.start()
+        >>> # The lock is free while the entry loads
+        >>> time.sleep(0.05)
+        >>> assert _plugin.GLOBAL_CACHES_LOCK.acquire(timeout=0.1)
+        >>> _plugin.GLOBAL_CACHES_LOCK.release()
+        >>> for thread in threads:
+        >>>     thread.join()
+        >>> assert len(loads) == 1 and all(result is cache['key'] for result in results)
+    """
+    with GLOBAL_CACHES_LOCK:
+        if key in cache:
+            return cache[key]
+
+    def compute_fn(flight_keys):
+        with GLOBAL_CACHES_LOCK:
+            # Loaded by a flight that finished after our lookup
+            if key in cache:
+                return [cache[key]]
+        value = load_fn()
+        with GLOBAL_CACHES_LOCK:
+            return [cache.setdefault(key, value)]
+
+    flight_key = (id(cache), key)
+    return GLOBAL_CACHES_FLIGHT.run([flight_key], compute_fn)[flight_key]
+
+
+def _get_embedding_store(ibs, fingerprint):
+    r"""
+    Open the on-disk embedding store of one species model, next to the depc cache
+
+    Stores are keyed on the fingerprint alone, so that species aliases sharing
+    a config and model share a store.
+    """
+    dpath = _embedding_store_dpath(ibs, fingerprint)
+    return _cached(GLOBAL_EMBEDDING_STORES, dpath, lambda: EmbeddingStore(dpath))
+
+
+def _embedding_store_dpath(ibs, fingerprint):
+    return os.path.join(ibs.get_cachedir(), 'pie_v2_embeddings', fingerprint)
+
+
+def _get_ann_index(ibs, fingerprint):
+    r"""
+    Open the approximate nearest neighbour index of one species model, stored
+    with its embeddings
+    """
+    from wbia_pie_v2.metrics.ann import IVFFlatIndex
+
+    fpath = os.path.join(_embedding_store_dpath(ibs, fingerprint), 'ann.npz')
+
+    def load_fn():
+        if os.path.exists(fpath):
+            return IVFFlatIndex.load(fpath)
+        return IVFFlatIndex()
+
+    return _cached(GLOBAL_ANN_INDEXES, fpath, load_fn), fpath
+
+
+def _embedding_fingerprint(config, species):
+    r"""
+    Identify the config and model that produce the embeddings of a species
+    """
+    if config is None:
+        config = CONFIGS.get(species)
+    model_url = MODELS.get(species)
+    fingerprint = '{}|{}'.format(config, model_url)
+    return hashlib.sha1(fingerprint.encode('utf-8')).hexdigest()[:16]
 
 
 class PieV2EmbeddingConfig(dt.Config):  # NOQA
@@ -170,34 +395,522 @@ def pie_v2_embedding_depc(depc, aid_list, config=None):
 
 
 @register_ibs_method
-def pie_v2_compute_embedding(ibs, aid_list, config=None, multithread=False):
-    # Get species from the first annotation
-    species = ibs.get_annot_species_texts(aid_list[0])
+def pie_v2_compute_embedding(
+    ibs,
+    aid_list,
+    config=None,
+    multithread=False,
+    num_threads=None,
+    num_workers=None,
+    backend=None,
+    precision=None,
+    num_procs=None,
+):
+    r"""
+    Compute embeddings, running each species through its own model
+
+    Annotations are grouped by the (config, model) pair of their species, each
+    group is embedded in full batches, and the results are returned in the
+    order of ``aid_list``.
+
+    Args:
+        ibs (IBEISController): IBEIS / WBIA controller object
+        aid_list  (int): annot ids specifying the input
+        config (str): config url overriding the per-species default
+        multithread (bool): load images with ``cfg.data.workers`` workers
+        num_threads (int): torch intra-op threads used for the whole call, or
+            by each worker process with ``num_procs``
+        num_workers (int): data loading workers used by every group,
+            overrides ``multithread``
+        backend (str): inference backend overriding ``cfg.test.backend``
+        precision (str): forward pass precision overriding ``cfg.test.precision``
+        num_procs (int): run the forward passes of eager CPU models in this
+            many worker processes pinned to disjoint core sets, sharing the
+            model weights in shared memory
+
+    When the WBIA_PIE_V2_EMBEDDING_SERVER socket is configured and no backend,
+    precision or process override is given, the embeddings are requested from the
+    embedding server, falling back to local computation if it is unreachable.
+    Otherwise, with WBIA_PIE_V2_MICRO_BATCH_WAIT_MS set, they are computed in
+    batches shared with concurrent calls.
+
+    Example:
+        >>> # ENABLE_DOCTEST
+        >>> import numpy as np
+        >>> import wbia_pie_v2
+        >>> species = 'rhincodon_typus'
+        >>> test_ibs = wbia_pie_v2._plugin.wbia_pie_v2_examples_ibs(species)
+        >>> aid_list = test_ibs.get_valid_aids(species=species)
+        >>> embs = test_ibs.pie_v2_compute_embedding(aid_list, backend='eager')
+        >>> onnx_embs = test_ibs.pie_v2_compute_embedding(aid_list, backend='onnx')
+        >>> assert np.abs(onnx_embs - embs).max() < 1e-3
+
+    Example:
+        >>> # ENABLE_DOCTEST
+        >>> import numpy as np
+        >>> import wbia_pie_v2
+        >>> species = 'rhincodon_typus'
+        >>> test_ibs = wbia_pie_v2._plugin.wbia_pie_v2_examples_ibs(species)
+        >>> aid_list = test_ibs.get_valid_aids(species=species)
+        >>> # Repeated inputs are embedded once and fanned out
+        >>> embs = test_ibs.pie_v2_compute_embedding(aid_list[:2] + aid_list[:1])
+        >>> assert len(embs) == 3 and np.all(embs[2] == embs[0])
+
+    Example:
+        >>> # ENABLE_DOCTEST
+        >>> import os
+        >>> import os.path as osp
+        >>> import tempfile
+        >>> import numpy as np
+        >>> import wbia_pie_v2
+        >>> from wbia_pie_v2 import _plugin
+        >>> from wbia_pie_v2.inference import EmbeddingServer
+        >>> os.environ['WBIA_PIE_V2_EMBEDDING_AUTHKEY'] = 'secret'
+        >>> species = 'rhincodon_typus'
+        >>> test_ibs = _plugin.wbia_pie_v2_examples_ibs(species)
+        >>> aid_list = test_ibs.get_valid_aids(species=species)
+        >>> embs = test_ibs.pie_v2_compute_embedding(aid_list)
+        >>> # Serve embeddings from a thread standing in for the server process
+        >>> address = osp.join(tempfile.mkdtemp(), 'pie_v2.sock')
+        >>> server = EmbeddingServer(address, _plugin.embed_annotations, b'secret').start()
+        >>> _plugin.EMBEDDING_SERVER = address
+        >>> served_embs = test_ibs.pie_v2_compute_embedding(aid_list)
+        >>> _plugin.EMBEDDING_SERVER = None
+        >>> server.close()
+        >>> assert np.allclose(served_embs, embs, atol=1e-5)
+    """
+    annots = _annot_inputs(ibs, aid_list)
+
+    local_only = backend is not None or precision is not None or num_procs is not None
+    if EMBEDDING_SERVER is not None and not local_only:
+        try:
+            return _get_embedding_client().embed(annots, config)
+        except (OSError, EOFError) as ex:
+            print('Embedding server unavailable ({}), computing locally'.format(ex))
+
+    if MICRO_BATCH_WAIT_MS > 0 and not local_only:
+        return _embed_micro_batched(
+            annots,
+            config,
+            _get_chip_cache(ibs),
+            multithread=multithread,
+            num_threads=num_threads,
+            num_workers=num_workers,
+        )
+
+    return embed_annotations(
+        annots,
+        config,
+        chip_cache=_get_chip_cache(ibs),
+        multithread=multithread,
+        num_threads=num_threads,
+        num_workers=num_workers,
+        backend=backend,
+        precision=precision,
+        num_procs=num_procs,
+    )
+
+
+def embed_annotations(
+    annots,
+    config=None,
+    chip_cache=None,
+    multithread=False,
+    num_threads=None,
+    num_workers=None,
+    backend=None,
+    precision=None,
+    num_procs=None,
+):
+    r"""
+    Compute embeddings of annotations given by their image, bounding box,
+    viewpoint and species, without a controller. Used by
+    :func:`pie_v2_compute_embedding` and by the embedding server.
+
+    Args:
+        annots (dict): equal-length lists ``image_path``, ``bbox``,
+            ``viewpoint`` and ``species``, and optionally ``image_uuid`` and
+            ``name``
+        config (str): config url overriding the per-species default
+        chip_cache (ChipCache): cache of preprocessed chips, requires
+            ``image_uuid``
+
+    See :func:`pie_v2_compute_embedding` for the other arguments.
+    """
+    num_annots = len(annots['image_path'])
+    grouped_idxs = ut.group_items(
+        list(range(num_annots)), _group_keys(annots['species'], config)
+    )
+
+    embeddings = [None] * num_annots
+    for (config_url, model_url), idxs in grouped_idxs.items():
+        group_embeddings = _compute_group_embedding(
+            _take_annots(annots, idxs),
+            config_url,
+            model_url,
+            chip_cache,
+            multithread,
+            num_threads,
+            num_workers,
+            backend,
+            precision,
+            num_procs,
+        )
+        for idx, embedding in zip(idxs, group_embeddings):
+            embeddings[idx] = embedding
+
+    if len(set(embedding.shape for embedding in embeddings)) == 1:
+        embeddings = np.stack(embeddings)
+    return embeddings
+
+
+def _group_keys(species_list, config=None):
+    r"""
+    The (config, model) pair that embeds each species
+    """
+    return [
+        (CONFIGS[species] if config is None else config, MODELS[species])
+        for species in species_list
+    ]
+
+
+def _embed_micro_batched(
+    annots,
+    config=None,
+    chip_cache=None,
+    multithread=False,
+    num_threads=None,
+    num_workers=None,
+):
+    r"""
+    Embed annotations through the micro-batchers, which coalesce the
+    annotations of concurrent calls into full batches per (config, model)
+
+    The loading and thread settings are passed on to the batches, so calls
+    are only coalesced with calls using the same settings.
+    """
+    settings = (multithread, num_threads, num_workers)
+    num_annots = len(annots['image_path'])
+    grouped_idxs = ut.group_items(
+        list(range(num_annots)), _group_keys(annots['species'], config)
+    )
+    futures = {}
+    for group_key, idxs in grouped_idxs.items():
+        rows = [
+            {key: values[idx] for key, values in annots.items()} for idx in idxs
+        ]
+        batcher = _get_micro_batcher(group_key, chip_cache, settings)
+        futures[group_key] = batcher.submit(rows)
+
+    embeddings = [None] * num_annots
+    for group_key, idxs in grouped_idxs.items():
+        for idx, embedding in zip(idxs, futures[group_key].result()):
+            embeddings[idx] = embedding
+
+    if len(set(embedding.shape for embedding in embeddings)) == 1:
+        embeddings = np.stack(embeddings)
+    return embeddings
+
+
+def _get_micro_batcher(group_key, chip_cache=None, settings=(False, None, None)):
+    r"""
+    Get the micro-batcher of a (config, model) pair and of the (multithread,
+    num_threads, num_workers) settings, dispatching batches of the tuned or
+    configured batch size
+    """
+    from wbia_pie_v2.inference import MicroBatcher
+
+    config_url, model_url = group_key
+    batcher_key = (config_url, model_url, getattr(chip_cache, 'dpath', None), settings)
+    with GLOBAL_MICRO_BATCHERS_LOCK:
+        if batcher_key not in GLOBAL_MICRO_BATCHERS:
+            multithread, num_threads, num_workers = settings
+
+            def process_fn(rows):
+                annots = {key: [row[key] for row in rows] for key in rows[0]}
+                return embed_annotations(
+                    annots,
+                    config_url,
+                    chip_cache=chip_cache,
+                    multithread=multithread,
+                    num_threads=num_threads,
+                    num_workers=num_workers,
+                )
+
+            cfg = _load_config(config_url)
+            GLOBAL_MICRO_BATCHERS[batcher_key] = MicroBatcher(
+                process_fn,
+                max_batch=_batch_size(cfg),
+                max_wait=MICRO_BATCH_WAIT_MS / 1000.0,
+            )
+        return GLOBAL_MICRO_BATCHERS[batcher_key]
+
+
+@register_ibs_method
+def pie_v2_micro_batch_stats(ibs):
+    r"""
+    Report the request, batch, latency and throughput counters of the
+    micro-batchers, to tune WBIA_PIE_V2_MICRO_BATCH_WAIT_MS
+    """
+    with GLOBAL_MICRO_BATCHERS_LOCK:
+        items = list(GLOBAL_MICRO_BATCHERS.items())
+    return [
+        dict(
+            config_url=config_url,
+            model_url=model_url,
+            multithread=settings[0],
+            num_threads=settings[1],
+            num_workers=settings[2],
+            **batcher.stats()
+        )
+        for (config_url, model_url, _, settings), batcher in items
+    ]
+
+
+def _annot_inputs(ibs, aid_list):
+    r"""
+    Gather what the model input of each annotation depends on
+    """
+    return {
+        'image_path': ibs.get_annot_image_paths(aid_list),
+        'image_uuid': ibs.get_annot_image_uuids(aid_list),
+        'bbox': ibs.get_annot_bboxes(aid_list),
+        'viewpoint': ibs.get_annot_viewpoints(aid_list),
+        'species': ibs.get_annot_species_texts(aid_list),
+        'name': ibs.get_annot_name_rowids(aid_list),
+    }
+
+
+def _take_annots(annots, idxs):
+    return {key: ut.take(values, idxs) for key, values in annots.items()}
+
+
+def _get_embedding_client():
+    r"""
+    Get the client of the embedding server configured with
+    WBIA_PIE_V2_EMBEDDING_SERVER, authenticated with its shared secret
+    """
+    from wbia_pie_v2.inference import EmbeddingClient, read_authkey
+
+    return _cached(
+        GLOBAL_EMBEDDING_CLIENTS,
+        EMBEDDING_SERVER,
+        lambda: EmbeddingClient(EMBEDDING_SERVER, authkey=read_authkey()),
+    )
+
+
+def _compute_group_embedding(
+    annots,
+    config_url,
+    model_url,
+    chip_cache=None,
+    multithread=False,
+    num_threads=None,
+    num_workers=None,
+    backend=None,
+    precision=None,
+    num_procs=None,
+):
+    r"""
+    Compute embeddings of annotations that share a config and a model, with
+    the thread count found by pie_v2_autotune unless ``num_threads`` is given
+    """
+    import torch
+    from wbia_pie_v2.utils.torchtools import bfloat16_autocast
 
     # Load config
-    if config is None:
-        config = CONFIGS[species]
-    cfg = _load_config(config)
+    cfg = _load_config(config_url)
+    if backend is not None:
+        cfg.test.backend = backend
+    if precision is not None:
+        cfg.test.precision = precision
+
+    sharded = None
+    if num_procs is not None and num_procs > 1:
+        sharded = _get_sharded_embedder(
+            cfg, config_url, model_url, num_procs, num_threads
+        )
 
-    # Load model
-    model = _load_model(cfg, MODELS[species])
+    # Load model, sizing thread pools created on load (onnx) to the budget
+    if sharded is None:
+        if num_threads is None:
+            num_threads = _tuned_setting(cfg).get('num_threads')
+        with _thread_budget(num_threads):
+            model = _get_model(cfg, config_url, model_url)
+
+    # Annotations with the same model input are only embedded once
+    unique_idxs, inverse = _unique_inputs(annots, cfg)
+    num_annots = len(annots['image_path'])
+    num_saved = num_annots - len(unique_idxs)
+    if num_saved > 0:
+        print(
+            'Embedding {} unique inputs for {} annotations, saved {} forward '
+            'passes'.format(len(unique_idxs), num_annots, num_saved)
+        )
 
     # Preprocess images to model input
-    test_loader, test_dataset = _load_data(ibs, aid_list, cfg, multithread)
+    test_loader, test_dataset = _load_annot_data(
+        _take_annots(annots, unique_idxs), cfg, chip_cache, multithread, num_workers
+    )
 
-    # Compute embeddings
-    embeddings = []
-    model.eval()
-    with torch.no_grad():
-        for images, names in test_loader:
-            if cfg.use_gpu:
-                images = images.cuda(non_blocking=True)
+    # Compute embeddings, in bfloat16 under autocast if requested. Other
+    # backends run their own graphs and always use float32.
+    autocast = bfloat16_autocast(
+        'cuda' if _use_gpu(cfg) else 'cpu',
+        enabled=cfg.test.precision == 'bfloat16' and cfg.test.backend == 'eager',
+    )
+    if sharded is not None:
+        embeddings = sharded(
+            _prepare_batch(cfg, images) for images, names in test_loader
+        )
+    else:
+        embeddings = []
+        with torch.no_grad(), autocast, _thread_budget(num_threads):
+            for images, names in test_loader:
+                images = _prepare_batch(cfg, images)
+                output = model(images)
+                embeddings.append(output.detach().float().cpu().numpy())
 
-            output = model(images.float())
-            embeddings.append(output.detach().cpu().numpy())
+    embeddings = np.concatenate(embeddings)[inverse]
+    return embeddings.astype(cfg.test.embedding_dtype)
+
+
+def _get_sharded_embedder(cfg, config_url, model_url, num_procs, num_threads=None):
+    r"""
+    Get the worker process pool running an eager CPU model, or None for other
+    backends and on GPU, which run in-process
+    """
+    from wbia_pie_v2.inference.sharded import ShardedEmbedder
+
+    if cfg.test.backend != 'eager' or _use_gpu(cfg):
+        print(
+            'Sharded inference needs the eager backend on CPU, '
+            'running {} in-process'.format(cfg.test.backend)
+        )
+        return None
+
+    def load_fn():
+        model = _get_model(cfg, config_url, model_url)
+        print(
+            'Starting {} inference processes with {} threads each'.format(
+                num_procs, 'all their' if num_threads is None else num_threads
+            )
+        )
+        return ShardedEmbedder(
+            model,
+            num_procs,
+            num_threads=num_threads,
+            precision=cfg.test.precision,
+        )
+
+    key = (config_url, model_url, num_procs, num_threads, cfg.test.precision)
+    return _cached(GLOBAL_SHARDED_EMBEDDERS, key, load_fn)
+
+
+def _unique_inputs(annots, cfg):
+    r"""
+    Group annotations that produce the same model input, i.e. share the image,
+    the bounding box and the left-right flip
+
+    Returns:
+        tuple: the index of the first annotation of every distinct input, and
+        the index of the input of every annotation
+    """
+    images = annots.get('image_uuid', annots['image_path'])
+    if cfg.test.fliplr:
+        flips = [viewpoint in cfg.test.fliplr_view for viewpoint in annots['viewpoint']]
+    else:
+        flips = [False] * len(images)
+
+    input_index = {}
+    unique_idxs = []
+    inverse = []
+    keys = zip(images, map(tuple, annots['bbox']), flips)
+    for idx, key in enumerate(keys):
+        if key not in input_index:
+            input_index[key] = len(unique_idxs)
+            unique_idxs.append(idx)
+        inverse.append(input_index[key])
+    return unique_idxs, np.array(inverse, dtype=np.int64)
+
+
+def _prepare_batch(cfg, images):
+    r"""
+    Move a batch of model inputs to the model device and dtype
+    """
+    if _use_gpu(cfg):
+        images = images.cuda(non_blocking=True)
+    if not cfg.test.uint8_input:
+        images = images.float()
+    return images
+
+
+@contextlib.contextmanager
+def _thread_budget(num_threads=None):
+    r"""
+    Temporarily set the number of torch intra-op threads
+
+    The thread count is a process-wide setting, so concurrent calls with a
+    budget are serialized under GLOBAL_THREAD_BUDGET_LOCK. Otherwise two
+    requests would interleave and restore each other's thread counts, leaving
+    the process on the wrong one.
+    """
+    import torch
+
+    if num_threads is None:
+        yield
+        return
+    with GLOBAL_THREAD_BUDGET_LOCK:
+        prev_num_threads = torch.get_num_threads()
+        torch.set_num_threads(num_threads)
+        try:
+            yield
+        finally:
+            torch.set_num_threads(prev_num_threads)
+
+
+def _tuning_records():
+    r"""
+    Open the file of settings persisted by pie_v2_autotune
+    """
+    from wbia_pie_v2.inference.autotune import TuningRecords
+
+    fpath = os.path.join(
+        ut.ensure_app_cache_dir('wbia_pie_v2', 'autotune'), 'settings.json'
+    )
+    return _cached(GLOBAL_TUNING_RECORDS, fpath, lambda: TuningRecords(fpath))
 
-    embeddings = np.concatenate(embeddings)
-    return embeddings
+
+def _tuning_key(cfg):
+    r"""
+    Everything the CPU throughput of a model depends on: its architecture,
+    input size and format, backend and precision, but not its weights
+    """
+    return '{}.{}x{}.{}.{}.{}'.format(
+        cfg.model.name,
+        cfg.data.height,
+        cfg.data.width,
+        'uint8' if cfg.test.uint8_input else 'float',
+        cfg.test.backend,
+        cfg.test.precision,
+    )
+
+
+def _tuned_setting(cfg):
+    r"""
+    The batch size and thread count tuned for this model on this host, empty
+    if it was not tuned, on GPU, or with ``cfg.test.autotune`` disabled
+    """
+    from wbia_pie_v2.inference.autotune import host_fingerprint
+
+    if not cfg.test.autotune or _use_gpu(cfg):
+        return {}
+    setting = _tuning_records().get(host_fingerprint(), _tuning_key(cfg))
+    return {} if setting is None else setting
+
+
+def _batch_size(cfg):
+    return _tuned_setting(cfg).get('batch_size', cfg.test.batch_size)
 
 
 class PieV2Config(dt.Config):  # NOQA
@@ -210,6 +923,8 @@ class PieV2Config(dt.Config):  # NOQA
 
 def get_match_results(depc, qaid_list, daid_list, score_list, config):
     """ converts table results into format for ipython notebook """
+    from wbia_pie_v2.metrics import NameIndex
+
     # qaid_list, daid_list = request.get_parent_rowids()
     # score_list = request.score_list
     # config = request.config
@@ -221,11 +936,14 @@ def get_match_results(depc, qaid_list, daid_list, score_list, config):
 
     ibs = depc.controller
     unique_qnids = ibs.get_annot_nids(unique_qaids)
+    # The names of all database annotations are fetched at once
+    unique_daids = np.unique(daid_list)
+    unique_dnids = np.array(ibs.get_annot_nids(unique_daids.tolist()))
 
     # scores
     _iter = zip(unique_qaids, unique_qnids, grouped_daids, grouped_scores)
     for qaid, qnid, daids, scores in _iter:
-        dnids = ibs.get_annot_nids(daids)
+        dnids = unique_dnids[np.searchsorted(unique_daids, daids)]
 
         # Remove distance to self
         annot_scores = np.array(scores)
@@ -246,8 +964,11 @@ def get_match_results(depc, qaid_list, daid_list, score_list, config):
         match_result._update_daid_index()
         match_result._update_unique_nid_index()
 
-        grouped_annot_scores = vt.apply_grouping(annot_scores, match_result.name_groupxs)
-        name_scores = np.array([np.sum(dists) for dists in grouped_annot_scores])
+        # unique_nids are sorted, as the names of a NameIndex
+        name_codes = NameIndex(dnid_list_).codes
+        name_scores = np.bincount(
+            name_codes, weights=annot_scores, minlength=len(match_result.unique_nids)
+        )
         match_result.set_cannonical_name_score(annot_scores, name_scores)
         yield match_result
 
@@ -302,6 +1023,8 @@ class PieV2Request(dt.base.VsOneSimilarityRequest):
     chunksize=None,
 )
 def wbia_plugin_pie_v2(depc, qaid_list, daid_list, config):
+    import tqdm
+
     ibs = depc.controller
 
     qaids = list(set(qaid_list))
@@ -309,36 +1032,42 @@ def wbia_plugin_pie_v2(depc, qaid_list, daid_list, config):
 
     use_knn = config.get('use_knn', True)
 
+    # All queries are ranked against the database at once
     qaid_score_dict = {}
-    for qaid in tqdm.tqdm(qaids):
-        if use_knn:
-                pie_name_dists = ibs.pie_v2_predict_light(
-                    qaid,
-                    daids,
-                    config['config_path'],
-                )
-                pie_name_scores = distance_dicts_to_name_score_dicts(pie_name_dists)
-
-                aid_score_list = aid_scores_from_name_scores(ibs, pie_name_scores, daids)
-                aid_score_dict = dict(zip(daids, aid_score_list))
+    if use_knn:
+        from wbia_pie_v2.metrics import NameIndex
 
-                qaid_score_dict[qaid] = aid_score_dict
-        else:
-            pie_annot_distances = ibs.pie_v2_predict_light_distance(
-                qaid,
-                daids,
-                config['config_path'],
+        pie_name_dists_list = ibs.pie_v2_predict_light_batch(
+            qaids,
+            daids,
+            config['config_path'],
+        )
+        # The gallery labels are fetched and indexed once for every query
+        label_index = NameIndex(_db_labels_for_pie(ibs, daids))
+        for qaid, pie_name_dists in zip(tqdm.tqdm(qaids), pie_name_dists_list):
+            pie_name_scores = distance_dicts_to_name_score_dicts(pie_name_dists)
+            qaid_score_dict[qaid] = aid_scores_from_name_scores(
+                ibs, pie_name_scores, daids, label_index=label_index
             )
-            qaid_score_dict[qaid] = {}
-            for daid, pie_annot_distance in zip(daids, pie_annot_distances):
-                qaid_score_dict[qaid][daid] = distance_to_score(pie_annot_distance, norm=500.0)
+    else:
+        pie_annot_distances = ibs.pie_v2_predict_light_distance_batch(
+            qaids,
+            daids,
+            config['config_path'],
+        )
+        pie_annot_scores = distance_to_score(pie_annot_distances, norm=500.0)
+        qaid_score_dict = dict(zip(qaids, pie_annot_scores))
 
+    daid_index = {daid: idx for idx, daid in enumerate(daids)}
     for qaid, daid in zip(qaid_list, daid_list):
         if qaid == daid:
             daid_score = 0.0
         else:
-            aid_score_dict = qaid_score_dict.get(qaid, {})
-            daid_score = aid_score_dict.get(daid)
+            aid_scores = qaid_score_dict.get(qaid)
+            if aid_scores is None:
+                daid_score = None
+            else:
+                daid_score = float(aid_scores[daid_index[daid]])
         yield (daid_score,)
 
 
@@ -348,24 +1077,428 @@ def evaluate_distmat(ibs, aid_list, config, use_depc, ranks=[1, 5, 10, 20]):
     computing distance matrix.
     """
     embs = np.array(pie_v2_embedding(ibs, aid_list, config, use_depc))
-    print('Computing distance matrix ...')
-    distmat = distance_matrix(embs, embs)
+    db_labels = np.array(ibs.get_annot_name_rowids(aid_list))
+    return _evaluate_embeddings(embs, db_labels, ranks)
+
+
+def _evaluate_embeddings(embs, db_labels, ranks=[1, 5, 10, 20]):
+    r"""
+    Print the 1vsall ranks of a set of embeddings and return rank-1
+
+    The nearest neighbours of every embedding are searched in blocks within
+    a fixed memory budget, see :func:`streaming_topk`, so that the distance
+    matrix of large galleries is never held in memory. ``embs`` may be a
+    memory-mapped array.
+    """
+    from wbia_pie_v2.metrics import streaming_cmc
 
     print('Computing ranks ...')
-    db_labels = np.array(ibs.get_annot_name_rowids(aid_list))
-    cranks, mAP = eval_onevsall(distmat, db_labels)
+    cranks = streaming_cmc(embs, db_labels, max_rank=max(ranks))
 
     print('** Results **')
-    # print('mAP: {:.1%}'.format(mAP))
     for r in ranks:
         print('Rank-{:<3}: {:.1%}'.format(r, cranks[r - 1]))
     return cranks[0]
 
 
+@register_ibs_method
+def pie_v2_validate_precision(
+    ibs,
+    aid_list,
+    config=None,
+    precision='bfloat16',
+    embedding_dtype='float16',
+    ranks=[1, 5, 10, 20],
+):
+    r"""
+    Compare reduced-precision embeddings against float32 on a set of annotations
+
+    The embeddings of ``aid_list`` are computed in float32 and under
+    ``precision``, and the reduced ones are rounded to ``embedding_dtype`` as
+    they would be when stored. The distance matrices and ranks of both are
+    then compared.
+
+    Args:
+        ibs (IBEISController): IBEIS / WBIA controller object
+        aid_list (list of int): annotations to evaluate, typically a demo database
+        config (str): config url overriding the per-species default
+        precision (str): reduced forward pass precision, e.g. 'bfloat16'
+        embedding_dtype (str): reduced storage dtype, e.g. 'float16'
+        ranks (list of int): ranks to report
+
+    Returns:
+        dict: rank-1 of both precisions, the largest absolute difference
+        between the distance matrices, and their total difference relative to
+        the float32 distances
+
+    CommandLine:
+        python -m wbia_pie_v2._plugin pie_v2_validate_precision
+
+    Example:
+        >>> # ENABLE_DOCTEST
+        >>> import wbia_pie_v2
+        >>> from wbia_pie_v2._plugin import DEMOS
+        >>> species = 'rhincodon_typus'
+        >>> test_ibs = wbia_pie_v2._plugin.wbia_pie_v2_test_ibs(DEMOS[species], species, 'test2021')
+        >>> aid_list = test_ibs.get_valid_aids(species=species)
+        >>> result = test_ibs.pie_v2_validate_precision(aid_list)
+        >>> assert abs(result['rank1'] - result['rank1_reduced']) < 1e-2
+        >>> assert result['distance_rel_diff'] < 1e-2
+    """
+    from scipy.spatial import distance_matrix
+
+    db_labels = np.array(ibs.get_annot_name_rowids(aid_list))
+
+    print('Evaluating float32 embeddings ...')
+    embs = np.array(
+        pie_v2_compute_embedding(ibs, aid_list, config, precision='float32'),
+        dtype=np.float32,
+    )
+    rank1 = _evaluate_embeddings(embs, db_labels, ranks)
+
+    print('Evaluating {} embeddings stored as {} ...'.format(precision, embedding_dtype))
+    reduced_embs = np.array(
+        pie_v2_compute_embedding(ibs, aid_list, config, precision=precision),
+        dtype=embedding_dtype,
+    ).astype(np.float32)
+    rank1_reduced = _evaluate_embeddings(reduced_embs, db_labels, ranks)
+
+    distmat = distance_matrix(embs, embs)
+    reduced_distmat = distance_matrix(reduced_embs, reduced_embs)
+    abs_diff = np.abs(reduced_distmat - distmat)
+    result = {
+        'rank1': rank1,
+        'rank1_reduced': rank1_reduced,
+        'distance_abs_diff': abs_diff.max(),
+        'distance_rel_diff': abs_diff.sum() / max(np.abs(distmat).sum(), 1e-12),
+    }
+    print('Distance matrix max abs diff: {:.4g}'.format(result['distance_abs_diff']))
+    print('Distance matrix mean rel diff: {:.4g}'.format(result['distance_rel_diff']))
+    return result
+
+
+@register_ibs_method
+def pie_v2_quantize_model(
+    ibs,
+    aid_list,
+    config_url,
+    model_url,
+    num_calibration=256,
+    max_rank1_drop=0.01,
+    publish=True,
+):
+    r"""
+    Quantize a model to int8 and publish it for the 'int8' backend if it passes
+    the accuracy gate
+
+    ResNet models get static post-training quantization calibrated on a random
+    sample of ``aid_list``; other models, or ResNets whose static quantization
+    fails, get dynamic quantization of the fc head. The rank-1 accuracies of
+    the float model of ``model_url`` and of the quantized model are computed
+    on ``aid_list`` from the same preprocessed batches, and the quantized
+    model is only written where ``_load_model`` picks it up if its rank-1 is
+    no more than ``max_rank1_drop`` below.
+
+    Args:
+        ibs (IBEISController): IBEIS / WBIA controller object
+        aid_list (list of int): annotations used for calibration and evaluation,
+            typically a demo database
+        config_url (str): config url of the float model
+        model_url (str): checkpoint url of the float model
+        num_calibration (int): number of annotations in the calibration pass
+        max_rank1_drop (float): largest accepted rank-1 regression
+        publish (bool): save the artifact if the gate passes
+
+    Returns:
+        dict: rank-1 of both models, the quantization scheme, whether the
+        artifact was published and its path
+
+    Example:
+        >>> # ENABLE_DOCTEST
+        >>> import wbia_pie_v2
+        >>> from wbia_pie_v2._plugin import DEMOS, CONFIGS, MODELS
+        >>> species = 'rhincodon_typus'
+        >>> test_ibs = wbia_pie_v2._plugin.wbia_pie_v2_test_ibs(DEMOS[species], species, 'test2021')
+        >>> aid_list = test_ibs.get_valid_aids(species=species)
+        >>> result = test_ibs.pie_v2_quantize_model(aid_list, CONFIGS[species], MODELS[species], publish=False)
+        >>> assert result['scheme'] == 'static'
+        >>> assert result['rank1'] - result['rank1_int8'] < 0.01
+    """
+    import torch
+    from wbia_pie_v2.inference import quantization
+
+    cfg = _load_config(config_url)
+    cfg.use_gpu = False
+    model_path = _download_model(model_url)
+    model = _build_model(cfg, model_path)
+
+    rng = np.random.RandomState(0)
+    num_calibration = min(num_calibration, len(aid_list))
+    calib_aids = rng.choice(aid_list, num_calibration, replace=False).tolist()
+    calib_loader, _ = _load_data(ibs, calib_aids, cfg)
+    calibration_batches = (_prepare_batch(cfg, images) for images, _ in calib_loader)
+    print('Quantizing model: {}'.format(cfg.model.name))
+    qmodel, scheme = quantization.quantize_model(
+        model, cfg.model.name, calibration_batches
+    )
+
+    # Both models embed the same preprocessed batches, so that the gate only
+    # measures the quantization
+    print('Embedding with the float and int8 ({} quantization) models ...'.format(scheme))
+    test_loader, _ = _load_data(ibs, aid_list, cfg)
+    float_embs, int8_embs = [], []
+    with torch.no_grad():
+        for images, _ in test_loader:
+            images = _prepare_batch(cfg, images)
+            float_embs.append(model(images).float().numpy())
+            int8_embs.append(qmodel(images).float().numpy())
+    db_labels = np.array(ibs.get_annot_name_rowids(aid_list))
+    print('Evaluating float model ...')
+    rank1 = _evaluate_embeddings(np.concatenate(float_embs), db_labels)
+    print('Evaluating int8 model ...')
+    rank1_int8 = _evaluate_embeddings(np.concatenate(int8_embs), db_labels)
+
+    fpath = _artifact_fpath(cfg, model_path, 'int8')
+    passed = quantization.passes_accuracy_gate(rank1, rank1_int8, max_rank1_drop)
+    if not passed:
+        print(
+            'Rank-1 dropped from {:.1%} to {:.1%}, not publishing {}'.format(
+                rank1, rank1_int8, fpath
+            )
+        )
+    elif publish:
+        quantization.save_quantized(qmodel, _example_input(cfg), fpath)
+        # Replaces a float fallback loaded for the int8 backend on its next use
+        MODEL_REGISTRY.unload((config_url, model_url, 'cpu', 'int8'))
+    return {
+        'rank1': rank1,
+        'rank1_int8': rank1_int8,
+        'scheme': scheme,
+        'published': passed and publish,
+        'fpath': fpath,
+    }
+
+
+@register_ibs_method
+def pie_v2_autotune(
+    ibs,
+    species,
+    config=None,
+    backend=None,
+    precision=None,
+    batch_sizes=None,
+    thread_counts=None,
+    repeats=3,
+    save=True,
+):
+    r"""
+    Find the CPU batch size and torch intra-op thread count of highest
+    throughput for the model of a species on this host
+
+    The model is benchmarked on synthetic inputs of ``cfg.data.height`` x
+    ``cfg.data.width``. The best setting is saved per (host fingerprint,
+    model), and from then on used by :func:`pie_v2_compute_embedding` and
+    ``_load_data`` instead of ``cfg.test.batch_size`` and the default thread
+    count. Set ``cfg.test.autotune = False`` to ignore it.
+
+    The inter-op thread pool is not tuned: torch fixes its size on first use,
+    and a forward pass of one model does not run inter-op parallel work.
+
+    Args:
+        ibs (IBEISController): IBEIS / WBIA controller object
+        species (str): species whose model is tuned
+        config (str): config url overriding the per-species default
+        backend (str): inference backend overriding ``cfg.test.backend``
+        precision (str): forward pass precision overriding ``cfg.test.precision``
+        batch_sizes (list of int): candidate batch sizes, default 8 to 128
+        thread_counts (list of int): candidate thread counts, default powers of
+            two up to the number of usable cores
+        repeats (int): timed forward passes per setting
+        save (bool): persist the best setting
+
+    Returns:
+        dict: the best ``batch_size`` and ``num_threads``, its ``throughput``
+        in images per second, and the ``results`` of every setting tried
+
+    Example:
+        >>> # ENABLE_DOCTEST
+        >>> import wbia_pie_v2
+        >>> from wbia_pie_v2 import _plugin
+        >>> species = 'rhincodon_typus'
+        >>> test_ibs = _plugin.wbia_pie_v2_examples_ibs(species)
+        >>> setting = test_ibs.pie_v2_autotune(species, batch_sizes=[2, 4], thread_counts=[1, 2], repeats=1)
+        >>> cfg = _plugin._load_config(_plugin.CONFIGS[species])
+        >>> assert _plugin._batch_size(cfg) == setting['batch_size']
+        >>> assert _plugin._tuned_setting(cfg)['num_threads'] == setting['num_threads']
+    """
+    from wbia_pie_v2.inference import autotune
+    from wbia_pie_v2.utils.torchtools import bfloat16_autocast
+
+    config_url, model_url = _group_keys([species], config)[0]
+    cfg = _load_config(config_url)
+    cfg.use_gpu = False
+    if backend is not None:
+        cfg.test.backend = backend
+    if precision is not None:
+        cfg.test.precision = precision
+
+    model = _get_model(cfg, config_url, model_url)
+    autocast = bfloat16_autocast(
+        'cpu',
+        enabled=cfg.test.precision == 'bfloat16' and cfg.test.backend == 'eager',
+    )
+
+    def model_fn():
+        run_model = model
+        if cfg.test.backend == 'onnx':
+            # The session sizes its thread pool on creation
+            from wbia_pie_v2.inference.onnx_backend import OnnxEmbedder
+
+            run_model = OnnxEmbedder(model.fpath)
+
+        def run(images):
+            with autocast:
+                return run_model(images)
+
+        return run
+
+    def make_input(batch_size):
+        return _prepare_batch(cfg, _example_input(cfg, batch_size))
+
+    print('Tuning {} on host {}'.format(_tuning_key(cfg), autotune.host_fingerprint()))
+    # The sweep changes the process-wide thread count, as _thread_budget does
+    with GLOBAL_THREAD_BUDGET_LOCK:
+        setting = autotune.autotune(
+            model_fn,
+            make_input,
+            batch_sizes=batch_sizes,
+            thread_counts=thread_counts,
+            repeats=repeats,
+        )
+    print(
+        'Best: batch size {batch_size}, {num_threads} threads, '
+        '{throughput:.1f} images/s'.format(**setting)
+    )
+    if save:
+        _tuning_records().put(
+            autotune.host_fingerprint(),
+            _tuning_key(cfg),
+            ut.dict_subset(setting, ['batch_size', 'num_threads', 'throughput']),
+        )
+    return setting
+
+
+@register_ibs_method
+def pie_v2_benchmark_sharding(
+    ibs,
+    species,
+    config=None,
+    splits=None,
+    batch_size=None,
+    num_batches=None,
+    precision=None,
+):
+    r"""
+    Compare the CPU throughput of one process running N threads with N/M
+    processes of M threads each, as used by ``pie_v2_compute_embedding`` with
+    ``num_procs``, on synthetic inputs of ``cfg.data.height`` x ``cfg.data.width``
+
+    Args:
+        ibs (IBEISController): IBEIS / WBIA controller object
+        species (str): species whose model is benchmarked
+        config (str): config url overriding the per-species default
+        splits (list of tuple): (processes, threads per process) pairs, default
+            1 x N, 2 x N/2, ... down to 2 threads per process
+        batch_size (int): images per batch, default the tuned or configured
+            batch size
+        num_batches (int): batches embedded by every split, default 4 per
+            process of the largest split
+        precision (str): forward pass precision overriding ``cfg.test.precision``
+
+    Returns:
+        list of dict: ``num_procs``, ``num_threads`` and ``throughput`` in
+        images per second of every split
+
+    Example:
+        >>> # ENABLE_DOCTEST
+        >>> import wbia_pie_v2
+        >>> from wbia_pie_v2 import _plugin
+        >>> species = 'rhincodon_typus'
+        >>> test_ibs = _plugin.wbia_pie_v2_examples_ibs(species)
+        >>> results = test_ibs.pie_v2_benchmark_sharding(species, splits=[(1, 2), (2, 1)], batch_size=2)
+        >>> assert [result['num_procs'] for result in results] == [1, 2]
+    """
+    from wbia_pie_v2.inference import sharded
+
+    config_url, model_url = _group_keys([species], config)[0]
+    cfg = _load_config(config_url)
+    cfg.use_gpu = False
+    cfg.test.backend = 'eager'
+    if precision is not None:
+        cfg.test.precision = precision
+
+    if splits is None:
+        splits = sharded.default_splits()
+    if batch_size is None:
+        batch_size = _batch_size(cfg)
+    if num_batches is None:
+        num_batches = 4 * max(num_procs for num_procs, _ in splits)
+
+    model = _get_model(cfg, config_url, model_url)
+    batches = [
+        _prepare_batch(cfg, _example_input(cfg, batch_size)) for _ in range(num_batches)
+    ]
+    # The in-process split changes the process-wide thread count
+    with GLOBAL_THREAD_BUDGET_LOCK:
+        return sharded.benchmark_splits(
+            model, batches, splits=splits, precision=cfg.test.precision
+        )
+
+
+@register_ibs_method
+def pie_v2_loaded_models(ibs):
+    r"""
+    List the models held in memory by this process, least recently used first
+    """
+    return MODEL_REGISTRY.loaded()
+
+
+@register_ibs_method
+def pie_v2_unload_models(ibs):
+    r"""
+    Release every model held in memory by this process, and stop the
+    sharded inference worker processes
+
+    Returns:
+        int: number of models released
+    """
+    import torch
+
+    num_unloaded = MODEL_REGISTRY.unload()
+    with GLOBAL_CACHES_LOCK:
+        GLOBAL_CONFIG_CACHE.clear()
+        sharded_list = list(GLOBAL_SHARDED_EMBEDDERS.values())
+        GLOBAL_SHARDED_EMBEDDERS.clear()
+    # Joining the workers can take seconds, other lookups go on meanwhile
+    for sharded in sharded_list:
+        sharded.close()
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+    return num_unloaded
+
+
 def _load_config(config_url):
     r"""
     Load a configuration file
     """
+    cfg = _cached(GLOBAL_CONFIG_CACHE, config_url, lambda: _read_config(config_url))
+    return cfg.clone()
+
+
+def _read_config(config_url):
+    import torch
+    from wbia_pie_v2.default_config import get_default_config
+
     config_fname = config_url.split('/')[-1]
     config_file = ut.grab_file_url(
         config_url, appname='wbia_pie_v2', check_hash=True, fname=config_fname
@@ -381,23 +1514,21 @@ def _load_model(cfg, model_url):
     r"""
     Load a model based on config file
     """
-    print('Building model: {}'.format(cfg.model.name))
-    model = build_model(
-        name=cfg.model.name,
-        num_classes=cfg.model.num_train_classes,
-        loss=cfg.loss.name,
-        pretrained=cfg.model.pretrained,
-        use_gpu=cfg.use_gpu,
-    )
+    import torch
 
-    # Download the model weights
-    model_fname = model_url.split('/')[-1]
-    model_path = ut.grab_file_url(
-        model_url, appname='wbia_pie_v2', check_hash=True, fname=model_fname
-    )
+    model_path = _download_model(model_url)
+    build_model = ut.partial(_build_model, cfg, model_path)
+
+    if cfg.test.backend == 'int8':
+        return _load_quantized_model(cfg, model_path, build_model)
 
-    load_pretrained_weights(model, model_path)
+    if cfg.test.backend == 'onnx':
+        return _load_onnx_model(cfg, model_path, build_model)
 
+    if cfg.test.backend == 'torchscript' and not cfg.use_gpu:
+        return _load_frozen_model(cfg, model_path, build_model)
+
+    model = build_model()
     # if cfg.use_gpu:
     #    model.load_state_dict(torch.load(model_path))
     # else:
@@ -405,45 +1536,196 @@ def _load_model(cfg, model_url):
     # print('Loaded model from {}'.format(model_path))
     if cfg.use_gpu:
         model = torch.nn.DataParallel(model).cuda()
+    model.eval()
     return model
 
 
-def _load_data(ibs, aid_list, cfg, multithread=False):
+def _download_model(model_url):
+    r"""
+    Download the model weights, returning the local checkpoint path
+    """
+    model_fname = model_url.split('/')[-1]
+    return ut.grab_file_url(
+        model_url, appname='wbia_pie_v2', check_hash=True, fname=model_fname
+    )
+
+
+def _build_model(cfg, model_path):
+    r"""
+    Build the eval-mode CPU model straight from the fine-tuned weights, without
+    ImageNet weights or random initialization
+    """
+    import torch
+    from wbia_pie_v2.datasets.transforms import NORM_MEAN, NORM_STD, BatchNormalize
+    from wbia_pie_v2.models import build_inference_model
+    from wbia_pie_v2.utils import read_state_dict
+
+    print('Building model: {}'.format(cfg.model.name))
+    model = build_inference_model(
+        name=cfg.model.name,
+        num_classes=cfg.model.num_train_classes,
+        state_dict=read_state_dict(model_path),
+        loss=cfg.loss.name,
+    )
+    print('Loaded model weights from "{}"'.format(model_path))
+
+    if cfg.test.uint8_input:
+        model = torch.nn.Sequential(BatchNormalize(NORM_MEAN, NORM_STD), model)
+    return model.eval()
+
+
+def _artifact_fpath(cfg, model_path, kind):
+    r"""
+    Path of a derived model artifact, keyed by the checkpoint hash, the input
+    size and format, and the torch version
+    """
+    import torch
+    from wbia_pie_v2.inference.torchscript import file_hash
+
+    fname = 'pie_v2.{}.{}.{}x{}.{}.torch{}.pt'.format(
+        cfg.model.name,
+        file_hash(model_path)[:16],
+        cfg.data.height,
+        cfg.data.width,
+        'uint8' if cfg.test.uint8_input else 'float',
+        torch.__version__.split('+')[0],
+    )
+    return os.path.join(ut.ensure_app_cache_dir('wbia_pie_v2', kind), fname)
+
+
+def _example_input(cfg, batch_size=2):
+    import torch
+
+    shape = (batch_size, 3, cfg.data.height, cfg.data.width)
+    if cfg.test.uint8_input:
+        return torch.randint(0, 256, shape, dtype=torch.uint8)
+    return torch.randn(*shape)
+
+
+def _load_frozen_model(cfg, model_path, build_model):
+    r"""
+    Load the frozen TorchScript version of a model for CPU inference, freezing
+    and caching it on first use
+    """
+    from wbia_pie_v2.inference import torchscript
+
+    fpath = _artifact_fpath(cfg, model_path, 'frozen')
+    return torchscript.load_or_freeze(fpath, build_model, _example_input(cfg))
+
+
+def _load_quantized_model(cfg, model_path, build_model):
+    r"""
+    Load the int8 model published by pie_v2_quantize_model for CPU inference.
+    Without a published artifact, which passed the accuracy gate, the float
+    model is used instead.
+    """
+    import torch
+
+    fpath = _artifact_fpath(cfg, model_path, 'int8')
+    if os.path.exists(fpath):
+        print('Loading quantized model from "{}"'.format(fpath))
+        return torch.jit.load(fpath, map_location='cpu')
+    warnings.warn(
+        'No quantized model at "{}", using the float model. Publish one with '
+        'pie_v2_quantize_model'.format(fpath)
+    )
+    return build_model()
+
+
+def _load_onnx_model(cfg, model_path, build_model):
+    r"""
+    Load the ONNX export of a model into an onnxruntime CPU session, exporting
+    and caching it on first use
+    """
+    from wbia_pie_v2.inference import onnx_backend
+
+    fpath = _artifact_fpath(cfg, model_path, 'onnx')[:-3] + '.onnx'
+    if not os.path.exists(fpath):
+        onnx_backend.export_onnx(build_model(), fpath, _example_input(cfg))
+    print('Loading ONNX model from "{}"'.format(fpath))
+    return onnx_backend.OnnxEmbedder(fpath)
+
+
+def _use_gpu(cfg):
+    r"""
+    The int8 and onnx backends only run on CPU
+    """
+    return cfg.use_gpu and cfg.test.backend not in ('int8', 'onnx')
+
+
+def _get_model(cfg, config_url, model_url):
+    r"""
+    Get an eval-mode model from the process-wide registry, loading it on first use
+    """
+    device = 'cuda' if _use_gpu(cfg) else 'cpu'
+    key = (config_url, model_url, device, cfg.test.backend)
+    return MODEL_REGISTRY.get(key, lambda: _load_model(cfg, model_url))
+
+
+def _load_data(ibs, aid_list, cfg, multithread=False, num_workers=None):
     r"""
     Load data, preprocess and create data loaders
     """
-    test_transform = transforms.Compose(
-        [
-            transforms.ToTensor(),
-            transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]),
-        ]
+    return _load_annot_data(
+        _annot_inputs(ibs, aid_list),
+        cfg,
+        _get_chip_cache(ibs),
+        multithread,
+        num_workers,
     )
 
-    image_paths = ibs.get_annot_image_paths(aid_list)
-    bboxes = ibs.get_annot_bboxes(aid_list)
-    names = ibs.get_annot_name_rowids(aid_list)
+
+def _load_annot_data(annots, cfg, chip_cache=None, multithread=False, num_workers=None):
+    r"""
+    Create the data loader of annotations given by their image, bounding box
+    and viewpoint
+    """
+    import torch
+    import torchvision.transforms as transforms
+    from wbia_pie_v2.datasets import AnimalNameWbiaDataset
+    from wbia_pie_v2.datasets.transforms import NORM_MEAN, NORM_STD
+
+    if cfg.test.uint8_input:
+        # Normalization runs once per batch inside the model, see _load_model
+        test_transform = None
+    else:
+        test_transform = transforms.Compose(
+            [
+                transforms.ToTensor(),
+                transforms.Normalize(mean=NORM_MEAN, std=NORM_STD),
+            ]
+        )
+
+    image_paths = annots['image_path']
+    names = annots.get('name', [0] * len(image_paths))
     target_imsize = (cfg.data.height, cfg.data.width)
-    viewpoints = ibs.get_annot_viewpoints(aid_list)
+
+    image_uuids = annots.get('image_uuid')
+    if image_uuids is None:
+        # Chips are keyed by image uuid
+        chip_cache = None
 
     dataset = AnimalNameWbiaDataset(
         image_paths,
         names,
-        bboxes,
-        viewpoints,
+        list(annots['bbox']),
+        annots['viewpoint'],
         target_imsize,
         test_transform,
         fliplr=cfg.test.fliplr,
         fliplr_view=cfg.test.fliplr_view,
+        fast_decode=cfg.test.fast_decode,
+        chip_cache=chip_cache,
+        image_uuids=image_uuids,
+        uint8=cfg.test.uint8_input,
     )
 
-    if multithread:
-        num_workers = cfg.data.workers
-    else:
-        num_workers = 0
+    if num_workers is None:
+        num_workers = cfg.data.workers if multithread else 0
 
     dataloader = torch.utils.data.DataLoader(
         dataset,
-        batch_size=cfg.test.batch_size,
+        batch_size=_batch_size(cfg),
         shuffle=False,
         num_workers=num_workers,
         pin_memory=True,
@@ -454,10 +1736,28 @@ def _load_data(ibs, aid_list, cfg, multithread=False):
     return dataloader, dataset
 
 
+def _get_chip_cache(ibs):
+    r"""
+    Open the on-disk cache of preprocessed model-input chips, if enabled
+    """
+    from wbia_pie_v2.datasets import ChipCache
+
+    if CHIP_CACHE_MB <= 0:
+        return None
+    dpath = os.path.join(ibs.get_cachedir(), 'pie_v2_chips')
+    return _cached(
+        GLOBAL_CHIP_CACHES,
+        dpath,
+        lambda: ChipCache(dpath, max_bytes=CHIP_CACHE_MB * 2 ** 20),
+    )
+
+
 def wbia_pie_v2_test_ibs(demo_db_url, species, subset):
     r"""
     Create a database to test orientation detection from a coco annotation file
     """
+    from wbia_pie_v2.utils import read_json
+
     testdb_name = 'testdb_{}_{}'.format(species, subset)
 
     test_ibs = wbia.opendb(testdb_name, allow_newdir=True)
@@ -505,26 +1805,191 @@ def wbia_pie_v2_test_ibs(demo_db_url, species, subset):
         return test_ibs
 
 
+def wbia_pie_v2_examples_ibs(species):
+    r"""
+    Create a database from the example images shipped with the repository, with
+    one whole-image annotation per image
+    """
+    test_ibs = wbia.opendb('testdb_{}_examples'.format(species), allow_newdir=True)
+    if len(test_ibs.get_valid_aids()) > 0:
+        return test_ibs
+
+    example_dpath = os.path.join(os.path.dirname(__file__), '..', 'examples')
+    gpaths = sorted(
+        os.path.join(example_dpath, fname)
+        for fname in os.listdir(example_dpath)
+        if fname.endswith('.jpg')
+    )
+    gid_list = test_ibs.add_images(gpaths)
+    bbox_list = [(0, 0, w, h) for w, h in test_ibs.get_image_sizes(gid_list)]
+    test_ibs.add_annots(
+        gid_list, bbox_list=bbox_list, species_list=[species] * len(gid_list)
+    )
+    return test_ibs
+
+
 @register_ibs_method
 def pie_v2_predict_light(ibs, qaid, daid_list, config=None):
+    return pie_v2_predict_light_batch(ibs, [qaid], daid_list, config)[0]
+
+
+@register_ibs_method
+def pie_v2_predict_light_batch(ibs, qaid_list, daid_list, config=None, use_ann=None):
+    r"""
+    Rank the names of the database annotations for every query, computing the
+    query-to-database distances in tiles instead of one search per query
+
+    Galleries of a single species model with at least
+    WBIA_PIE_V2_ANN_MIN_GALLERY annotations are searched with its approximate
+    nearest neighbour index, see :func:`_sync_ann_index`.
+
+    Args:
+        use_ann (bool): force the use of the index on or off
+
+    Returns:
+        list of list of dict: ``label`` and ``distance`` of the nearest names
+        of every query, as returned by :func:`pie_v2_predict_light`
+    """
+    from wbia_pie_v2.metrics import pred_light_batch
+
     db_embs = np.array(ibs.pie_v2_embedding(daid_list, config))
     db_labels = np.array(ibs.get_annot_name_texts(daid_list, config))
-    query_emb = np.array(ibs.pie_v2_embedding([qaid], config))
+    query_embs = np.array(ibs.pie_v2_embedding(qaid_list, config))
+
+    if use_ann is None:
+        use_ann = ANN_MIN_GALLERY > 0 and len(daid_list) >= ANN_MIN_GALLERY
+    index = _sync_ann_index(ibs, daid_list, db_embs, config) if use_ann else None
+    if index is None:
+        return pred_light_batch(query_embs, db_embs, db_labels)
+
+    # The index is searched per annotation, and queries are searched again
+    # with more neighbours until they cover the nearest names
+    return index.search_names(query_embs, daid_list, db_labels)
+
+
+def _sync_ann_index(ibs, daid_list, db_embs, config=None):
+    r"""
+    Get the approximate nearest neighbour index of the species model of
+    ``daid_list``, adding the embeddings it misses, see :func:`_save_ann_index`.
+    Returns None if the annotations belong to several species models.
+    """
+    species_list = ut.unique(ibs.get_annot_species_texts(daid_list))
+    fingerprints = {_embedding_fingerprint(config, species) for species in species_list}
+    if len(fingerprints) != 1:
+        return None
+    fingerprint = fingerprints.pop()
+    index, fpath = _get_ann_index(ibs, fingerprint)
+    num_added = index.update(daid_list, db_embs)
+    if num_added > 0:
+        print('Added {} embeddings to the index "{}"'.format(num_added, fpath))
+    _save_ann_index(ibs, index, fpath, fingerprint, num_added, config)
+    return index
+
+
+def _save_ann_index(ibs, index, fpath, fingerprint, num_added=0, config=None):
+    r"""
+    Save an approximate nearest neighbour index, at most once every
+    ANN_SAVE_INTERVAL seconds, rather than rewriting it on every search that
+    adds an embedding. Annotations that left its gallery, i.e. were deleted
+    or now belong to another species model, are removed from it beforehand.
+
+    Returns:
+        bool: whether the index was saved
+    """
+    now = time.time()
+    with GLOBAL_CACHES_LOCK:
+        # The first change of a process is saved right away
+        saves = GLOBAL_ANN_SAVES.setdefault(fpath, {'num_unsaved': 0, 'time': 0})
+        saves['num_unsaved'] += num_added
+        if now - saves['time'] < ANN_SAVE_INTERVAL:
+            return False
+        num_unsaved = saves['num_unsaved']
+        saves.update(num_unsaved=0, time=now)
+
+    # Searches only return annotations of the gallery they are given, so
+    # stale entries only cost memory until they are pruned here
+    index_aids = index.aids
+    is_kept = np.isin(index_aids, ibs.get_valid_aids())
+    species_list = ibs.get_annot_species_texts(index_aids[is_kept].tolist())
+    species_fingerprints = {
+        species: _embedding_fingerprint(config, species)
+        for species in set(species_list)
+    }
+    is_kept[is_kept] = [
+        species_fingerprints[species] == fingerprint for species in species_list
+    ]
+    num_removed = int((~is_kept).sum())
+    if num_removed > 0:
+        print('Removed {} embeddings from the index "{}"'.format(num_removed, fpath))
+        index.remove(index_aids[~is_kept])
+
+    if num_unsaved + num_removed == 0:
+        return False
+    index.save(fpath)
+    return True
+
+
+@register_ibs_method
+def pie_v2_ann_recall(ibs, aid_list, config=None, k=10, nprobe=None):
+    r"""
+    Recall@k of the approximate nearest neighbour search, i.e. the fraction of
+    the exact k nearest neighbours it finds, with every annotation as a query
+    against all others. The index is trained on ``aid_list`` from scratch.
+
+    Example:
+        >>> # ENABLE_DOCTEST
+        >>> import wbia_pie_v2
+        >>> from wbia_pie_v2._plugin import DEMOS, CONFIGS
+        >>> for species in ['rhincodon_typus', 'whale_grey', 'horse_wild']:
+        >>>     test_ibs = wbia_pie_v2._plugin.wbia_pie_v2_test_ibs(DEMOS[species], species, 'test2021')
+        >>>     aid_list = test_ibs.get_valid_aids(species=species)
+        >>>     recall = test_ibs.pie_v2_ann_recall(aid_list, CONFIGS[species])
+        >>>     print('{}: recall@10 = {:.3f}'.format(species, recall))
+        >>>     assert recall > 0.9
+    """
+    from wbia_pie_v2.metrics.ann import IVFFlatIndex, squared_distances, recall_at_k
+
+    aids = np.array(aid_list)
+    embs = np.array(ibs.pie_v2_embedding(aid_list, config), dtype=np.float32)
+    index = IVFFlatIndex(train_size=0, nprobe=nprobe)
+    index.add(aids, embs)
 
-    ans = pred_light(query_emb, db_embs, db_labels)
-    return ans
+    # One more neighbour, the query itself, is dropped
+    neigh_aids, _ = index.search(embs, k + 1)
+    dists = squared_distances(embs, embs)
+    np.fill_diagonal(dists, np.inf)
+    exact_aids = aids[np.argsort(dists, axis=1, kind='stable')[:, :k]]
+    neigh_aids = [row[row != aid][:k] for aid, row in zip(aids, neigh_aids)]
+    return recall_at_k(neigh_aids, exact_aids)
 
 
 @register_ibs_method
 def pie_v2_predict_light_distance(ibs, qaid, daid_list, config=None):
+    return pie_v2_predict_light_distance_batch(ibs, [qaid], daid_list, config)[0]
+
+
+@register_ibs_method
+def pie_v2_predict_light_distance_batch(
+    ibs, qaid_list, daid_list, config=None, tile_size=256
+):
+    r"""
+    Distances of every query to every database annotation, computed in tiles
+    of ``tile_size`` queries
+
+    Returns:
+        np.ndarray: distance matrix of shape (len(qaid_list), len(daid_list))
+    """
+    import torch
+    from wbia_pie_v2.metrics import compute_distance_matrix
+
     assert len(daid_list) == len(set(daid_list))
-    db_embs = np.array(ibs.pie_v2_embedding(daid_list, config))
-    query_emb = np.array(ibs.pie_v2_embedding([qaid], config))
+    db_embs = torch.Tensor(np.array(ibs.pie_v2_embedding(daid_list, config)))
+    query_embs = np.array(ibs.pie_v2_embedding(qaid_list, config))
 
-    input1 = torch.Tensor(query_emb)
-    input2 = torch.Tensor(db_embs)
-    distmat = compute_distance_matrix(input1, input2)
-    distances = np.array(distmat[0])
+    distances = np.empty((len(query_embs), len(db_embs)), dtype=np.float32)
+    for start in range(0, len(query_embs), tile_size):
+        tile = torch.Tensor(query_embs[start : start + tile_size])
+        distances[start : start + len(tile)] = compute_distance_matrix(tile, db_embs)
     return distances
 
 
@@ -631,25 +2096,32 @@ def distance_dicts_to_name_score_dicts(distance_dicts, conversion_func=distance_
     return name_score_dicts
 
 
-def aid_scores_from_name_scores(ibs, name_score_dict, daid_list):
-    daid_name_list = list(_db_labels_for_pie(ibs, daid_list))
+def aid_scores_from_name_scores(ibs, name_score_dict, daid_list, label_index=None):
+    r"""
+    Split the score of every name evenly between its database annotations
 
-    name_count_dict = {
-        name: daid_name_list.count(name) for name in name_score_dict.keys()
-    }
+    Args:
+        label_index (NameIndex): labels of ``daid_list``, as returned by
+            :func:`_db_labels_for_pie`, to reuse them across queries
 
-    name_annotwise_score_dict = {
-        name: name_score_dict[name] / name_count_dict[name]
-        for name in name_score_dict.keys()
-    }
+    Returns:
+        float array: score of every annotation of ``daid_list``, 0 for names
+        absent from ``name_score_dict``
+    """
+    from wbia_pie_v2.metrics import NameIndex
 
-    from collections import defaultdict
+    if label_index is None:
+        label_index = NameIndex(_db_labels_for_pie(ibs, daid_list))
 
-    name_annotwise_score_dict = defaultdict(float, name_annotwise_score_dict)
+    codes = label_index.lookup(list(name_score_dict.keys()))
+    scores = np.array(list(name_score_dict.values()), dtype=np.float64)
+    is_valid = codes >= 0
+    codes, scores = codes[is_valid], scores[is_valid]
 
-    # bc daid_name_list is in the same order as daid_list
-    daid_scores = [name_annotwise_score_dict[name] for name in daid_name_list]
-    return daid_scores
+    name_annotwise_scores = np.zeros(len(label_index.names))
+    name_annotwise_scores[codes] = scores / label_index.counts[codes]
+    # bc label_index.codes is in the same order as daid_list
+    return name_annotwise_scores[label_index.codes]
 
 
 if __name__ == '__main__':
@@ -11,6 +11,7 @@ from .animal_datasets import SpermWhaleMax10Test
 from .animal_datasets import BottlenoseDolphin
 from .animal_datasets import ConfigDataset
 from .animal_wbia import AnimalNameWbiaDataset  # noqa: F401
+from .chip_cache import ChipCache  # noqa: F401
 
 
 __image_datasets = {
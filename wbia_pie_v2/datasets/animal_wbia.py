@@ -1,13 +1,30 @@
 # -*- coding: utf-8 -*-
+import torch
 from torch.utils.data import Dataset
 from skimage import transform as skimage_transform
+from PIL import Image
 import imageio
 import numpy as np
 
+from .chip_cache import ChipCache
+
 
 class AnimalNameWbiaDataset(Dataset):
     """Dataset to load animal data from COCO format for inference.
     Used in plugin.
+
+    With ``fast_decode=True``, JPEG annotations much larger than the target
+    size are decoded at a reduced resolution (see :func:`read_roi_reduced`)
+    instead of decoding the full image and resizing in float64.
+
+    With a ``chip_cache`` (and the ``image_uuids`` used to key it), the
+    cropped, resized and flipped chip is read from the cache before the
+    original image is touched, and stored there in uint8 after a miss.
+
+    With ``uint8=True`` samples are returned as uint8 CxHxW tensors and
+    ``transform`` is not applied, so that conversion to float and
+    normalization can run once per batch (see
+    :class:`~wbia_pie_v2.datasets.transforms.BatchNormalize`).
     """
 
     def __init__(
@@ -20,6 +37,10 @@ class AnimalNameWbiaDataset(Dataset):
         transform,
         fliplr=False,
         fliplr_view=None,
+        fast_decode=False,
+        chip_cache=None,
+        image_uuids=None,
+        uint8=False,
     ):
         self.image_paths = image_paths
         self.bboxes = bboxes
@@ -27,6 +48,13 @@ class AnimalNameWbiaDataset(Dataset):
         self.target_imsize = target_imsize
         self.transform = transform
         self.viewpoints = viewpoints
+        self.fast_decode = fast_decode
+        self.chip_cache = chip_cache
+        self.image_uuids = image_uuids
+        self.uint8 = uint8
+
+        if chip_cache is not None:
+            assert image_uuids is not None and len(image_uuids) == len(image_paths)
 
         if fliplr:
             assert isinstance(fliplr_view, list) and all(
@@ -40,6 +68,50 @@ class AnimalNameWbiaDataset(Dataset):
         return len(self.image_paths)
 
     def __getitem__(self, idx):
+        # Flip image if a model have been trained on one specific view
+        flip = self.fliplr and self.viewpoints[idx] in self.fliplr_view
+
+        image = None
+        if self.chip_cache is not None:
+            chip_key = ChipCache.key(
+                self.image_uuids[idx],
+                self.bboxes[idx],
+                self.target_imsize,
+                flip,
+                decoder='fast' if self.fast_decode else 'exact',
+            )
+            image = self.chip_cache.get(chip_key)
+
+        if image is None:
+            image = self._read_chip(idx)
+            if flip:
+                image = np.fliplr(image)
+            if self.chip_cache is not None:
+                image = _to_uint8(image)
+                self.chip_cache.put(chip_key, image)
+
+        if self.uint8:
+            image = _to_uint8(image).transpose(2, 0, 1)
+            return torch.from_numpy(np.ascontiguousarray(image)), self.names[idx]
+
+        if image.dtype == np.uint8:
+            image = image.astype(np.float64) / 255.0
+
+        if self.transform is not None:
+            image = self.transform(image.copy())
+        return image, self.names[idx]
+
+    def _read_chip(self, idx):
+        image = None
+        if self.fast_decode:
+            image = read_roi_reduced(
+                self.image_paths[idx], self.bboxes[idx], self.target_imsize
+            )
+        if image is None:
+            image = self._read_roi(idx)
+        return image
+
+    def _read_roi(self, idx):
         image = imageio.imread(self.image_paths[idx])
         if image is None:
             raise ValueError('Fail to read {}'.format(self.image_paths[id]))
@@ -56,12 +128,91 @@ class AnimalNameWbiaDataset(Dataset):
         image = skimage_transform.resize(
             image, self.target_imsize, order=3, anti_aliasing=True
         )
+        return image
 
-        # Flip image if a model have been trained on one specific view
-        if self.fliplr:
-            if self.viewpoints[idx] in self.fliplr_view:
-                image = np.fliplr(image)
 
-        if self.transform is not None:
-            image = self.transform(image.copy())
-        return image, self.names[idx]
+def _to_uint8(image):
+    if image.dtype == np.uint8:
+        return image
+    return np.clip(np.round(image * 255.0), 0, 255).astype(np.uint8)
+
+
+def read_roi_reduced(image_path, bbox, target_imsize, max_scale=8):
+    """Reads a bounding box from a JPEG at reduced resolution.
+
+    The JPEG is decoded with DCT scaling (``Image.draft``) at the largest
+    power-of-two reduction that keeps the bounding box at least as large as
+    the target size, and the box is then resized to the target size in uint8.
+    This skips most of the decoding and resizing work for large photos.
+
+    Args:
+        image_path (str): image path.
+        bbox (list): bounding box as ``[x, y, w, h]`` in full-resolution pixels.
+        target_imsize (tuple): target ``(height, width)``.
+        max_scale (int, optional): largest reduction factor. JPEG decoders
+            support 2, 4 and 8. Default is 8.
+
+    Returns:
+        np.ndarray or None: uint8 array of shape ``(height, width, 3)``, or None
+        if the image is not an RGB JPEG, the box is not fully inside the image,
+        or the box is too small to be reduced. Callers fall back to the full
+        resolution path in that case.
+
+    Example:
+        >>> import os.path as osp
+        >>> import tempfile
+        >>> import numpy as np
+        >>> from PIL import Image
+        >>> from wbia_pie_v2.datasets import AnimalNameWbiaDataset
+        >>> from wbia_pie_v2.datasets.animal_wbia import read_roi_reduced
+        >>> # Upsample an example into a large field photo
+        >>> example = osp.join(osp.dirname(__file__), '..', '..', 'examples', 'wh_000000000005_0.jpg')
+        >>> image_path = osp.join(tempfile.mkdtemp(), 'large.jpg')
+        >>> Image.open(example).resize((4000, 3000), Image.BICUBIC).save(image_path, quality=95)
+        >>> bbox = [600, 400, 2400, 2000]
+        >>> kwargs = dict(names=[0], bboxes=[bbox], viewpoints=['left'],
+        >>>               target_imsize=(256, 256), transform=None)
+        >>> fast = AnimalNameWbiaDataset([image_path], fast_decode=True, **kwargs)[0][0]
+        >>> exact = AnimalNameWbiaDataset([image_path], fast_decode=False, **kwargs)[0][0]
+        >>> assert fast.shape == exact.shape == (256, 256, 3)
+        >>> assert np.abs(fast - exact).mean() < 0.01
+        >>> assert np.abs(fast - exact).max() < 0.25
+        >>> assert read_roi_reduced(image_path, [0, 0, 300, 300], (256, 256)) is None
+        >>> # The image file is closed on every path, including the fallbacks
+        >>> import gc
+        >>> import warnings
+        >>> with warnings.catch_warnings(record=True) as caught:
+        >>>     warnings.simplefilter('always', ResourceWarning)
+        >>>     assert read_roi_reduced(image_path, [3000, 2000, 2400, 2000], (256, 256)) is None
+        >>>     assert read_roi_reduced(image_path, bbox, (256, 256)).shape == (256, 256, 3)
+        >>>     gc.collect()
+        >>> assert not [w for w in caught if issubclass(w.category, ResourceWarning)]
+    """
+    x1, y1, w, h = bbox
+    target_h, target_w = target_imsize
+
+    scale = 1
+    while (
+        scale < max_scale
+        and w // (2 * scale) >= target_w
+        and h // (2 * scale) >= target_h
+    ):
+        scale *= 2
+    if scale == 1:
+        return None
+
+    with Image.open(image_path) as image:
+        width, height = image.size
+        if image.format != 'JPEG' or image.mode != 'RGB':
+            return None
+        if x1 < 0 or y1 < 0 or x1 + w > width or y1 + h > height:
+            return None
+
+        # The decoder picks the smallest DCT scale not smaller than requested
+        image.draft('RGB', ((width + scale - 1) // scale, (height + scale - 1) // scale))
+        scale_x = width / image.size[0]
+        scale_y = height / image.size[1]
+        box = (x1 / scale_x, y1 / scale_y, (x1 + w) / scale_x, (y1 + h) / scale_y)
+        # The resized image is loaded, so it outlives the file
+        chip = image.resize((target_w, target_h), Image.BICUBIC, box=box)
+    return np.asarray(chip)
@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+from __future__ import division, print_function, absolute_import
+import os
+import os.path as osp
+import hashlib
+import threading
+import numpy as np
+
+
+__all__ = ['ChipCache']
+
+
+class ChipCache(object):
+    """Content-addressed on-disk cache of preprocessed uint8 model-input chips.
+
+    A chip is the cropped, resized and flipped annotation exactly as it is fed
+    to the model. Chips are stored as ``.npy`` files named by a hash of
+    everything that determines their content, so entries never go stale and
+    can be shared across models with the same input size. Reading a chip
+    refreshes its modification time, and once the cache exceeds ``max_bytes``
+    the least recently used chips are deleted. One cache can be shared by
+    threads and processes.
+
+    Args:
+        dpath (str): cache directory, created if missing.
+        max_bytes (int or None, optional): size cap. Default is None (unbounded).
+
+    Example:
+        >>> import uuid
+        >>> import tempfile
+        >>> import numpy as np
+        >>> from wbia_pie_v2.datasets import ChipCache
+        >>> cache = ChipCache(tempfile.mkdtemp(), max_bytes=20000)
+        >>> image_uuid = uuid.uuid4()
+        >>> keys = [cache.key(image_uuid, [0, 0, w, 10], (64, 64), False) for w in (10, 20)]
+        >>> assert cache.get(keys[0]) is None
+        >>> cache.put(keys[0], np.ones((64, 64, 3), dtype=np.uint8))
+        >>> assert cache.get(keys[0]).sum() == 64 * 64 * 3
+        >>> cache.put(keys[1], np.zeros((64, 64, 3), dtype=np.uint8))
+        >>> assert cache.get(keys[0]) is None and cache.get(keys[1]) is not None
+    """
+
+    def __init__(self, dpath, max_bytes=None):
+        self.dpath = dpath
+        self.max_bytes = max_bytes
+        os.makedirs(dpath, exist_ok=True)
+        self._lock = threading.Lock()
+        self.nbytes = sum(size for fpath, mtime, size in self._entries())
+
+    @staticmethod
+    def key(image_uuid, bbox, target_imsize, flip, decoder='exact'):
+        """Returns the cache key of a chip.
+
+        Args:
+            image_uuid (UUID): uuid of the source image.
+            bbox (list): bounding box as ``[x, y, w, h]``.
+            target_imsize (tuple): chip ``(height, width)``.
+            flip (bool): whether the chip is flipped left-right.
+            decoder (str, optional): decoding path that produced the chip.
+        """
+        text = '{}|{}|{}|{}|{}'.format(
+            image_uuid,
+            [int(v) for v in bbox],
+            tuple(target_imsize),
+            bool(flip),
+            decoder,
+        )
+        return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        """Returns the cached chip, or None on a miss."""
+        fpath = self._fpath(key)
+        try:
+            chip = np.load(fpath)
+        except (IOError, OSError, ValueError):
+            return None
+        try:
+            os.utime(fpath)
+        except OSError:
+            pass
+        return chip
+
+    def put(self, key, chip):
+        """Stores a uint8 chip."""
+        fpath = self._fpath(key)
+        os.makedirs(osp.dirname(fpath), exist_ok=True)
+        tmp_fpath = '{}.{}.{}.tmp.npy'.format(
+            fpath[:-4], os.getpid(), threading.get_ident()
+        )
+        np.save(tmp_fpath, np.ascontiguousarray(chip, dtype=np.uint8))
+        os.replace(tmp_fpath, fpath)
+        with self._lock:
+            self.nbytes += os.path.getsize(fpath)
+            if self.max_bytes is not None and self.nbytes > self.max_bytes:
+                self._evict()
+
+    def evict(self):
+        """Deletes the least recently used chips until 10% under the size cap."""
+        with self._lock:
+            self._evict()
+
+    def _evict(self):
+        entries = sorted(self._entries(), key=lambda entry: entry[1])
+        total = sum(size for fpath, mtime, size in entries)
+        for fpath, mtime, size in entries:
+            if total <= 0.9 * self.max_bytes:
+                break
+            try:
+                os.remove(fpath)
+            except OSError:
+                continue
+            total -= size
+        self.nbytes = total
+
+    def _fpath(self, key):
+        return osp.join(self.dpath, key[:2], key + '.npy')
+
+    def _entries(self):
+        for subdir in os.scandir(self.dpath):
+            if not subdir.is_dir():
+                continue
+            for entry in os.scandir(subdir.path):
+                if not entry.name.endswith('.npy') or '.tmp' in entry.name:
+                    continue
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    # Removed by another process
+                    continue
+                yield entry.path, stat.st_mtime_ns, stat.st_size
@@ -1,6 +1,8 @@
 # -*- coding: utf-8 -*-
 from __future__ import division, print_function, absolute_import
 import random
+import torch
+import torch.nn as nn
 from PIL import Image
 from torchvision.transforms import (
     Resize,
@@ -15,6 +17,10 @@ from torchvision.transforms import (
     GaussianBlur,
 )
 
+# ImageNet normalization of the pretrained backbones, used at inference
+NORM_MEAN = [0.485, 0.456, 0.406]
+NORM_STD = [0.229, 0.224, 0.225]
+
 
 def build_train_test_transforms(
     height,
@@ -91,6 +97,42 @@ class Random2DTranslation(object):
         return croped_img
 
 
+class BatchNormalize(nn.Module):
+    """Converts a batch of uint8 images to normalized float32 in one op.
+
+    Equivalent to ``ToTensor`` followed by ``Normalize`` on every sample, but
+    applied to a whole NxCxHxW batch as a single fused multiply-add, so
+    samples can stay uint8 through the data loader. Used as the first module
+    of an inference model.
+
+    Args:
+        norm_mean (list): normalization mean values in the [0, 1] range.
+        norm_std (list): normalization standard deviation values.
+
+    Example:
+        >>> import torch
+        >>> from torchvision.transforms import Normalize, ToTensor
+        >>> from wbia_pie_v2.datasets.transforms import BatchNormalize
+        >>> mean, std = [0.485, 0.456, 0.406], [0.229, 0.224, 0.225]
+        >>> images = torch.randint(0, 256, (2, 3, 8, 8), dtype=torch.uint8)
+        >>> expected = torch.stack([
+        >>>     Normalize(mean, std)(ToTensor()(image.permute(1, 2, 0).numpy()))
+        >>>     for image in images])
+        >>> assert torch.allclose(BatchNormalize(mean, std)(images), expected, atol=1e-5)
+    """
+
+    def __init__(self, norm_mean=NORM_MEAN, norm_std=NORM_STD):
+        super(BatchNormalize, self).__init__()
+        mean = torch.tensor(norm_mean, dtype=torch.float32).view(1, -1, 1, 1)
+        std = torch.tensor(norm_std, dtype=torch.float32).view(1, -1, 1, 1)
+        # (x / 255 - mean) / std == x * scale + shift
+        self.register_buffer('scale', 1.0 / (255.0 * std))
+        self.register_buffer('shift', -mean / std)
+
+    def forward(self, x):
+        return torch.addcmul(self.shift, x.float(), self.scale)
+
+
 def build_transforms(
     height,
     width,
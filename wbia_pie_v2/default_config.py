@@ -116,6 +116,12 @@ def get_default_config():
     cfg.test.visrank_resize = True  # if True resize images for visualization
     cfg.test.fliplr = False  # if True flip test image left-right
     cfg.test.fliplr_view = []  # viewpoint annotation to flip left-right
+    cfg.test.fast_decode = False  # decode large JPEGs at reduced resolution
+    cfg.test.uint8_input = False  # keep samples uint8, normalize per batch in model
+    cfg.test.backend = "eager"  # ['eager', 'torchscript', 'int8', 'onnx']
+    cfg.test.precision = "float32"  # eager forward pass, ['float32', 'bfloat16']
+    cfg.test.embedding_dtype = "float32"  # stored embeddings, ['float32', 'float16']
+    cfg.test.autotune = True  # use the CPU batch size and threads of pie_v2_autotune
 
     return cfg
 
@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+import argparse
+import torch
+import utool as ut
+
+from default_config import get_default_config
+from datasets.transforms import NORM_MEAN, NORM_STD, BatchNormalize
+from inference.onnx_backend import export_onnx
+from models import build_inference_model
+from utils import read_state_dict
+
+
+def _local_path(path_or_url):
+    if path_or_url.startswith(('http://', 'https://')):
+        fname = path_or_url.split('/')[-1]
+        return ut.grab_file_url(
+            path_or_url, appname='wbia_pie_v2', check_hash=True, fname=fname
+        )
+    return path_or_url
+
+
+def export(args):
+    cfg = get_default_config()
+    cfg.merge_from_file(_local_path(args.cfg))
+    cfg.merge_from_list(args.opts)
+
+    weights = _local_path(args.weights)
+    print("Building model: {}".format(cfg.model.name))
+    model = build_inference_model(
+        name=cfg.model.name,
+        num_classes=cfg.model.num_train_classes,
+        state_dict=read_state_dict(weights),
+        loss=cfg.loss.name,
+    )
+    print("Loaded model weights from {}".format(weights))
+
+    shape = (2, 3, cfg.data.height, cfg.data.width)
+    if cfg.test.uint8_input:
+        model = torch.nn.Sequential(BatchNormalize(NORM_MEAN, NORM_STD), model)
+        example = torch.randint(0, 256, shape, dtype=torch.uint8)
+    else:
+        example = torch.randn(*shape)
+
+    export_onnx(model.eval(), args.output, example, opset_version=args.opset)
+
+
+if __name__ == "__main__":
+    """
+    CommandLine:
+        python export_onnx.py \
+            --cfg https://wildbookiarepository.azureedge.net/models/pie_v2.whale_shark.20210315.yaml \
+            --weights https://wildbookiarepository.azureedge.net/models/pie_v2.whale_shark_cropped_model_20210315.pth.tar \
+            --output pie_v2.whale_shark.onnx
+    """
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument(
+        "--cfg", type=str, required=True, help="path or url of config file"
+    )
+    parser.add_argument(
+        "--weights", type=str, required=True, help="path or url of model checkpoint"
+    )
+    parser.add_argument("--output", type=str, required=True, help="output onnx path")
+    parser.add_argument("--opset", type=int, default=17, help="onnx opset version")
+
+    parser.add_argument(
+        "opts",
+        default=None,
+        nargs=argparse.REMAINDER,
+        help="Modify config options using the command-line",
+    )
+    args = parser.parse_args()
+
+    export(args)
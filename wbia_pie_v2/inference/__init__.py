@@ -0,0 +1,8 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+from .registry import ModelRegistry, model_nbytes  # noqa: F401
+from .embedding_cache import EmbeddingCache  # noqa: F401
+from .embedding_store import EmbeddingStore  # noqa: F401
+from .server import EmbeddingServer, EmbeddingClient, read_authkey  # noqa: F401
+from .batcher import MicroBatcher  # noqa: F401
+from .single_flight import SingleFlight  # noqa: F401
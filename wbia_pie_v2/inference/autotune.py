@@ -0,0 +1,236 @@
+# -*- coding: utf-8 -*-
+from __future__ import division, print_function, absolute_import
+import os
+import os.path as osp
+import json
+import time
+import hashlib
+import platform
+import threading
+import torch
+
+
+__all__ = [
+    'host_fingerprint',
+    'default_thread_counts',
+    'benchmark',
+    'autotune',
+    'TuningRecords',
+]
+
+
+_HOST_FINGERPRINT = None
+
+
+def _usable_cores():
+    """Sorted ids of the cores this process may run on."""
+    try:
+        return sorted(os.sched_getaffinity(0))
+    except AttributeError:  # pragma: no cover
+        return list(range(os.cpu_count() or 1))
+
+
+def _cpu_model():
+    try:
+        with open('/proc/cpuinfo', 'r') as f:
+            for line in f:
+                if line.startswith('model name'):
+                    return line.split(':', 1)[1].strip()
+    except (IOError, OSError):
+        pass
+    return platform.processor() or platform.machine()
+
+
+def _memory_gb():
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') // 2 ** 30
+    except (AttributeError, ValueError, OSError):  # pragma: no cover
+        return 0
+
+
+def host_fingerprint():
+    """Identifies the hardware and software a tuned setting was measured on.
+
+    Returns:
+        str: hash of the CPU model, the number of usable cores, the physical
+        memory in GB and the torch version.
+    """
+    global _HOST_FINGERPRINT
+    if _HOST_FINGERPRINT is None:
+        text = '{}|{}|{}|{}'.format(
+            _cpu_model(), len(_usable_cores()), _memory_gb(), torch.__version__
+        )
+        _HOST_FINGERPRINT = hashlib.sha1(text.encode('utf-8')).hexdigest()[:16]
+    return _HOST_FINGERPRINT
+
+
+def default_thread_counts():
+    """Powers of two below the number of usable cores, and that number."""
+    num_cores = len(_usable_cores())
+    counts = [1]
+    while counts[-1] * 2 < num_cores:
+        counts.append(counts[-1] * 2)
+    if counts[-1] != num_cores:
+        counts.append(num_cores)
+    return counts
+
+
+def benchmark(model, images, repeats=3, warmup=1):
+    """Times forward passes of one batch.
+
+    Args:
+        model (callable): maps a batch to embeddings.
+        images (torch.Tensor): input batch.
+        repeats (int, optional): number of timed passes. Default is 3.
+        warmup (int, optional): number of untimed passes. Default is 1.
+
+    Returns:
+        float: throughput in images per second, from the median pass time.
+    """
+    times = []
+    with torch.no_grad():
+        for idx in range(warmup + repeats):
+            start = time.perf_counter()
+            model(images)
+            if idx >= warmup:
+                times.append(time.perf_counter() - start)
+    times.sort()
+    return len(images) / max(times[len(times) // 2], 1e-9)
+
+
+def autotune(model_fn, make_input, batch_sizes=None, thread_counts=None, repeats=3):
+    """Finds the batch size and torch intra-op thread count of highest throughput.
+
+    The thread counts are swept first at a middle batch size, then the batch
+    sizes at the best thread count. The batch sweep stops at the first batch
+    size that runs out of memory or drops below 90% of the best throughput.
+
+    Args:
+        model_fn (callable): returns the model to benchmark. It is called once
+            per thread count, after the thread count is set, so that runtimes
+            sizing their thread pool on creation can be rebuilt.
+        make_input (callable): returns a synthetic input batch of a given size.
+        batch_sizes (list of int, optional): increasing candidate batch sizes.
+            Default is 8 to 128.
+        thread_counts (list of int, optional): candidate intra-op thread counts.
+            Default is :func:`default_thread_counts`.
+        repeats (int, optional): timed passes per setting. Default is 3.
+
+    Returns:
+        dict: the best ``batch_size``, ``num_threads`` and its ``throughput`` in
+        images per second, and the ``results`` as a list of ``(batch size,
+        threads, throughput)``.
+
+    Example:
+        >>> import torch
+        >>> from wbia_pie_v2.inference.autotune import autotune
+        >>> model = torch.nn.Sequential(torch.nn.Conv2d(3, 8, 3), torch.nn.Flatten())
+        >>> setting = autotune(lambda: model, lambda n: torch.rand(n, 3, 32, 32),
+        >>>                    batch_sizes=[2, 4, 8], thread_counts=[1, 2], repeats=1)
+        >>> assert setting['batch_size'] in [2, 4, 8] and setting['num_threads'] in [1, 2]
+        >>> assert setting['throughput'] == max(result[2] for result in setting['results'])
+    """
+    if batch_sizes is None:
+        batch_sizes = [8, 16, 32, 64, 128]
+    if thread_counts is None:
+        thread_counts = default_thread_counts()
+
+    results = []
+    prev_num_threads = torch.get_num_threads()
+
+    def measure(batch_size, num_threads, model):
+        throughput = benchmark(model, make_input(batch_size), repeats=repeats)
+        print(
+            'Batch size {:4d}, {:3d} threads: {:8.1f} images/s'.format(
+                batch_size, num_threads, throughput
+            )
+        )
+        results.append((batch_size, num_threads, throughput))
+        return throughput
+
+    try:
+        ref_batch_size = batch_sizes[len(batch_sizes) // 2]
+        best_throughput = -1.0
+        for num_threads in thread_counts:
+            torch.set_num_threads(num_threads)
+            throughput = measure(ref_batch_size, num_threads, model_fn())
+            if throughput > best_throughput:
+                best_throughput, best_threads = throughput, num_threads
+
+        torch.set_num_threads(best_threads)
+        model = model_fn()
+        for batch_size in batch_sizes:
+            if batch_size == ref_batch_size:
+                continue
+            try:
+                throughput = measure(batch_size, best_threads, model)
+            except (RuntimeError, MemoryError) as ex:
+                print('Batch size {} failed: {}'.format(batch_size, ex))
+                break
+            if batch_size > ref_batch_size and throughput < 0.9 * best_throughput:
+                break
+    finally:
+        torch.set_num_threads(prev_num_threads)
+
+    batch_size, num_threads, throughput = max(results, key=lambda result: result[2])
+    return {
+        'batch_size': batch_size,
+        'num_threads': num_threads,
+        'throughput': throughput,
+        'results': results,
+    }
+
+
+class TuningRecords(object):
+    """JSON file of tuned settings keyed by host fingerprint and model.
+
+    The file is re-read when another process updates it and replaced
+    atomically on :meth:`put`.
+
+    Args:
+        fpath (str): path of the JSON file.
+
+    Example:
+        >>> import os.path as osp
+        >>> import tempfile
+        >>> from wbia_pie_v2.inference.autotune import TuningRecords
+        >>> fpath = osp.join(tempfile.mkdtemp(), 'settings.json')
+        >>> records = TuningRecords(fpath)
+        >>> assert records.get('host', 'model') is None
+        >>> records.put('host', 'model', {'batch_size': 32, 'num_threads': 8})
+        >>> assert TuningRecords(fpath).get('host', 'model')['batch_size'] == 32
+        >>> assert records.get('other-host', 'model') is None
+    """
+
+    def __init__(self, fpath):
+        self.fpath = fpath
+        self._records = {}
+        self._mtime = None
+        self._lock = threading.Lock()
+
+    def get(self, host, model_key):
+        """Returns the setting tuned for ``model_key`` on ``host``, or None."""
+        with self._lock:
+            self._refresh()
+            return self._records.get(host, {}).get(model_key)
+
+    def put(self, host, model_key, setting):
+        """Records the setting tuned for ``model_key`` on ``host``."""
+        with self._lock:
+            self._refresh()
+            self._records.setdefault(host, {})[model_key] = setting
+            os.makedirs(osp.dirname(self.fpath) or '.', exist_ok=True)
+            tmp_fpath = '{}.{}.tmp'.format(self.fpath, os.getpid())
+            with open(tmp_fpath, 'w') as f:
+                json.dump(self._records, f, indent=2, sort_keys=True)
+            os.replace(tmp_fpath, self.fpath)
+            self._mtime = os.stat(self.fpath).st_mtime_ns
+
+    def _refresh(self):
+        if not osp.exists(self.fpath):
+            return
+        mtime = os.stat(self.fpath).st_mtime_ns
+        if mtime != self._mtime:
+            with open(self.fpath, 'r') as f:
+                self._records = json.load(f)
+            self._mtime = mtime
@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+from __future__ import division, print_function, absolute_import
+import time
+import threading
+from collections import deque
+from concurrent.futures import Future
+import numpy as np
+
+
+__all__ = ['MicroBatcher']
+
+
+class _Request(object):
+    def __init__(self, items):
+        self.items = items
+        self.future = Future()
+        self.submitted = time.perf_counter()
+
+
+class MicroBatcher(object):
+    """Coalesces concurrent small requests into batches for one worker thread.
+
+    Callers :meth:`submit` lists of items and get a future for the results of
+    their own items. A background thread waits until the queued items fill a
+    batch of ``max_batch`` or the oldest request has waited ``max_wait``
+    seconds, then calls ``process_fn`` once on the concatenated items of as
+    many queued requests as fit, and hands every request its slice of the
+    results. A request larger than ``max_batch`` is processed on its own.
+
+    Args:
+        process_fn (callable): maps a list of items to a sequence of results of
+            the same length.
+        max_batch (int, optional): target number of items per batch.
+            Default is 100.
+        max_wait (float, optional): longest time in seconds a request waits for
+            other requests to join its batch. Default is 0.01.
+        history (int, optional): number of recent requests and batches kept for
+            the latency and throughput counters. Default is 1000.
+
+    Example:
+        >>> import threading
+        >>> from wbia_pie_v2.inference import MicroBatcher
+        >>> batch_sizes = []
+        >>> def process_fn(items):
+        >>>     batch_sizes.append(len(items))
+        >>>     return [item * 10 for item in items]
+        >>> batcher = MicroBatcher(process_fn, max_batch=8, max_wait=0.5)
+        >>> results = {}
+        >>> def call(idx):
+        >>>     results[idx] = batcher.submit([idx, idx + 100]).result()
+        >>> threads = [threading.Thread(target=call, args=(idx,)) for idx in range(4)]
+        >>> for thread in threads:
+        >>>     thread.start()
+        >>> for thread in threads:
+        >>>     thread.join()
+        >>> assert results == {idx: [idx * 10, (idx + 100) * 10] for idx in range(4)}
+        >>> assert batch_sizes == [8]
+        >>> stats = batcher.stats()
+        >>> assert stats['requests'] == 4 and stats['batches'] == 1
+        >>> batcher.close()
+    """
+
+    def __init__(self, process_fn, max_batch=100, max_wait=0.01, history=1000):
+        self.process_fn = process_fn
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self._pending = deque()
+        self._num_pending = 0
+        self._cond = threading.Condition()
+        self._closed = False
+
+        self._num_requests = 0
+        self._num_items = 0
+        self._num_batches = 0
+        self._latencies = deque(maxlen=history)
+        self._queue_waits = deque(maxlen=history)
+        self._batches = deque(maxlen=history)
+
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def submit(self, items):
+        """Queues items for the next batch.
+
+        Returns:
+            concurrent.futures.Future: resolves to the list of results of
+            ``items``, or to the exception raised by ``process_fn``.
+        """
+        request = _Request(list(items))
+        if len(request.items) == 0:
+            request.future.set_result([])
+            return request.future
+        with self._cond:
+            if self._closed:
+                raise RuntimeError('MicroBatcher is closed')
+            self._pending.append(request)
+            self._num_pending += len(request.items)
+            self._cond.notify()
+        return request.future
+
+    def close(self):
+        """Stops the worker after the queued requests are processed."""
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        self._thread.join()
+
+    def stats(self):
+        """Reports counters to tune ``max_wait``.
+
+        Returns:
+            dict: totals of requests, items and batches, the mean batch size,
+            the mean and 95th percentile request latency and queue wait in
+            seconds, and the processing throughput in items per second, over
+            the most recent ``history`` requests and batches.
+        """
+        with self._cond:
+            latencies = np.array(self._latencies)
+            queue_waits = np.array(self._queue_waits)
+            batches = np.array(self._batches).reshape(-1, 2)
+            stats = {
+                'requests': self._num_requests,
+                'items': self._num_items,
+                'batches': self._num_batches,
+                'pending': self._num_pending,
+            }
+        stats['mean_batch_size'] = float(batches[:, 0].mean()) if len(batches) else 0.0
+        for name, values in (('latency', latencies), ('queue_wait', queue_waits)):
+            if len(values) == 0:
+                values = np.zeros(1)
+            stats['mean_' + name] = float(values.mean())
+            stats['p95_' + name] = float(np.percentile(values, 95))
+        busy = batches[:, 1].sum()
+        stats['throughput'] = float(batches[:, 0].sum() / busy) if busy > 0 else 0.0
+        return stats
+
+    def _next_batch(self):
+        with self._cond:
+            while True:
+                if self._pending:
+                    if self._closed or self._num_pending >= self.max_batch:
+                        break
+                    deadline = self._pending[0].submitted + self.max_wait
+                    timeout = deadline - time.perf_counter()
+                    if timeout <= 0:
+                        break
+                    self._cond.wait(timeout)
+                elif self._closed:
+                    return None
+                else:
+                    self._cond.wait()
+
+            batch = [self._pending.popleft()]
+            num_items = len(batch[0].items)
+            while (
+                self._pending
+                and num_items + len(self._pending[0].items) <= self.max_batch
+            ):
+                request = self._pending.popleft()
+                batch.append(request)
+                num_items += len(request.items)
+            self._num_pending -= num_items
+            return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+
+            start = time.perf_counter()
+            items = [item for request in batch for item in request.items]
+            try:
+                results = self.process_fn(items)
+                error = None
+            except Exception as ex:
+                error = ex
+            end = time.perf_counter()
+
+            offset = 0
+            for request in batch:
+                if error is not None:
+                    request.future.set_exception(error)
+                else:
+                    num_items = len(request.items)
+                    request.future.set_result(
+                        list(results[offset : offset + num_items])
+                    )
+                    offset += num_items
+
+            with self._cond:
+                self._num_requests += len(batch)
+                self._num_items += len(items)
+                self._num_batches += 1
+                self._batches.append((len(items), end - start))
+                for request in batch:
+                    self._latencies.append(end - request.submitted)
+                    self._queue_waits.append(start - request.submitted)
@@ -0,0 +1,209 @@
+# -*- coding: utf-8 -*-
+from __future__ import division, print_function, absolute_import
+import threading
+from collections import OrderedDict
+import numpy as np
+
+
+__all__ = ['EmbeddingCache']
+
+
+class _Slab(object):
+    """Contiguous storage for the embeddings of one fingerprint."""
+
+    min_capacity = 64
+
+    def __init__(self, dim, dtype):
+        self.dim = dim
+        self.data = np.empty((self.min_capacity, dim), dtype=dtype)
+        self.rows = {}
+        self.free = list(range(self.min_capacity - 1, -1, -1))
+
+    def __len__(self):
+        return len(self.rows)
+
+    @property
+    def capacity(self):
+        return self.data.shape[0]
+
+    def add(self, aid, embedding):
+        row = self.rows.get(aid)
+        if row is None:
+            if not self.free:
+                self._resize(2 * self.capacity)
+            row = self.free.pop()
+            self.rows[aid] = row
+        self.data[row] = embedding
+
+    def remove(self, aid):
+        self.free.append(self.rows.pop(aid))
+
+    def shrink(self):
+        """Compacts the slab once it is less than a quarter full."""
+        capacity = self.capacity
+        while capacity > self.min_capacity and len(self.rows) < capacity // 4:
+            capacity //= 2
+        if capacity < self.capacity:
+            self._resize(capacity)
+
+    def _resize(self, capacity):
+        aids = list(self.rows.keys())
+        old_rows = [self.rows[aid] for aid in aids]
+        data = np.empty((capacity, self.dim), dtype=self.data.dtype)
+        data[: len(aids)] = self.data[old_rows]
+        self.data = data
+        self.rows = dict(zip(aids, range(len(aids))))
+        self.free = list(range(capacity - 1, len(aids) - 1, -1))
+
+
+class EmbeddingCache(object):
+    """In-memory cache of embeddings keyed by ``(aid, fingerprint)``.
+
+    The fingerprint identifies the config and model that produced an
+    embedding, so embeddings of the same annotation from different models
+    never collide. Embeddings of one fingerprint are packed into a single
+    contiguous slab instead of one array object per annotation. Once the
+    stored embeddings exceed ``max_bytes`` the least recently used ones are
+    evicted. All methods are thread safe.
+
+    Args:
+        max_bytes (int or None, optional): memory budget. Default is None
+            (unbounded).
+        dtype (str or np.dtype, optional): storage dtype, ``float32`` or
+            ``float16``. Embeddings are always returned as ``float32``.
+            Default is ``float32``.
+
+    Example:
+        >>> import numpy as np
+        >>> from wbia_pie_v2.inference import EmbeddingCache
+        >>> cache = EmbeddingCache(max_bytes=3 * 4 * 4)
+        >>> cache.put([1, 2], 'model-a', np.ones((2, 4)))
+        >>> cache.put([1], 'model-b', np.zeros((1, 4)))
+        >>> found, missing = cache.lookup([1, 2, 3], 'model-a')
+        >>> assert sorted(found.keys()) == [1, 2] and missing == [3]
+        >>> assert found[1].sum() == 4
+        >>> cache.put([3], 'model-a', np.ones((1, 4)))
+        >>> found, missing = cache.lookup([1], 'model-b')
+        >>> assert missing == [1]
+        >>> stats = cache.stats()
+        >>> assert (stats['hits'], stats['misses'], stats['evictions']) == (2, 2, 1)
+    """
+
+    def __init__(self, max_bytes=None, dtype=np.float32):
+        self.max_bytes = max_bytes
+        self.dtype = np.dtype(dtype)
+        self._slabs = {}
+        self._lru = OrderedDict()
+        self._nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._lru)
+
+    def __contains__(self, key):
+        return key in self._lru
+
+    def lookup(self, aid_list, fingerprint):
+        """Fetches the cached embeddings of ``aid_list``.
+
+        Args:
+            aid_list (list of int): annot ids.
+            fingerprint (str): config/model fingerprint.
+
+        Returns:
+            tuple: dict of aid to ``float32`` embedding for the hits, and the
+            list of missing aids in input order.
+        """
+        found = {}
+        missing = []
+        with self._lock:
+            slab = self._slabs.get(fingerprint)
+            for aid in aid_list:
+                row = None if slab is None else slab.rows.get(aid)
+                if row is None:
+                    missing.append(aid)
+                    continue
+                found[aid] = slab.data[row].astype(np.float32)
+                self._lru.move_to_end((fingerprint, aid))
+            self.hits += len(found)
+            self.misses += len(missing)
+        return found, missing
+
+    def put(self, aid_list, fingerprint, embeddings):
+        """Stores embeddings, evicting old entries if over budget.
+
+        Args:
+            aid_list (list of int): annot ids.
+            fingerprint (str): config/model fingerprint.
+            embeddings (array-like): embeddings of shape (len(aid_list), dim).
+        """
+        if len(aid_list) == 0:
+            return
+        embeddings = np.asarray(embeddings).reshape(len(aid_list), -1)
+        with self._lock:
+            self._put(aid_list, fingerprint, embeddings)
+
+    def _put(self, aid_list, fingerprint, embeddings):
+        slab = self._slabs.get(fingerprint)
+        if slab is None:
+            slab = _Slab(embeddings.shape[1], self.dtype)
+            self._slabs[fingerprint] = slab
+        elif slab.dim != embeddings.shape[1]:
+            raise ValueError(
+                'Embedding size {} does not match size {} cached for {}'.format(
+                    embeddings.shape[1], slab.dim, fingerprint
+                )
+            )
+        row_nbytes = slab.dim * self.dtype.itemsize
+        for aid, embedding in zip(aid_list, embeddings):
+            key = (fingerprint, aid)
+            if key not in self._lru:
+                self._nbytes += row_nbytes
+            slab.add(aid, embedding)
+            self._lru[key] = None
+            self._lru.move_to_end(key)
+        self._evict()
+
+    def clear(self):
+        with self._lock:
+            self._slabs.clear()
+            self._lru.clear()
+            self._nbytes = 0
+
+    @property
+    def nbytes(self):
+        """Bytes used by the stored embeddings."""
+        return self._nbytes
+
+    def stats(self):
+        """Returns hit/miss/eviction counters and current usage."""
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'entries': len(self._lru),
+                'nbytes': self._nbytes,
+                'allocated': sum(slab.data.nbytes for slab in self._slabs.values()),
+            }
+
+    def _evict(self):
+        if self.max_bytes is None or self._nbytes <= self.max_bytes:
+            return
+        touched = set()
+        while self._nbytes > self.max_bytes and self._lru:
+            (fingerprint, aid), _ = self._lru.popitem(last=False)
+            slab = self._slabs[fingerprint]
+            slab.remove(aid)
+            self._nbytes -= slab.dim * self.dtype.itemsize
+            self.evictions += 1
+            touched.add(fingerprint)
+        for fingerprint in touched:
+            slab = self._slabs[fingerprint]
+            if len(slab) == 0:
+                del self._slabs[fingerprint]
+            else:
+                slab.shrink()
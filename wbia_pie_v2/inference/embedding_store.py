@@ -0,0 +1,223 @@
+# -*- coding: utf-8 -*-
+from __future__ import division, print_function, absolute_import
+import os
+import os.path as osp
+import json
+import contextlib
+import threading
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    fcntl = None
+
+
+__all__ = ['EmbeddingStore']
+
+
+INDEX_DTYPE = np.dtype([('aid', np.int64), ('row', np.int64), ('uuid', 'S16')])
+
+
+class EmbeddingStore(object):
+    """Append-only on-disk embedding matrix for one species model.
+
+    The store directory holds three files:
+
+        - ``embeddings.f32``: raw float32 matrix, one row per stored embedding
+          (``embeddings.f16`` for float16 stores). It is only ever appended to
+          and is read through a memory map.
+        - ``index.npy``: (aid, row, uuid) records sorted by aid.
+        - ``meta.json``: the embedding size and dtype.
+
+    Looking up many aids is a single ``searchsorted`` into the index followed
+    by one fancy-index into the memory map, so opening a gallery of any size
+    costs milliseconds. Re-adding an aid appends a new row and repoints the
+    index; the old row is left in place as garbage.
+
+    An optional 16-byte uuid (e.g. the annotation visual uuid) is stored with
+    every row. Lookups that pass uuids treat rows with a different uuid as
+    missing, so edited annotations are recomputed.
+
+    Appends are serialized between processes by a file lock and between
+    threads by an in-process lock, so one store can be shared by the threads
+    of a server.
+
+    The storage dtype is taken from the first appended embeddings: float16
+    embeddings are stored in half the space, anything else as float32. Lookups
+    always return float32.
+
+    Args:
+        dpath (str): store directory, created if missing.
+
+    Example:
+        >>> import numpy as np
+        >>> import tempfile
+        >>> from wbia_pie_v2.inference import EmbeddingStore
+        >>> store = EmbeddingStore(tempfile.mkdtemp())
+        >>> store.append([5, 3], np.arange(8).reshape(2, 4))
+        >>> embs, found = store.get([3, 4, 5])
+        >>> assert found.tolist() == [True, False, True]
+        >>> assert embs.tolist() == [[4, 5, 6, 7], [0, 1, 2, 3]]
+        >>> store.append([3], np.zeros((1, 4)))
+        >>> reopened = EmbeddingStore(store.dpath)
+        >>> embs, found = reopened.get([3])
+        >>> assert embs.sum() == 0 and len(reopened) == 2
+        >>> half = EmbeddingStore(tempfile.mkdtemp())
+        >>> half.append([1], np.full((1, 4), 0.1, dtype=np.float16))
+        >>> embs, found = EmbeddingStore(half.dpath).get([1])
+        >>> assert embs.dtype == np.float32 and abs(embs[0, 0] - 0.1) < 1e-3
+    """
+
+    def __init__(self, dpath):
+        self.dpath = dpath
+        os.makedirs(dpath, exist_ok=True)
+        self.index_fpath = osp.join(dpath, 'index.npy')
+        self.meta_fpath = osp.join(dpath, 'meta.json')
+        self.lock_fpath = osp.join(dpath, 'lock')
+        self.dim = None
+        self.dtype = None
+        self._index = np.zeros(0, dtype=INDEX_DTYPE)
+        self._index_mtime = None
+        self._data = None
+        self._mutex = threading.RLock()
+        self.refresh()
+
+    def __len__(self):
+        return len(self._index)
+
+    def refresh(self):
+        """Reloads the index if another process appended to the store."""
+        with self._mutex:
+            if not osp.exists(self.index_fpath):
+                return
+            mtime = os.stat(self.index_fpath).st_mtime_ns
+            if mtime == self._index_mtime:
+                return
+            with open(self.meta_fpath, 'r') as f:
+                meta = json.load(f)
+            self.dim = meta['dim']
+            self.dtype = np.dtype(meta.get('dtype', 'float32'))
+            self._index = np.load(self.index_fpath)
+            self._index_mtime = mtime
+            self._open_data()
+
+    def get(self, aid_list, uuid_list=None):
+        """Reads the stored embeddings of ``aid_list``.
+
+        Args:
+            aid_list (list of int): annot ids.
+            uuid_list (list of UUID, optional): expected uuid of each aid.
+
+        Returns:
+            tuple: float32 array of shape (num_found, dim) holding the
+            embeddings of the found aids in input order, and a boolean mask
+            over ``aid_list`` marking which aids were found.
+        """
+        with self._mutex:
+            self.refresh()
+            index, data, dim = self._index, self._data, self.dim
+        aids = np.asarray(aid_list, dtype=np.int64)
+        if len(index) == 0 or len(aids) == 0:
+            dim = 0 if dim is None else dim
+            return np.zeros((0, dim), dtype=np.float32), np.zeros(len(aids), dtype=bool)
+
+        pos = np.searchsorted(index['aid'], aids)
+        pos = np.minimum(pos, len(index) - 1)
+        found = index['aid'][pos] == aids
+        if uuid_list is not None:
+            found &= index['uuid'][pos] == _uuid_bytes(uuid_list)
+        rows = index['row'][pos[found]]
+        embeddings = np.asarray(data[rows], dtype=np.float32)
+        return embeddings, found
+
+    def append(self, aid_list, embeddings, uuid_list=None):
+        """Appends embeddings and points the index of their aids at them.
+
+        Args:
+            aid_list (list of int): annot ids.
+            embeddings (array-like): embeddings of shape (len(aid_list), dim).
+            uuid_list (list of UUID, optional): uuid of each aid.
+        """
+        if len(aid_list) == 0:
+            return
+        embeddings = np.asarray(embeddings)
+        embeddings = embeddings.reshape(len(aid_list), -1)
+        aids = np.asarray(aid_list, dtype=np.int64)
+        # Keep the last occurrence of a repeated aid
+        aids, last = np.unique(aids[::-1], return_index=True)
+        last = len(aid_list) - 1 - last
+        embeddings = embeddings[last]
+
+        with self._mutex, self._lock():
+            self.refresh()
+            if self.dim is None:
+                self.dim = embeddings.shape[1]
+                self.dtype = np.dtype(
+                    np.float16 if embeddings.dtype == np.float16 else np.float32
+                )
+                with open(self.meta_fpath, 'w') as f:
+                    json.dump({'dim': self.dim, 'dtype': self.dtype.name}, f)
+            elif self.dim != embeddings.shape[1]:
+                raise ValueError(
+                    'Embedding size {} does not match store size {}'.format(
+                        embeddings.shape[1], self.dim
+                    )
+                )
+
+            embeddings = np.ascontiguousarray(embeddings, dtype=self.dtype)
+            with open(self.data_fpath, 'ab') as f:
+                start = f.tell() // self._row_nbytes
+                f.write(embeddings.tobytes())
+
+            records = np.zeros(len(aids), dtype=INDEX_DTYPE)
+            records['aid'] = aids
+            records['row'] = np.arange(start, start + len(aids))
+            if uuid_list is not None:
+                records['uuid'] = _uuid_bytes(uuid_list)[last]
+
+            keep = ~np.isin(self._index['aid'], aids)
+            index = np.concatenate([self._index[keep], records])
+            index = index[np.argsort(index['aid'], kind='stable')]
+
+            tmp_fpath = self.index_fpath + '.tmp.npy'
+            np.save(tmp_fpath, index)
+            os.replace(tmp_fpath, self.index_fpath)
+            self._index = index
+            self._index_mtime = os.stat(self.index_fpath).st_mtime_ns
+            self._open_data()
+
+    @property
+    def data_fpath(self):
+        ext = 'f16' if self.dtype == np.float16 else 'f32'
+        return osp.join(self.dpath, 'embeddings.{}'.format(ext))
+
+    @property
+    def _row_nbytes(self):
+        return self.dim * self.dtype.itemsize
+
+    def _open_data(self):
+        num_rows = 0
+        if osp.exists(self.data_fpath):
+            num_rows = os.path.getsize(self.data_fpath) // self._row_nbytes
+        if num_rows == 0:
+            self._data = np.zeros((0, self.dim), dtype=self.dtype)
+        else:
+            self._data = np.memmap(
+                self.data_fpath, dtype=self.dtype, mode='r', shape=(num_rows, self.dim)
+            )
+
+    @contextlib.contextmanager
+    def _lock(self):
+        with open(self.lock_fpath, 'a') as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def _uuid_bytes(uuid_list):
+    return np.array([uuid.bytes for uuid in uuid_list], dtype='S16')
@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+from __future__ import division, print_function, absolute_import
+import os
+import os.path as osp
+import inspect
+import torch
+
+from .torchscript import set_exportable_swish
+
+
+__all__ = ['export_onnx', 'OnnxEmbedder']
+
+
+def export_onnx(model, fpath, example, opset_version=17):
+    """Exports an eval-mode model to ONNX with a dynamic batch axis.
+
+    Args:
+        model (nn.Module): eval-mode model.
+        fpath (str): output path.
+        example (torch.Tensor): example input batch. Its dtype and spatial size
+            are fixed in the exported graph, the batch size is not.
+        opset_version (int, optional): ONNX opset. Default is 17.
+    """
+    model = set_exportable_swish(model.eval())
+
+    kwargs = {}
+    # torch >= 2.5 may default to the dynamo exporter, older torch lacks the flag
+    if 'dynamo' in inspect.signature(torch.onnx.export).parameters:
+        kwargs['dynamo'] = False
+
+    os.makedirs(osp.dirname(fpath) or '.', exist_ok=True)
+    tmp_fpath = '{}.{}.tmp'.format(fpath, os.getpid())
+    with torch.no_grad():
+        torch.onnx.export(
+            model,
+            (example,),
+            tmp_fpath,
+            input_names=['images'],
+            output_names=['embeddings'],
+            dynamic_axes={'images': {0: 'batch'}, 'embeddings': {0: 'batch'}},
+            opset_version=opset_version,
+            **kwargs
+        )
+    os.replace(tmp_fpath, fpath)
+    print('Exported ONNX model to "{}"'.format(fpath))
+
+
+class OnnxEmbedder(object):
+    """Runs an exported embedding model with the onnxruntime CPU provider.
+
+    Instances are called like the eager model: on a batch tensor, returning a
+    tensor of embeddings. Every graph optimization is enabled and the
+    intra-op thread pool is sized to ``num_threads``. Idle pool threads do not
+    spin, so they leave the cores to the data loading workers between batches.
+
+    Args:
+        fpath (str): path of the exported model.
+        num_threads (int, optional): intra-op threads. Default is the number of
+            torch threads.
+
+    Example:
+        >>> import os.path as osp
+        >>> import tempfile
+        >>> import torch
+        >>> from wbia_pie_v2.models import build_model
+        >>> from wbia_pie_v2.inference.onnx_backend import export_onnx, OnnxEmbedder
+        >>> model = build_model('resnet50_fc512', 10, pretrained=False).eval()
+        >>> fpath = osp.join(tempfile.mkdtemp(), 'model.onnx')
+        >>> export_onnx(model, fpath, torch.rand(2, 3, 64, 64))
+        >>> embedder = OnnxEmbedder(fpath, num_threads=2)
+        >>> images = torch.rand(5, 3, 64, 64)
+        >>> with torch.no_grad():
+        >>>     expected = model(images)
+        >>> assert torch.allclose(embedder(images), expected, atol=1e-4)
+    """
+
+    def __init__(self, fpath, num_threads=None):
+        try:
+            import onnxruntime
+        except ImportError:
+            raise ImportError(
+                'The onnx backend requires onnxruntime, install it with '
+                '"pip install onnxruntime"'
+            )
+
+        if num_threads is None:
+            num_threads = torch.get_num_threads()
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = (
+            onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        )
+        options.execution_mode = onnxruntime.ExecutionMode.ORT_SEQUENTIAL
+        options.intra_op_num_threads = num_threads
+        options.inter_op_num_threads = 1
+        options.add_session_config_entry('session.intra_op.allow_spinning', '0')
+
+        self.fpath = fpath
+        self.num_threads = num_threads
+        self.nbytes = os.path.getsize(fpath)
+        self.session = onnxruntime.InferenceSession(
+            fpath, options, providers=['CPUExecutionProvider']
+        )
+        self.input_name = self.session.get_inputs()[0].name
+
+    def __call__(self, images):
+        images = images.cpu().numpy()
+        (embeddings,) = self.session.run(None, {self.input_name: images})
+        return torch.from_numpy(embeddings)
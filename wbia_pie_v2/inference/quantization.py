@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+from __future__ import division, print_function, absolute_import
+import os
+import os.path as osp
+import copy
+import warnings
+import torch
+import torch.nn as nn
+
+
+__all__ = [
+    'supports_static_quantization',
+    'quantize_dynamic_fc',
+    'quantize_static',
+    'quantize_model',
+    'save_quantized',
+    'passes_accuracy_gate',
+]
+
+
+# Architectures whose convolutions gain from static int8 quantization. The
+# swish activations of EfficientNet stay in float, so quantizing its
+# convolutions only adds quantize/dequantize overhead.
+STATIC_PTQ_PREFIXES = ('resnet', 'resnext')
+
+
+def supports_static_quantization(model_name):
+    """Returns True if static post-training quantization is used for a model."""
+    return model_name.startswith(STATIC_PTQ_PREFIXES)
+
+
+def quantize_dynamic_fc(model):
+    """Quantizes the fully connected layers of a model to int8 weights.
+
+    Activations are quantized on the fly, so no calibration is needed.
+
+    Args:
+        model (nn.Module): eval-mode model.
+
+    Returns:
+        nn.Module
+    """
+    return torch.ao.quantization.quantize_dynamic(
+        copy.deepcopy(model).eval(), {nn.Linear}, dtype=torch.qint8
+    )
+
+
+def quantize_static(model, calibration_batches, qengine='x86'):
+    """Applies static post-training int8 quantization to a model.
+
+    The model is traced with torch.fx, observers record the activation ranges
+    over the calibration batches, and convolutions, linear layers and
+    activations are then converted to int8 kernels with BatchNorm folded in.
+
+    Args:
+        model (nn.Module): eval-mode model.
+        calibration_batches (iterable): input batches representative of the
+            inference data.
+        qengine (str, optional): quantized kernel backend. Default is 'x86'.
+
+    Returns:
+        nn.Module
+    """
+    from torch.ao.quantization import get_default_qconfig_mapping
+    from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+
+    calibration_batches = iter(calibration_batches)
+    example = next(calibration_batches)
+    torch.backends.quantized.engine = qengine
+    prepared = prepare_fx(
+        copy.deepcopy(model).eval(), get_default_qconfig_mapping(qengine), (example,)
+    )
+    with torch.no_grad():
+        prepared(example)
+        for images in calibration_batches:
+            prepared(images)
+    return convert_fx(prepared)
+
+
+def quantize_model(model, model_name, calibration_batches):
+    """Quantizes a model with static PTQ when supported, and the ``fc`` head only
+    otherwise or if static quantization fails.
+
+    Args:
+        model (nn.Module): eval-mode model.
+        model_name (str): architecture name, e.g. ``cfg.model.name``.
+        calibration_batches (iterable): input batches used by static PTQ.
+
+    Returns:
+        tuple: the quantized model and the scheme used, 'static' or 'dynamic'.
+
+    Example:
+        >>> import torch
+        >>> from wbia_pie_v2.models import build_model
+        >>> from wbia_pie_v2.inference.quantization import quantize_model
+        >>> model = build_model('resnet50_fc512', 10, pretrained=False).eval()
+        >>> batches = [torch.rand(4, 3, 64, 64) for _ in range(2)]
+        >>> qmodel, scheme = quantize_model(model, 'resnet50_fc512', batches)
+        >>> with torch.no_grad():
+        >>>     similarity = torch.cosine_similarity(model(batches[0]), qmodel(batches[0]))
+        >>> assert scheme == 'static' and similarity.min() > 0.99
+    """
+    if supports_static_quantization(model_name):
+        try:
+            return quantize_static(model, calibration_batches), 'static'
+        except Exception as ex:
+            warnings.warn(
+                'Static quantization of {} failed ({}), quantizing fc only'.format(
+                    model_name, ex
+                )
+            )
+    return quantize_dynamic_fc(model), 'dynamic'
+
+
+def save_quantized(model, example, fpath):
+    """Traces a quantized model and saves it as TorchScript.
+
+    The saved artifact loads with ``torch.jit.load`` without rebuilding or
+    recalibrating the model.
+
+    Args:
+        model (nn.Module): quantized model.
+        example (torch.Tensor): example input batch.
+        fpath (str): output path.
+    """
+    with torch.no_grad():
+        traced = torch.jit.freeze(torch.jit.trace(model.eval(), example))
+    os.makedirs(osp.dirname(fpath), exist_ok=True)
+    tmp_fpath = '{}.{}.tmp'.format(fpath, os.getpid())
+    torch.jit.save(traced, tmp_fpath)
+    os.replace(tmp_fpath, fpath)
+    print('Saved quantized model to "{}"'.format(fpath))
+
+
+def passes_accuracy_gate(rank1, rank1_quantized, max_rank1_drop=0.01):
+    """Returns True if the quantized rank-1 accuracy is within
+    ``max_rank1_drop`` of the float accuracy.
+
+    Example:
+        >>> from wbia_pie_v2.inference.quantization import passes_accuracy_gate
+        >>> assert passes_accuracy_gate(0.80, 0.795)
+        >>> assert not passes_accuracy_gate(0.80, 0.75)
+    """
+    return rank1 - rank1_quantized <= max_rank1_drop
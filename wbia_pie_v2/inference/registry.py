@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+from __future__ import division, print_function, absolute_import
+import threading
+from collections import OrderedDict
+
+
+__all__ = ['ModelRegistry', 'model_nbytes']
+
+
+KEY_FIELDS = ('config_url', 'model_url', 'device', 'backend')
+
+
+def model_nbytes(model):
+    """Returns the number of bytes held by the parameters and buffers of a model.
+
+    Args:
+        model (nn.Module): network model.
+
+    Frozen TorchScript modules hold their weights as graph constants rather
+    than parameters, so those constants are counted instead.
+
+    Returns:
+        int
+    """
+    if not hasattr(model, 'parameters'):
+        # Models run outside of torch report their own size
+        return getattr(model, 'nbytes', 0)
+
+    nbytes = 0
+    for tensor in model.parameters():
+        nbytes += tensor.numel() * tensor.element_size()
+    for tensor in model.buffers():
+        nbytes += tensor.numel() * tensor.element_size()
+    if nbytes == 0 and hasattr(model, 'code_with_constants'):
+        constants = model.code_with_constants[1].const_mapping.values()
+        for tensor in constants:
+            if hasattr(tensor, 'element_size'):
+                nbytes += tensor.numel() * tensor.element_size()
+    return nbytes
+
+
+class ModelRegistry(object):
+    """Process-wide cache of loaded, eval-mode models.
+
+    Models are keyed by ``(config_url, model_url, device, backend)``. When the
+    combined size of the cached models exceeds ``max_bytes`` the least recently
+    used models are dropped. The most recently loaded model is never evicted, so a
+    single model larger than the budget is still usable.
+
+    Concurrent requests for the same key build the model only once; requests
+    for different keys do not block each other while loading.
+
+    Args:
+        max_bytes (int or None, optional): memory budget for all cached models.
+            Default is None (unbounded).
+
+    Example:
+        >>> import torch.nn as nn
+        >>> from wbia_pie_v2.inference import ModelRegistry
+        >>> registry = ModelRegistry(max_bytes=5000)
+        >>> model = registry.get(('a.yaml', 'a.pth', 'cpu'), lambda: nn.Linear(20, 20))
+        >>> assert registry.get(('a.yaml', 'a.pth', 'cpu'), lambda: None) is model
+        >>> _ = registry.get(('b.yaml', 'b.pth', 'cpu'), lambda: nn.Linear(40, 40))
+        >>> assert [info['config_url'] for info in registry.loaded()] == ['b.yaml']
+        >>> assert registry.unload() == 1
+    """
+
+    def __init__(self, max_bytes=None):
+        self.max_bytes = max_bytes
+        self._models = OrderedDict()
+        self._lock = threading.Lock()
+        self._key_locks = {}
+
+    def __len__(self):
+        return len(self._models)
+
+    def __contains__(self, key):
+        return key in self._models
+
+    def get(self, key, loader):
+        """Returns the model for ``key``, calling ``loader()`` to build it on a miss.
+
+        Args:
+            key (tuple): ``(config_url, model_url, device, backend)``.
+            loader (callable): builds and returns the eval-mode model.
+
+        Returns:
+            nn.Module
+        """
+        model = self._lookup(key)
+        if model is not None:
+            return model
+
+        with self._lock:
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+
+        with key_lock:
+            # Another thread may have finished loading while we waited
+            model = self._lookup(key)
+            if model is not None:
+                return model
+
+            model = loader()
+            nbytes = model_nbytes(model)
+            with self._lock:
+                self._models[key] = (model, nbytes)
+                self._evict(keep=key)
+                self._key_locks.pop(key, None)
+        return model
+
+    def unload(self, key=None):
+        """Drops one model, or every model if ``key`` is None.
+
+        Returns:
+            int: number of models removed.
+        """
+        with self._lock:
+            if key is None:
+                num_removed = len(self._models)
+                self._models.clear()
+            else:
+                num_removed = int(self._models.pop(key, None) is not None)
+        return num_removed
+
+    def loaded(self):
+        """Lists the cached models, least recently used first.
+
+        Returns:
+            list of dict: with the key fields ``config_url``, ``model_url``,
+            ``device`` and, if given, ``backend``, and ``nbytes``.
+        """
+        with self._lock:
+            items = list(self._models.items())
+        return [
+            dict(zip(KEY_FIELDS, key), nbytes=nbytes) for key, (model, nbytes) in items
+        ]
+
+    @property
+    def nbytes(self):
+        with self._lock:
+            return sum(nbytes for model, nbytes in self._models.values())
+
+    def _lookup(self, key):
+        with self._lock:
+            entry = self._models.get(key)
+            if entry is None:
+                return None
+            self._models.move_to_end(key)
+            return entry[0]
+
+    def _evict(self, keep):
+        if self.max_bytes is None:
+            return
+        total = sum(nbytes for model, nbytes in self._models.values())
+        for key in list(self._models.keys()):
+            if total <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            model, nbytes = self._models.pop(key)
+            total -= nbytes
+            print('Evicted model {} ({:.1f} MB)'.format(key[1], nbytes / 2 ** 20))
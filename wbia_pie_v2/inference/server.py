@@ -0,0 +1,232 @@
+# -*- coding: utf-8 -*-
+from __future__ import division, print_function, absolute_import
+import os
+import threading
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Client, Listener
+
+
+__all__ = ['EmbeddingServer', 'EmbeddingClient', 'read_authkey']
+
+
+def read_authkey():
+    """Reads the shared secret of the embedding server and its clients.
+
+    The secret is the value of the WBIA_PIE_V2_EMBEDDING_AUTHKEY environment
+    variable, or else the content of the file named by
+    WBIA_PIE_V2_EMBEDDING_AUTHKEY_FILE.
+
+    Returns:
+        bytes: the secret, or None if neither is set.
+    """
+    authkey = os.environ.get('WBIA_PIE_V2_EMBEDDING_AUTHKEY')
+    if authkey:
+        return authkey.encode('utf-8')
+    fpath = os.environ.get('WBIA_PIE_V2_EMBEDDING_AUTHKEY_FILE')
+    if fpath:
+        with open(fpath, 'rb') as f:
+            return f.read().strip() or None
+    return None
+
+
+def _check_authkey(authkey):
+    if not authkey:
+        raise ValueError(
+            'The embedding server requires a shared secret, set '
+            'WBIA_PIE_V2_EMBEDDING_AUTHKEY or WBIA_PIE_V2_EMBEDDING_AUTHKEY_FILE'
+        )
+    return authkey
+
+
+class EmbeddingServer(object):
+    """Serves embedding requests from other processes over a Unix domain socket.
+
+    One server process holds the models, and every wbia process on the node
+    sends it the annotations to embed. A request is a dict of equal-length
+    columns: ``image_path``, ``bbox``, ``viewpoint`` and ``species``, plus an
+    optional config url. The reply holds one embedding per annotation. Each
+    client connection is served by its own thread, and ``embed_fn`` calls are
+    serialized, since a forward pass already uses every core.
+
+    Requests are unpickled, so clients must authenticate with a shared
+    secret, see :func:`read_authkey`.
+
+    The server can run in a thread of the current process (:meth:`start`),
+    which is how it is tested, or as a standalone process::
+
+        WBIA_PIE_V2_EMBEDDING_AUTHKEY_FILE=~/.pie_v2_authkey \\
+            python -m wbia_pie_v2.inference.server --address /tmp/pie_v2.sock
+
+    Args:
+        address (str): path of the Unix domain socket.
+        embed_fn (callable): ``embed_fn(annots, config)`` returns the embeddings
+            of the ``annots`` columns, e.g.
+            :func:`wbia_pie_v2._plugin.embed_annotations`.
+        authkey (bytes): shared secret required from clients.
+
+    Example:
+        >>> import os.path as osp
+        >>> import tempfile
+        >>> import numpy as np
+        >>> from wbia_pie_v2.inference import EmbeddingServer, EmbeddingClient
+        >>> def embed_fn(annots, config):
+        >>>     return np.array([[bbox[2], bbox[3]] for bbox in annots['bbox']], dtype=np.float32)
+        >>> address = osp.join(tempfile.mkdtemp(), 'pie_v2.sock')
+        >>> server = EmbeddingServer(address, embed_fn, authkey=b'secret').start()
+        >>> # Clients failing the handshake are refused, and the server goes on
+        >>> try:
+        >>>     EmbeddingClient(address, authkey=b'wrong').embed({})
+        >>> except Exception as ex:
+        >>>     assert type(ex).__name__ == 'AuthenticationError'
+        >>> client = EmbeddingClient(address, authkey=b'secret')
+        >>> annots = {'image_path': ['a.jpg', 'b.jpg'], 'bbox': [(0, 0, 4, 3), (0, 0, 8, 6)],
+        >>>           'viewpoint': ['left', 'right'], 'species': ['whale_grey'] * 2}
+        >>> assert client.embed(annots).tolist() == [[4, 3], [8, 6]]
+        >>> del annots['bbox']
+        >>> try:
+        >>>     client.embed(annots)
+        >>> except RuntimeError as ex:
+        >>>     assert 'KeyError' in str(ex)
+        >>> client.close()
+        >>> server.close()
+        >>> assert not osp.exists(address)
+    """
+
+    def __init__(self, address, embed_fn, authkey):
+        authkey = _check_authkey(authkey)
+        self.address = address
+        self.embed_fn = embed_fn
+        if os.path.exists(address):
+            # Left behind by a server that did not shut down cleanly
+            os.remove(address)
+        self._listener = Listener(address, family='AF_UNIX', authkey=authkey)
+        self._lock = threading.Lock()
+        self._closed = False
+
+    def start(self):
+        """Serves in a daemon thread of the current process."""
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return self
+
+    def serve_forever(self):
+        """Accepts client connections until :meth:`close` is called."""
+        while not self._closed:
+            try:
+                conn = self._listener.accept()
+            except (OSError, EOFError, AuthenticationError):
+                if self._closed:
+                    break
+                continue
+            thread = threading.Thread(target=self._serve, args=(conn,), daemon=True)
+            thread.start()
+
+    def close(self):
+        self._closed = True
+        self._listener.close()
+        if os.path.exists(self.address):
+            os.remove(self.address)
+
+    def _serve(self, conn):
+        with conn:
+            while True:
+                try:
+                    request = conn.recv()
+                except (OSError, EOFError):
+                    break
+                try:
+                    with self._lock:
+                        embeddings = self.embed_fn(
+                            request['annots'], request.get('config')
+                        )
+                    reply = {'embeddings': embeddings}
+                except Exception as ex:
+                    reply = {'error': '{}: {}'.format(type(ex).__name__, ex)}
+                conn.send(reply)
+
+
+class EmbeddingClient(object):
+    """Sends embedding requests to an :class:`EmbeddingServer`.
+
+    The connection is opened on first use and reopened once if the server
+    restarted in between. Calls from several threads are serialized on the
+    single connection.
+
+    Args:
+        address (str): path of the server's Unix domain socket.
+        authkey (bytes): shared secret of the server.
+    """
+
+    def __init__(self, address, authkey):
+        self.address = address
+        self.authkey = _check_authkey(authkey)
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def embed(self, annots, config=None):
+        """Returns the embeddings of the ``annots`` columns.
+
+        Raises:
+            OSError or EOFError: if the server cannot be reached.
+            RuntimeError: if the server failed to compute the embeddings.
+        """
+        request = {'annots': annots, 'config': config}
+        with self._lock:
+            for attempt in range(2):
+                try:
+                    if self._conn is None:
+                        self._conn = Client(
+                            self.address, family='AF_UNIX', authkey=self.authkey
+                        )
+                    self._conn.send(request)
+                    reply = self._conn.recv()
+                    break
+                except (OSError, EOFError):
+                    self._close()
+                    if attempt > 0:
+                        raise
+        if 'error' in reply:
+            raise RuntimeError('Embedding server failed: {}'.format(reply['error']))
+        return reply['embeddings']
+
+    def close(self):
+        with self._lock:
+            self._close()
+
+    def _close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+
+def main():  # nocover
+    import argparse
+    from wbia_pie_v2._plugin import embed_annotations
+
+    parser = argparse.ArgumentParser(description='Serve pie_v2 embeddings')
+    parser.add_argument('--address', required=True, help='Unix domain socket path')
+    parser.add_argument(
+        '--authkey-file',
+        help='file holding the shared secret of the clients, by default read '
+        'from WBIA_PIE_V2_EMBEDDING_AUTHKEY(_FILE)',
+    )
+    args = parser.parse_args()
+
+    if args.authkey_file is not None:
+        with open(args.authkey_file, 'rb') as f:
+            authkey = f.read().strip()
+    else:
+        authkey = read_authkey()
+    if not authkey:
+        parser.error('a shared secret is required, see --authkey-file')
+
+    server = EmbeddingServer(args.address, embed_annotations, authkey)
+    print('Serving embeddings on "{}"'.format(args.address))
+    try:
+        server.serve_forever()
+    finally:
+        server.close()
+
+
+if __name__ == '__main__':
+    main()
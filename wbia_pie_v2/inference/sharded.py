@@ -0,0 +1,294 @@
+# -*- coding: utf-8 -*-
+from __future__ import division, print_function, absolute_import
+import os
+import time
+import queue
+import threading
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+
+from ..utils.torchtools import bfloat16_autocast
+from .autotune import _usable_cores
+
+
+__all__ = ['split_cores', 'ShardedEmbedder', 'default_splits', 'benchmark_splits']
+
+
+def split_cores(num_procs, cores=None):
+    """Splits the usable cores into contiguous, disjoint core sets.
+
+    Args:
+        num_procs (int): number of core sets.
+        cores (list of int, optional): cores to split. Default is the cores this
+            process may run on.
+
+    Returns:
+        list of list of int: ``num_procs`` core sets, of sizes differing by at
+        most one. With fewer cores than sets, cores are shared round-robin.
+
+    Example:
+        >>> from wbia_pie_v2.inference.sharded import split_cores
+        >>> assert split_cores(3, cores=list(range(8))) == [[0, 1, 2], [3, 4, 5], [6, 7]]
+        >>> assert split_cores(3, cores=[0, 1]) == [[0], [1], [0]]
+    """
+    if cores is None:
+        cores = _usable_cores()
+    if len(cores) < num_procs:
+        return [[cores[idx % len(cores)]] for idx in range(num_procs)]
+    return [chunk.tolist() for chunk in np.array_split(np.array(cores), num_procs)]
+
+
+def _worker(model, cores, num_threads, precision, tasks, results):
+    if cores is not None and hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cores)
+    torch.set_num_threads(num_threads)
+    torch.set_num_interop_threads(1)
+    autocast = bfloat16_autocast('cpu', enabled=precision == 'bfloat16')
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        call_id, idx, images = task
+        try:
+            with torch.no_grad(), autocast:
+                output = model(images)
+            results.put((call_id, idx, output.float().numpy(), None))
+        except Exception as ex:
+            error = '{}: {}'.format(type(ex).__name__, ex)
+            results.put((call_id, idx, None, error))
+
+
+class ShardedEmbedder(object):
+    """Runs the forward passes of a CPU model in a pool of worker processes.
+
+    The model parameters are moved to shared memory and mapped by every
+    worker, so N workers cost one copy of the weights. Each worker is pinned
+    to its own core set and runs ``num_threads`` intra-op threads. Batches are
+    handed to whichever worker is free, and the embeddings are returned in
+    batch order.
+
+    Several small thread pools on disjoint cores scale better than one pool
+    spanning a large machine, whose threads synchronize at every operator.
+
+    Args:
+        model (nn.Module): eval-mode CPU model. Its parameters are moved to
+            shared memory in place.
+        num_procs (int): number of worker processes.
+        num_threads (int, optional): intra-op threads per worker. Default is
+            the size of the worker's core set.
+        pin_cores (bool, optional): pin each worker to a disjoint core set.
+            Default is True.
+        precision (str, optional): ``float32`` or ``bfloat16`` (autocast).
+            Default is ``float32``.
+
+    Example:
+        >>> import torch
+        >>> from wbia_pie_v2.inference.sharded import ShardedEmbedder
+        >>> model = torch.nn.Sequential(torch.nn.Conv2d(3, 4, 3), torch.nn.Flatten()).eval()
+        >>> batches = [torch.rand(n, 3, 8, 8) for n in (3, 1, 2, 5)]
+        >>> embedder = ShardedEmbedder(model, num_procs=2, num_threads=1)
+        >>> embeddings = embedder(batches)
+        >>> embedder.close()
+        >>> with torch.no_grad():
+        >>>     expected = [model(batch).numpy() for batch in batches]
+        >>> assert [len(emb) for emb in embeddings] == [3, 1, 2, 5]
+        >>> assert all(abs(emb - exp).max() < 1e-5 for emb, exp in zip(embeddings, expected))
+
+    Example:
+        >>> # A call whose batches fail to load leaves nothing for the next call
+        >>> import torch
+        >>> from wbia_pie_v2.inference.sharded import ShardedEmbedder
+        >>> model = torch.nn.Linear(1, 1, bias=False).eval()
+        >>> model.weight.data.fill_(1.0)
+        >>> def failing_batches():
+        >>>     yield torch.tensor([[1.0]])
+        >>>     yield torch.tensor([[2.0]])
+        >>>     raise IOError('image missing')
+        >>> embedder = ShardedEmbedder(model, num_procs=2, num_threads=1)
+        >>> try:
+        >>>     embedder(failing_batches())
+        >>> except IOError:
+        >>>     pass
+        >>> embeddings = embedder([torch.tensor([[10.0]]), torch.tensor([[20.0]])])
+        >>> embedder.close()
+        >>> assert [emb.tolist() for emb in embeddings] == [[[10.0]], [[20.0]]]
+    """
+
+    def __init__(
+        self, model, num_procs, num_threads=None, pin_cores=True, precision='float32'
+    ):
+        model = model.eval().share_memory()
+        ctx = mp.get_context('spawn')
+        self.num_procs = num_procs
+        self.num_threads = num_threads
+        self._tasks = ctx.Queue()
+        self._results = ctx.Queue()
+        self._lock = threading.Lock()
+        self._call_id = 0
+        self.core_sets = split_cores(num_procs)
+        self._workers = []
+        for cores in self.core_sets:
+            threads = len(cores) if num_threads is None else num_threads
+            worker = ctx.Process(
+                target=_worker,
+                args=(
+                    model,
+                    cores if pin_cores else None,
+                    threads,
+                    precision,
+                    self._tasks,
+                    self._results,
+                ),
+                daemon=True,
+            )
+            worker.start()
+            self._workers.append(worker)
+
+    def __call__(self, batches):
+        """Embeds batches of model inputs.
+
+        Args:
+            batches (iterable of torch.Tensor): input batches, consumed lazily
+                so that loading overlaps with the forward passes.
+
+        Returns:
+            list of np.ndarray: float32 embeddings of every batch, in order.
+
+        Raises:
+            RuntimeError: if a forward pass failed or a worker died.
+        """
+        with self._lock:
+            # Results are tagged with the call, so that results of an earlier
+            # call that failed are never taken for those of this one
+            self._call_id += 1
+            call_id = self._call_id
+            embeddings = {}
+            errors = []
+            num_sent = 0
+            max_inflight = 2 * self.num_procs
+            try:
+                for images in batches:
+                    self._tasks.put((call_id, num_sent, images))
+                    num_sent += 1
+                    while num_sent - len(embeddings) >= max_inflight:
+                        self._receive(call_id, embeddings, errors)
+                    if errors:
+                        break
+            finally:
+                # Drain every result, also when the batches raised, so that
+                # none is left for the next call
+                while len(embeddings) < num_sent:
+                    self._receive(call_id, embeddings, errors)
+        if errors:
+            raise RuntimeError('Sharded inference failed: {}'.format(errors[0]))
+        return [embeddings[idx] for idx in range(num_sent)]
+
+    def close(self):
+        """Stops the worker processes."""
+        for worker in self._workers:
+            if worker.is_alive():
+                self._tasks.put(None)
+        for worker in self._workers:
+            worker.join(timeout=10)
+            if worker.is_alive():
+                worker.terminate()
+        self._workers = []
+
+    def _receive(self, call_id, embeddings, errors):
+        while True:
+            try:
+                result_call_id, idx, output, error = self._results.get(timeout=1.0)
+            except queue.Empty:
+                if not all(worker.is_alive() for worker in self._workers):
+                    raise RuntimeError('A sharded inference worker died')
+                continue
+            if result_call_id == call_id:
+                break
+        if error is not None:
+            errors.append(error)
+        embeddings[idx] = output
+
+
+def default_splits(num_cores=None):
+    """Process/thread splits of the usable cores: 1xN, 2xN/2, ... down to 2
+    threads per process."""
+    if num_cores is None:
+        num_cores = len(_usable_cores())
+    splits = [(1, num_cores)]
+    num_procs = 2
+    while num_cores // num_procs >= 2:
+        splits.append((num_procs, num_cores // num_procs))
+        num_procs *= 2
+    return splits
+
+
+def benchmark_splits(model, batches, splits=None, precision='float32', warmup=1):
+    """Measures the throughput of process/thread splits on the same batches.
+
+    The ``1 x N`` split runs in the current process with ``N`` torch threads,
+    the others through a :class:`ShardedEmbedder` with pinned core sets.
+
+    Args:
+        model (nn.Module): eval-mode CPU model.
+        batches (list of torch.Tensor): input batches, embedded by every split.
+        splits (list of tuple, optional): ``(processes, threads per process)``.
+            Default is :func:`default_splits`.
+        precision (str, optional): ``float32`` or ``bfloat16``.
+        warmup (int, optional): untimed passes over the batches. Default is 1.
+
+    Returns:
+        list of dict: ``num_procs``, ``num_threads`` and ``throughput`` in
+        images per second of every split.
+
+    Example:
+        >>> import torch
+        >>> from wbia_pie_v2.inference.sharded import benchmark_splits
+        >>> model = torch.nn.Sequential(torch.nn.Conv2d(3, 4, 3), torch.nn.Flatten()).eval()
+        >>> batches = [torch.rand(4, 3, 16, 16) for _ in range(4)]
+        >>> results = benchmark_splits(model, batches, splits=[(1, 2), (2, 1)])
+        >>> assert [(r['num_procs'], r['num_threads']) for r in results] == [(1, 2), (2, 1)]
+        >>> assert all(r['throughput'] > 0 for r in results)
+    """
+    if splits is None:
+        splits = default_splits()
+    num_images = sum(len(images) for images in batches)
+    autocast = bfloat16_autocast('cpu', enabled=precision == 'bfloat16')
+
+    results = []
+    for num_procs, num_threads in splits:
+        if num_procs == 1:
+            prev_num_threads = torch.get_num_threads()
+            torch.set_num_threads(num_threads)
+
+            def embed(batches):
+                with torch.no_grad(), autocast:
+                    return [model(images) for images in batches]
+
+            close = None
+        else:
+            embed = ShardedEmbedder(
+                model, num_procs, num_threads=num_threads, precision=precision
+            )
+            close = embed.close
+        try:
+            for _ in range(warmup):
+                embed(batches)
+            start = time.perf_counter()
+            embed(batches)
+            duration = time.perf_counter() - start
+        finally:
+            if close is None:
+                torch.set_num_threads(prev_num_threads)
+            else:
+                close()
+        throughput = num_images / duration
+        print(
+            '{:3d} processes x {:3d} threads: {:8.1f} images/s'.format(
+                num_procs, num_threads, throughput
+            )
+        )
+        results.append(
+            {'num_procs': num_procs, 'num_threads': num_threads, 'throughput': throughput}
+        )
+    return results
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+from __future__ import division, print_function, absolute_import
+import threading
+from concurrent.futures import Future
+
+
+__all__ = ['SingleFlight']
+
+
+class SingleFlight(object):
+    """Shares in-flight computations between concurrent callers.
+
+    Work is identified by hashable keys, such as ``(aid, fingerprint)``. A
+    caller of :meth:`run` computes only the keys that no other thread is
+    computing at the moment, and waits for the others to finish the rest.
+    Keys are forgotten as soon as their computation finishes, so this only
+    deduplicates concurrent work; finished results belong in a cache.
+
+    Callers never wait while holding keys that others wait on, so concurrent
+    calls with overlapping keys cannot deadlock. If a computation raises, every
+    caller waiting on its keys gets the exception.
+
+    Example:
+        >>> import threading
+        >>> import time
+        >>> from wbia_pie_v2.inference import SingleFlight
+        >>> flight = SingleFlight()
+        >>> computed = []
+        >>> def compute_fn(keys):
+        >>>     computed.extend(keys)
+        >>>     time.sleep(0.2)
+        >>>     return [key * 2 for key in keys]
+        >>> results = [None] * 4
+        >>> def call(idx):
+        >>>     results[idx] = flight.run([1, 2, 3], compute_fn)
+        >>> threads = [threading.Thread(target=call, args=(idx,)) for idx in range(4)]
+        >>> for thread in threads:
+        >>>     thread.start()
+        >>> for thread in threads:
+        >>>     thread.join()
+        >>> assert all(result == {1: 2, 2: 4, 3: 6} for result in results)
+        >>> assert sorted(computed) == [1, 2, 3]
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._inflight = {}
+
+    def __len__(self):
+        return len(self._inflight)
+
+    def run(self, keys, compute_fn):
+        """Computes the values of ``keys``, sharing in-flight work.
+
+        Args:
+            keys (iterable): hashable keys.
+            compute_fn (callable): maps a list of keys to a sequence of values of
+                the same length. It is only called with keys this caller owns.
+
+        Returns:
+            dict: value of every key.
+        """
+        owned = []
+        waiting = {}
+        with self._lock:
+            for key in dict.fromkeys(keys):
+                if key in self._inflight:
+                    waiting[key] = self._inflight[key]
+                else:
+                    self._inflight[key] = Future()
+                    owned.append(key)
+
+        results = {}
+        if len(owned) > 0:
+            futures = [self._inflight[key] for key in owned]
+            try:
+                values = compute_fn(owned)
+                for key, future, value in zip(owned, futures, values):
+                    future.set_result(value)
+                    results[key] = value
+            except BaseException as ex:
+                for future in futures:
+                    if not future.done():
+                        future.set_exception(ex)
+                raise
+            finally:
+                with self._lock:
+                    for key in owned:
+                        self._inflight.pop(key, None)
+
+        for key, future in waiting.items():
+            results[key] = future.result()
+        return results
@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+from __future__ import division, print_function, absolute_import
+import os
+import os.path as osp
+import hashlib
+import warnings
+import torch
+import torch.nn as nn
+
+
+__all__ = [
+    'file_hash',
+    'set_exportable_swish',
+    'freeze_model',
+    'check_parity',
+    'load_or_freeze',
+]
+
+
+def file_hash(fpath, blocksize=2 ** 20):
+    """Returns the sha1 hex digest of a file's content."""
+    hasher = hashlib.sha1()
+    with open(fpath, 'rb') as f:
+        for block in iter(lambda: f.read(blocksize), b''):
+            hasher.update(block)
+    return hasher.hexdigest()
+
+
+class _ChannelsLast(nn.Module):
+    def forward(self, x):
+        return x.contiguous(memory_format=torch.channels_last)
+
+
+def set_exportable_swish(model):
+    """Swaps the memory-efficient swish of efficientnet_pytorch, a custom
+    autograd function that can be neither traced nor exported to ONNX, for
+    the plain one in every submodule of the model.
+
+    Args:
+        model (nn.Module): model, modified in place.
+
+    Returns:
+        nn.Module
+
+    Example:
+        >>> from efficientnet_pytorch import EfficientNet
+        >>> from wbia_pie_v2.inference.torchscript import set_exportable_swish
+        >>> model = set_exportable_swish(EfficientNet.from_name('efficientnet-b0'))
+        >>> names = {type(module).__name__ for module in model.modules()}
+        >>> assert 'MemoryEfficientSwish' not in names
+    """
+    for module in model.modules():
+        if hasattr(module, 'set_swish'):
+            module.set_swish(memory_efficient=False)
+    return model
+
+
+def freeze_model(model, example):
+    """Traces an eval-mode model and freezes it for CPU inference.
+
+    The model is converted to the channels_last memory format, together with
+    its input, and traced on ``example``. Freezing then inlines the weights
+    as constants and folds every BatchNorm into the preceding convolution.
+
+    Args:
+        model (nn.Module): eval-mode model.
+        example (torch.Tensor): example input batch.
+
+    Returns:
+        torch.jit.ScriptModule
+    """
+    model = set_exportable_swish(model.eval())
+    model = nn.Sequential(_ChannelsLast(), model).eval()
+    model = model.to(memory_format=torch.channels_last)
+    with torch.no_grad():
+        traced = torch.jit.trace(model, example)
+        frozen = torch.jit.freeze(traced)
+    return frozen
+
+
+def check_parity(model, frozen, example, atol=1e-3, rtol=1e-3):
+    """Checks that the frozen model reproduces the eager model's embeddings."""
+    with torch.no_grad():
+        expected = model(example)
+        output = frozen(example)
+    return torch.allclose(output, expected, atol=atol, rtol=rtol)
+
+
+def load_or_freeze(fpath, build_model, example):
+    """Loads a frozen model from disk, or freezes and saves it on first use.
+
+    The parity of the frozen model with the eager one is checked before it is
+    saved. If the check fails the eager model is returned instead and nothing
+    is written.
+
+    Args:
+        fpath (str): path of the frozen artifact. It should identify the
+            checkpoint, e.g. through :func:`file_hash`.
+        build_model (callable): returns the eager, eval-mode model.
+        example (torch.Tensor): example input batch.
+
+    Returns:
+        torch.jit.ScriptModule or nn.Module
+
+    Example:
+        >>> import os.path as osp
+        >>> import tempfile
+        >>> import torch
+        >>> from wbia_pie_v2.models import build_model
+        >>> from wbia_pie_v2.inference.torchscript import load_or_freeze
+        >>> fpath = osp.join(tempfile.mkdtemp(), 'frozen.pt')
+        >>> model = build_model('resnet50_fc512', 10, pretrained=False).eval()
+        >>> example = torch.rand(2, 3, 64, 64)
+        >>> with torch.no_grad():
+        >>>     expected = model(example)
+        >>> frozen = load_or_freeze(fpath, lambda: model, example)
+        >>> assert isinstance(frozen, torch.jit.ScriptModule) and osp.exists(fpath)
+        >>> reloaded = load_or_freeze(fpath, None, example)
+        >>> assert torch.allclose(reloaded(example), expected, atol=1e-3)
+    """
+    if osp.exists(fpath):
+        print('Loading frozen model from "{}"'.format(fpath))
+        return torch.jit.load(fpath, map_location='cpu')
+
+    model = build_model()
+    print('Freezing model for CPU inference')
+    frozen = freeze_model(model, example)
+    if not check_parity(model, frozen, example):
+        warnings.warn('Frozen model does not match the eager model, using eager mode')
+        return model
+
+    os.makedirs(osp.dirname(fpath), exist_ok=True)
+    tmp_fpath = '{}.{}.tmp'.format(fpath, os.getpid())
+    torch.jit.save(frozen, tmp_fpath)
+    os.replace(tmp_fpath, fpath)
+    print('Saved frozen model to "{}"'.format(fpath))
+    return frozen
@@ -2,4 +2,6 @@
 from .accuracy import accuracy  # noqa: F401
 from .onevsall import eval_onevsall  # noqa: F401
 from .distance import compute_distance_matrix  # noqa: F401
-from .knn import pred_light  # noqa: F401
+from .knn import pred_light, pred_light_batch, predict_k_names, NameIndex  # noqa: F401
+from .ann import IVFFlatIndex  # noqa: F401
+from .streaming import streaming_topk, streaming_cmc  # noqa: F401
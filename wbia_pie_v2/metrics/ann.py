@@ -0,0 +1,388 @@
+# -*- coding: utf-8 -*-
+from __future__ import division, print_function, absolute_import
+import os
+import threading
+import numpy as np
+
+
+__all__ = ['IVFFlatIndex', 'squared_distances', 'recall_at_k']
+
+
+def squared_distances(query_embs, db_embs, db_sqnorms=None):
+    """Squared euclidean distances as ``|q|^2 - 2 q.d + |d|^2``, clipped at 0.
+
+    Args:
+        query_embs (float array): of shape (num_q, emb_size).
+        db_embs (float array): of shape (num_emb, emb_size).
+        db_sqnorms (float array, optional): precomputed squared norms of
+            ``db_embs``.
+
+    Returns:
+        float array of shape (num_q, num_emb), in the dtype of the inputs.
+    """
+    if db_sqnorms is None:
+        db_sqnorms = np.einsum('ij,ij->i', db_embs, db_embs)
+    dist = query_embs @ db_embs.T
+    dist *= -2
+    dist += np.einsum('ij,ij->i', query_embs, query_embs)[:, None]
+    dist += db_sqnorms[None, :]
+    return np.maximum(dist, 0, out=dist)
+
+
+def _kmeans(embs, num_clusters, num_iters=20, seed=0):
+    rng = np.random.RandomState(seed)
+    centroids = embs[rng.choice(len(embs), num_clusters, replace=False)].copy()
+    for _ in range(num_iters):
+        assign = squared_distances(embs, centroids).argmin(axis=1)
+        counts = np.bincount(assign, minlength=num_clusters)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assign, embs)
+        empty = counts == 0
+        centroids[~empty] = sums[~empty] / counts[~empty, None]
+        # Reseed empty clusters on random points
+        centroids[empty] = embs[rng.choice(len(embs), empty.sum(), replace=False)]
+    return centroids
+
+
+class IVFFlatIndex(object):
+    """Inverted-file index with exact distances for approximate k-NN search.
+
+    The embeddings are partitioned into ``nlist`` clusters by k-means. A
+    query only computes distances to the embeddings of the ``nprobe``
+    clusters whose centroids are nearest to it, which is a fraction of the
+    gallery, and these distances are exact. Embeddings are stored flat, so
+    adding and removing annotations is cheap and never rebuilds the index.
+
+    Until it holds ``train_size`` embeddings the index has a single list, i.e.
+    searches are exhaustive. It is then trained with ``nlist = sqrt(size)``
+    clusters, and retrained whenever it has grown 4-fold since.
+
+    Searches of many queries are batched per cluster, keeping a running top-k
+    of every query. All methods are thread safe.
+
+    Args:
+        train_size (int, optional): size from which the index is partitioned.
+            Default is 4096.
+        nprobe (int, optional): clusters searched per query. Default is an
+            eighth of the clusters, at least 8.
+        seed (int, optional): k-means seed. Default is 0.
+
+    Example:
+        >>> import numpy as np
+        >>> from wbia_pie_v2.metrics.ann import IVFFlatIndex, squared_distances, recall_at_k
+        >>> rng = np.random.RandomState(0)
+        >>> centers = rng.randn(50, 32) * 4
+        >>> embs = (centers[rng.randint(0, 50, 5000)] + rng.randn(5000, 32)).astype(np.float32)
+        >>> aids = np.arange(5000) + 1
+        >>> index = IVFFlatIndex(train_size=1000)
+        >>> index.add(aids[:4000], embs[:4000])
+        >>> index.add(aids[4000:], embs[4000:])
+        >>> index.remove(aids[:10])
+        >>> assert len(index) == 4990 and index.nlist == int(np.sqrt(4000))
+        >>> queries = embs[:200] + 0.1
+        >>> neigh_aids, neigh_dists = index.search(queries, k=10)
+        >>> exact = np.argsort(squared_distances(queries, embs[10:]), axis=1)[:, :10] + 11
+        >>> assert recall_at_k(neigh_aids, exact) > 0.95
+        >>> assert np.all(np.diff(neigh_dists, axis=1) >= 0)
+    """
+
+    def __init__(self, train_size=4096, nprobe=None, seed=0):
+        self.train_size = train_size
+        self.nprobe = nprobe
+        self.seed = seed
+        self.centroids = None
+        self._aids = np.zeros(0, dtype=np.int64)
+        self._embs = None
+        self._lists = np.zeros(0, dtype=np.int64)
+        self._trained_size = 0
+        self._layout = None
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._aids)
+
+    def __contains__(self, aid):
+        return bool(np.any(self._aids == aid))
+
+    @property
+    def aids(self):
+        """Annot ids in the index."""
+        return self._aids
+
+    @property
+    def nlist(self):
+        return 0 if self.centroids is None else len(self.centroids)
+
+    def add(self, aids, embs):
+        """Adds embeddings, replacing those of aids already in the index.
+
+        Args:
+            aids (int array): annot ids.
+            embs (float array): embeddings of shape (len(aids), emb_size).
+        """
+        aids = np.asarray(aids, dtype=np.int64)
+        if len(aids) == 0:
+            return
+        embs = np.asarray(embs, dtype=np.float32).reshape(len(aids), -1)
+        with self._lock:
+            self.remove(aids)
+            if self._embs is None:
+                self._embs = np.zeros((0, embs.shape[1]), dtype=np.float32)
+            self._aids = np.concatenate([self._aids, aids])
+            self._embs = np.concatenate([self._embs, embs])
+            self._lists = np.concatenate([self._lists, self._assign(embs)])
+            self._layout = None
+            if (self.centroids is None and len(self) >= self.train_size) or (
+                self.centroids is not None and len(self) >= 4 * self._trained_size
+            ):
+                self.train()
+
+    def update(self, aids, embs):
+        """Adds the embeddings of aids that are missing or have changed.
+
+        Returns:
+            int: number of embeddings added.
+        """
+        aids = np.asarray(aids, dtype=np.int64)
+        embs = np.asarray(embs, dtype=np.float32).reshape(len(aids), -1)
+        with self._lock:
+            found = np.zeros(len(aids), dtype=bool)
+            if len(self) > 0:
+                order = np.argsort(self._aids)
+                pos = np.searchsorted(self._aids[order], aids)
+                pos = order[np.minimum(pos, len(order) - 1)]
+                found = self._aids[pos] == aids
+                found[found] = np.all(self._embs[pos[found]] == embs[found], axis=1)
+            self.add(aids[~found], embs[~found])
+            return int((~found).sum())
+
+    def remove(self, aids):
+        """Removes the embeddings of aids, e.g. of deleted annotations."""
+        with self._lock:
+            keep = ~np.isin(self._aids, aids)
+            if keep.all():
+                return
+            self._aids = self._aids[keep]
+            self._embs = self._embs[keep]
+            self._lists = self._lists[keep]
+            self._layout = None
+
+    def train(self):
+        """Partitions the stored embeddings into ``sqrt(size)`` clusters."""
+        with self._lock:
+            nlist = int(np.sqrt(len(self)))
+            if nlist < 2:
+                return
+            rng = np.random.RandomState(self.seed)
+            sample = rng.choice(len(self), min(len(self), 256 * nlist), replace=False)
+            self.centroids = _kmeans(self._embs[sample], nlist, seed=self.seed)
+            self._lists = self._assign(self._embs)
+            self._trained_size = len(self)
+            self._layout = None
+
+    def search(self, query_embs, k, nprobe=None, aid_filter=None):
+        """Finds the approximate k nearest neighbours of every query.
+
+        Args:
+            query_embs (float array): of shape (num_q, emb_size).
+            k (int): number of neighbours.
+            nprobe (int, optional): clusters searched per query, overriding the
+                index default.
+            aid_filter (int array, optional): only return these aids.
+
+        Returns:
+            tuple: aids of shape (num_q, k), padded with -1 if fewer than k
+            embeddings were searched, and their euclidean distances, padded
+            with inf, in increasing order of distance.
+        """
+        query_embs = np.asarray(query_embs, dtype=np.float32).reshape(
+            len(query_embs), -1
+        )
+        num_q = len(query_embs)
+        best_dists = np.full((num_q, k), np.inf, dtype=np.float32)
+        best_rows = np.full((num_q, k), -1, dtype=np.int64)
+
+        with self._lock:
+            aids, embs, centroids = self._aids, self._embs, self.centroids
+            order, offsets = self._get_layout()
+        if len(aids) > 0 and num_q > 0 and k > 0:
+            allowed = None if aid_filter is None else np.isin(aids, aid_filter)
+            if centroids is None:
+                probes = np.zeros((num_q, 1), dtype=np.int64)
+            else:
+                nprobe = min(self._nprobe(nprobe, len(centroids)), len(centroids))
+                cdists = squared_distances(query_embs, centroids)
+                probes = np.argpartition(cdists, nprobe - 1, axis=1)[:, :nprobe]
+
+            for list_idx in np.unique(probes):
+                qidxs = np.nonzero((probes == list_idx).any(axis=1))[0]
+                rows = order[offsets[list_idx] : offsets[list_idx + 1]]
+                if allowed is not None:
+                    rows = rows[allowed[rows]]
+                if len(rows) == 0:
+                    continue
+                dists = squared_distances(query_embs[qidxs], embs[rows])
+                cand_dists = np.concatenate([best_dists[qidxs], dists], axis=1)
+                cand_rows = np.concatenate(
+                    [best_rows[qidxs], np.broadcast_to(rows, dists.shape)], axis=1
+                )
+                top = np.argpartition(cand_dists, k - 1, axis=1)[:, :k]
+                best_dists[qidxs] = np.take_along_axis(cand_dists, top, axis=1)
+                best_rows[qidxs] = np.take_along_axis(cand_rows, top, axis=1)
+
+        sort = np.argsort(best_dists, axis=1, kind='stable')
+        best_dists = np.take_along_axis(best_dists, sort, axis=1)
+        best_rows = np.take_along_axis(best_rows, sort, axis=1)
+        if len(aids) == 0:
+            neigh_aids = best_rows
+        else:
+            neigh_aids = np.where(best_rows >= 0, aids[np.maximum(best_rows, 0)], -1)
+        return neigh_aids, np.sqrt(best_dists.astype(np.float64))
+
+    def search_names(self, query_embs, aids, labels, n_results=10, k=50, nprobe=None):
+        """Finds the approximate nearest names of every query.
+
+        The neighbours of a query are searched among ``aids`` and de-duplicated
+        by label. Whenever they cover fewer than ``n_results`` names, e.g.
+        because one well-sighted name owns most of them, the query is searched
+        again with twice as many neighbours, until the names are covered or the
+        probed clusters are exhausted.
+
+        Args:
+            query_embs (float array): of shape (num_q, emb_size).
+            aids (int array): annot ids searched.
+            labels (str or int array): name of every annot of ``aids``.
+            n_results (int, optional): number of names per query. Default is 10.
+            k (int, optional): number of neighbours of the first search.
+                Default is 50.
+            nprobe (int, optional): clusters searched per query.
+
+        Returns:
+            list of list of dict: per query, ``label`` and ``distance`` of the
+            nearest annotation of the nearest names, in order of distance.
+
+        Example:
+            >>> import numpy as np
+            >>> from wbia_pie_v2.metrics.ann import IVFFlatIndex
+            >>> from wbia_pie_v2.metrics.knn import pred_light_batch
+            >>> rng = np.random.RandomState(0)
+            >>> embs = rng.randn(3000, 16).astype(np.float32)
+            >>> labels = np.array(['n{}'.format(idx) for idx in range(3000)])
+            >>> # One name owns 300 annotations around the queries
+            >>> queries = rng.randn(5, 16).astype(np.float32)
+            >>> embs[:300] = queries[rng.randint(0, 5, 300)] + 0.01 * rng.randn(300, 16)
+            >>> labels[:300] = 'big'
+            >>> aids = np.arange(3000) + 1
+            >>> index = IVFFlatIndex(train_size=1000)
+            >>> index.add(aids, embs)
+            >>> answers = index.search_names(queries, aids, labels, nprobe=index.nlist)
+            >>> expected = pred_light_batch(queries, embs, labels)
+            >>> for ans, exp in zip(answers, expected):
+            >>>     assert len(ans) == 10 and ans[0]['label'] == 'big'
+            >>>     assert [row['label'] for row in ans] == [row['label'] for row in exp]
+        """
+        from .knn import rank_neighbor_labels
+
+        query_embs = np.asarray(query_embs, dtype=np.float32).reshape(
+            len(query_embs), -1
+        )
+        aids = np.asarray(aids, dtype=np.int64)
+        labels = np.asarray(labels)
+        answers = [[] for _ in range(len(query_embs))]
+        if len(aids) == 0:
+            return answers
+        aid_order = np.argsort(aids)
+        num_names = min(n_results, len(np.unique(labels)))
+
+        pending = np.arange(len(query_embs))
+        k = min(k, len(aids))
+        while len(pending) > 0:
+            neigh_aids, neigh_dist = self.search(
+                query_embs[pending], k, nprobe=nprobe, aid_filter=aids
+            )
+            pos = np.searchsorted(aids[aid_order], neigh_aids)
+            neigh_lbl = labels[aid_order[np.minimum(pos, len(aids) - 1)]]
+            ranked = rank_neighbor_labels(neigh_lbl, neigh_dist, n_results)
+            # Searching more neighbours does not help once the probed clusters
+            # hold fewer than k of them
+            exhausted = ~np.isfinite(neigh_dist[:, -1]) | (k >= len(aids))
+            is_done = np.array([len(ans) >= num_names for ans in ranked]) | exhausted
+            for qx, ans, done in zip(pending, ranked, is_done):
+                if done:
+                    answers[qx] = ans
+            pending = pending[~is_done]
+            k = min(2 * k, len(aids))
+        return answers
+
+    def save(self, fpath):
+        """Writes the index atomically to a ``.npz`` file."""
+        with self._lock:
+            embs = self._embs
+            if embs is None:
+                embs = np.zeros((0, 0), dtype=np.float32)
+            centroids = self.centroids
+            if centroids is None:
+                centroids = np.zeros((0, embs.shape[1]), dtype=np.float32)
+            os.makedirs(os.path.dirname(fpath) or '.', exist_ok=True)
+            tmp_fpath = '{}.{}.tmp.npz'.format(fpath[:-4], os.getpid())
+            np.savez(
+                tmp_fpath,
+                aids=self._aids,
+                embs=embs,
+                lists=self._lists,
+                centroids=centroids,
+                params=np.array([self.train_size, self._trained_size, self.seed]),
+            )
+            os.replace(tmp_fpath, fpath)
+
+    @classmethod
+    def load(cls, fpath, nprobe=None):
+        """Reads an index written by :meth:`save`."""
+        data = np.load(fpath)
+        train_size, trained_size, seed = data['params'].tolist()
+        index = cls(train_size=train_size, nprobe=nprobe, seed=seed)
+        index._aids = data['aids']
+        index._embs = data['embs']
+        index._lists = data['lists']
+        if len(data['centroids']) > 0:
+            index.centroids = data['centroids']
+        index._trained_size = trained_size
+        return index
+
+    def _nprobe(self, nprobe, nlist):
+        if nprobe is None:
+            nprobe = self.nprobe
+        if nprobe is None:
+            nprobe = max(8, nlist // 8)
+        return nprobe
+
+    def _assign(self, embs):
+        if self.centroids is None:
+            return np.zeros(len(embs), dtype=np.int64)
+        return squared_distances(embs, self.centroids).argmin(axis=1)
+
+    def _get_layout(self):
+        """Rows sorted by list and the offset of every list in them."""
+        if self._layout is None:
+            order = np.argsort(self._lists, kind='stable')
+            offsets = np.searchsorted(
+                self._lists[order], np.arange(max(self.nlist, 1) + 1)
+            )
+            self._layout = (order, offsets)
+        return self._layout
+
+
+def recall_at_k(neigh_aids, exact_aids):
+    """Fraction of the exact k nearest neighbours found by an approximate search.
+
+    Args:
+        neigh_aids (int array): approximate neighbours of shape (num_q, k).
+        exact_aids (int array): exact neighbours of shape (num_q, k).
+
+    Returns:
+        float
+    """
+    neigh_aids = np.asarray(neigh_aids)
+    exact_aids = np.asarray(exact_aids)
+    hits = [np.isin(exact, neigh).sum() for neigh, exact in zip(neigh_aids, exact_aids)]
+    return float(np.sum(hits)) / max(exact_aids.size, 1)
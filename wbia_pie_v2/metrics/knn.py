@@ -1,6 +1,5 @@
 # -*- coding: utf-8 -*-
 import numpy as np
-from sklearn.neighbors import NearestNeighbors
 
 
 def predict_k_neigh(db_emb, db_lbls, test_emb, k=5):
@@ -16,33 +15,183 @@ def predict_k_neigh(db_emb, db_lbls, test_emb, k=5):
         neigh_ind_un (int array): labels of indices of nearest points of shape (num_emb_t, k)
         neigh_dist_un (float array): distances of predictions of shape (num_emb_t, k)
     """
-    # Set number of nearest points (with duplicated labels)
-    k_w_dupl = min(50, len(db_emb))
-    nn_classifier = NearestNeighbors(n_neighbors=k_w_dupl, metric='euclidean')
-    nn_classifier.fit(db_emb, db_lbls)
+    neigh_lbl, neigh_ind, neigh_dist = predict_k_names(test_emb, db_emb, db_lbls, k=k)
+    return neigh_lbl.tolist(), neigh_ind.tolist(), neigh_dist.tolist()
 
-    # Predict nearest neighbors and distances for test embeddings
-    neigh_dist, neigh_ind = nn_classifier.kneighbors(test_emb)
 
-    # Get labels of nearest neighbors
-    neigh_lbl = np.zeros(shape=neigh_ind.shape, dtype=db_lbls.dtype)
-    for i, preds in enumerate(neigh_ind):
-        for j, pred in enumerate(preds):
-            neigh_lbl[i, j] = db_lbls[pred]
+class NameIndex(object):
+    """Groups database annotations by label (name) for name-level searches.
 
-    # Remove duplicates
-    neigh_lbl_un = []
-    neigh_ind_un = []
-    neigh_dist_un = []
+    The labels are encoded once as integer codes, and the annotations sorted
+    by code, so that a reduction over every name is a single ``reduceat`` over
+    contiguous segments of a row of distances.
 
-    for j in range(neigh_lbl.shape[0]):
-        indices = np.arange(0, len(neigh_lbl[j]))
-        a, b = rem_dupl(neigh_lbl[j], indices)
-        neigh_lbl_un.append(a[:k])
-        neigh_ind_un.append(neigh_ind[j][b][:k].tolist())
-        neigh_dist_un.append(neigh_dist[j][b][:k].tolist())
+    Args:
+        labels (str or int array): database labels of size (num_emb,).
+
+    Attributes:
+        names (array): the unique labels, in sorted order.
+        codes (int array): index in ``names`` of every annotation.
+        order (int array): annotations sorted by code.
+        offsets (int array): start of every name in ``order``.
+        counts (int array): number of annotations of every name.
+    """
+
+    def __init__(self, labels):
+        labels = np.asarray(labels)
+        self.names, codes = np.unique(labels, return_inverse=True)
+        self.codes = codes.reshape(-1)
+        self.order = np.argsort(self.codes, kind='stable')
+        self.counts = np.bincount(self.codes, minlength=len(self.names))
+        self.offsets = np.concatenate([[0], np.cumsum(self.counts)[:-1]]).astype(
+            np.int64
+        )
+
+    def __len__(self):
+        return len(self.codes)
+
+    def lookup(self, labels):
+        """Codes of labels, or -1 for labels absent from the database.
+
+        Example:
+            >>> from wbia_pie_v2.metrics.knn import NameIndex
+            >>> index = NameIndex(['b', 'a', 'b', 'c', 'b'])
+            >>> assert index.counts.tolist() == [1, 3, 1]
+            >>> assert index.lookup(['c', 'x', 'a', 'bb']).tolist() == [2, -1, 0, -1]
+        """
+        labels = np.asarray(labels)
+        if len(self.names) == 0 or len(labels) == 0:
+            return np.full(len(labels), -1, dtype=np.int64)
+        pos = np.minimum(np.searchsorted(self.names, labels), len(self.names) - 1)
+        return np.where(self.names[pos] == labels, pos, -1)
+
+    def reduce(self, dist, reduce='min', top_m=3):
+        """Reduces distances to annotations to distances to names.
+
+        Input:
+            dist (float array): distances of shape (num_q, num_emb)
+            reduce (str): ``min``, ``mean`` or ``topm``, the mean of the
+                ``top_m`` smallest distances of every name
+            top_m (int): number of distances averaged by ``topm``
+        Returns:
+            name_dist (float array): of shape (num_q, num_names)
+            nearest (int array): index of the nearest annotation of every name,
+                of shape (num_q, num_names)
+        """
+        dist = dist[:, self.order]
+        positions = np.arange(dist.shape[1])
+        name_min = np.minimum.reduceat(dist, self.offsets, axis=1)
+        # First position of the minimum of every name
+        is_min = dist == np.repeat(name_min, self.counts, axis=1)
+        first = np.minimum.reduceat(
+            np.where(is_min, positions, len(positions)), self.offsets, axis=1
+        )
+        nearest = self.order[first]
+
+        if reduce == 'min':
+            name_dist = name_min
+        elif reduce == 'mean':
+            name_dist = np.add.reduceat(dist, self.offsets, axis=1) / self.counts
+        elif reduce == 'topm':
+            # Pop the minimum of every name top_m times
+            name_dist = name_min.copy()
+            rows = np.arange(len(dist))[:, None]
+            for step in range(1, top_m):
+                dist[rows, first] = np.inf
+                name_min = np.minimum.reduceat(dist, self.offsets, axis=1)
+                is_min = dist == np.repeat(name_min, self.counts, axis=1)
+                first = np.minimum.reduceat(
+                    np.where(is_min, positions, len(positions)), self.offsets, axis=1
+                )
+                name_dist += np.where(self.counts > step, name_min, 0)
+            name_dist /= np.minimum(self.counts, top_m)
+        else:
+            raise ValueError('Unknown name reduction {!r}'.format(reduce))
+        return name_dist, nearest
 
-    return neigh_lbl_un, neigh_ind_un, neigh_dist_un
+
+def predict_k_names(
+    query_embs,
+    db_embeddings,
+    db_labels,
+    k=5,
+    reduce='min',
+    top_m=3,
+    tile_bytes=2 ** 26,
+):
+    """Get the k nearest names of the database for many query embeddings.
+
+    The distance of a query to a name is the minimum (or mean, or mean of the
+    ``top_m`` smallest) of its distances to the annotations of the name. It is
+    computed exactly for every name, so ``min(k, num_names)`` names are always
+    returned, however many annotations the nearest names own. Distances are
+    computed in tiles of queries sized to ``tile_bytes``.
+
+    Input:
+        query_embs (float array): query embeddings of size (num_q, emb_size)
+        db_embeddings (float array): database embeddings of size (num_emb, emb_size)
+        db_labels (str or int array or NameIndex): database labels of size
+            (num_emb,), or their :class:`NameIndex` to reuse it across calls
+        k (int): number of names to return per query
+        reduce (str): ``min``, ``mean`` or ``topm``, see :meth:`NameIndex.reduce`
+        top_m (int): number of distances averaged by ``topm``
+        tile_bytes (int): memory budget of a tile of distances
+    Returns:
+        neigh_lbl (str or int array): names of shape (num_q, min(k, num_names)),
+            in increasing order of distance
+        neigh_ind (int array): index of the nearest annotation of every name
+        neigh_dist (float array): distances of the names
+
+    Example:
+        >>> import numpy as np
+        >>> from wbia_pie_v2.metrics.knn import predict_k_names
+        >>> rng = np.random.RandomState(0)
+        >>> db_embs = rng.rand(300, 8)
+        >>> db_labels = rng.randint(0, 20, 300)
+        >>> # One well-sighted name owns 100 annotations next to the queries
+        >>> query_embs = rng.rand(4, 8)
+        >>> db_embs[:100] = query_embs[0] + 1e-3 * rng.randn(100, 8)
+        >>> db_labels[:100] = 99
+        >>> lbl, ind, dist = predict_k_names(query_embs, db_embs, db_labels, k=5)
+        >>> assert lbl.shape == (4, 5) and lbl[0, 0] == 99
+        >>> full = np.linalg.norm(query_embs[:, None] - db_embs[None], axis=2)
+        >>> for qx in range(4):
+        >>>     names = np.unique(db_labels)
+        >>>     expected = np.array([full[qx, db_labels == name].min() for name in names])
+        >>>     assert list(lbl[qx]) == list(names[np.argsort(expected)[:5]])
+        >>>     assert np.allclose(dist[qx], np.sort(expected)[:5])
+        >>>     assert np.allclose(full[qx, ind[qx]], dist[qx])
+        >>> _, _, mean_dist = predict_k_names(query_embs, db_embs, db_labels, k=30, reduce='mean')
+        >>> expected = np.array([full[1, db_labels == name].mean() for name in names])
+        >>> assert np.allclose(mean_dist[1], np.sort(expected))
+        >>> _, _, topm_dist = predict_k_names(query_embs, db_embs, db_labels, k=30, reduce='topm')
+        >>> expected = np.array([np.sort(full[2, db_labels == name])[:3].mean() for name in names])
+        >>> assert np.allclose(topm_dist[2], np.sort(expected))
+    """
+    index = db_labels if isinstance(db_labels, NameIndex) else NameIndex(db_labels)
+    num_q = len(query_embs)
+    kk = min(k, len(index.names))
+    neigh_lbl = np.zeros((num_q, kk), dtype=index.names.dtype)
+    neigh_ind = np.zeros((num_q, kk), dtype=np.int64)
+    neigh_dist = np.zeros((num_q, kk), dtype=np.float64)
+    if num_q == 0 or kk == 0:
+        return neigh_lbl, neigh_ind, neigh_dist
+
+    start = 0
+    for dist in _euclidean_distance_tiles(query_embs, db_embeddings, tile_bytes):
+        name_dist, nearest = index.reduce(dist, reduce=reduce, top_m=top_m)
+        top = np.argpartition(name_dist, kk - 1, axis=1)[:, :kk]
+        top_dist = np.take_along_axis(name_dist, top, axis=1)
+        top_nearest = np.take_along_axis(nearest, top, axis=1)
+        # Ties are broken by the position of the nearest annotation
+        sort = np.lexsort((top_nearest, top_dist))
+        stop = start + len(dist)
+        top = np.take_along_axis(top, sort, axis=1)
+        neigh_lbl[start:stop] = index.names[top]
+        neigh_ind[start:stop] = np.take_along_axis(top_nearest, sort, axis=1)
+        neigh_dist[start:stop] = np.take_along_axis(top_dist, sort, axis=1)
+        start = stop
+    return neigh_lbl, neigh_ind, neigh_dist
 
 
 def pred_light(query_embedding, db_embeddings, db_labels, n_results=10):
@@ -62,6 +211,106 @@ def pred_light(query_embedding, db_embeddings, db_labels, n_results=10):
     return ans_dict
 
 
+def pred_light_batch(
+    query_embs, db_embeddings, db_labels, n_results=10, tile_bytes=2 ** 26
+):
+    """Get k nearest solutions from the database for many query embeddings.
+
+    Returns the same answers as :func:`pred_light` on every query: the
+    ``n_results`` nearest names, at the distance of their nearest annotation,
+    see :func:`predict_k_names`. The database is not indexed once per query;
+    instead the distances of a tile of queries to the whole database are
+    computed at once, with tiles sized to ``tile_bytes``.
+
+    Input:
+        query_embs (float array): query embeddings of size (num_q, emb_size)
+        db_embeddings (float array): database embeddings of size (num_emb, emb_size)
+        db_labels (str or int array or NameIndex): database labels of size (num_emb,)
+        n_results (int): number of labels to return per query
+        tile_bytes (int): memory budget of a tile of distances
+    Returns:
+        list of list of dict: per query, ``label`` and ``distance`` of the
+        predictions in order of distance
+
+    Example:
+        >>> import numpy as np
+        >>> from wbia_pie_v2.metrics.knn import pred_light_batch
+        >>> # 1-D embeddings, so that distances are |query - db|
+        >>> db_embs = np.array([[0], [1], [1.5], [4], [4], [7], [10]], dtype=np.float64)
+        >>> db_labels = np.array(['a', 'a', 'a', 'b', 'c', 'c', 'd'])
+        >>> query_embs = np.array([[2], [6], [1.2]], dtype=np.float64)
+        >>> answers = pred_light_batch(query_embs, db_embs, db_labels, n_results=4, tile_bytes=8)
+        >>> # Ties between names are broken by the position of their nearest annotation
+        >>> expected = [
+        >>>     [('a', 0.5), ('b', 2.0), ('c', 2.0), ('d', 8.0)],
+        >>>     [('c', 1.0), ('b', 2.0), ('d', 4.0), ('a', 4.5)],
+        >>>     [('a', 0.2), ('b', 2.8), ('c', 2.8), ('d', 8.8)],
+        >>> ]
+        >>> for ans, exp in zip(answers, expected):
+        >>>     assert [row['label'] for row in ans] == [lbl for lbl, _ in exp]
+        >>>     assert np.allclose([row['distance'] for row in ans], [dist for _, dist in exp])
+        >>> # The annotations of 'a' nearest to the query do not crowd out other names
+        >>> answers = pred_light_batch(query_embs[2:], db_embs, db_labels, n_results=3)
+        >>> assert [row['label'] for row in answers[0]] == ['a', 'b', 'c']
+    """
+    neigh_lbl, _, neigh_dist = predict_k_names(
+        query_embs, db_embeddings, db_labels, k=n_results, tile_bytes=tile_bytes
+    )
+    return [
+        [
+            {'label': lbl, 'distance': dist}
+            for lbl, dist in zip(lbls.tolist(), dists.tolist())
+        ]
+        for lbls, dists in zip(neigh_lbl, neigh_dist)
+    ]
+
+
+def rank_neighbor_labels(neigh_lbl, neigh_dist, n_results=10):
+    """De-duplicate the labels of sorted nearest neighbours, as in :func:`pred_light`.
+
+    Input:
+        neigh_lbl (str or int array): labels of the neighbours of every query,
+            of shape (num_q, num_neigh), sorted by distance
+        neigh_dist (float array): distances of the neighbours; infinite
+            distances mark missing neighbours and are skipped
+        n_results (int): number of labels to return per query
+    Returns:
+        list of list of dict: per query, ``label`` and ``distance`` of the
+        nearest occurrence of the first ``n_results`` labels
+    """
+    answers = []
+    for lbls, dists in zip(neigh_lbl, neigh_dist):
+        valid = np.isfinite(dists)
+        lbls, dists = lbls[valid], dists[valid]
+        # First occurrence of every label, in order of distance
+        _, first = np.unique(lbls, return_index=True)
+        first = np.sort(first)[:n_results]
+        answers.append(
+            [
+                {'label': lbl, 'distance': dist}
+                for lbl, dist in zip(lbls[first], dists[first].tolist())
+            ]
+        )
+    return answers
+
+
+def _euclidean_distance_tiles(query_embs, db_embs, tile_bytes=2 ** 26):
+    """Yields float64 euclidean distances of consecutive tiles of queries to
+    the whole database, as ``sqrt(|q|^2 - 2 q.d + |d|^2)``."""
+    query_embs = np.asarray(query_embs, dtype=np.float64)
+    db_embs = np.asarray(db_embs, dtype=np.float64)
+    db_sqnorms = np.einsum('ij,ij->i', db_embs, db_embs)
+    tile_rows = max(1, tile_bytes // (8 * max(1, len(db_embs))))
+    for start in range(0, len(query_embs), tile_rows):
+        tile = query_embs[start : start + tile_rows]
+        dist = tile @ db_embs.T
+        dist *= -2
+        dist += np.einsum('ij,ij->i', tile, tile)[:, None]
+        dist += db_sqnorms[None, :]
+        np.maximum(dist, 0, out=dist)
+        yield np.sqrt(dist, out=dist)
+
+
 def rem_dupl(seq, seq2=None):
     """Remove duplicates from a sequence and keep the order of elements.
     Do it in unison with a sequence 2."""
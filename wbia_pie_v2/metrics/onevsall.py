@@ -2,60 +2,69 @@
 import numpy as np
 
 
-def eval_onevsall(distmat, q_pids, max_rank=50):
-    """Evaluation with one vs all on query set."""
-    num_q = distmat.shape[0]
+def eval_onevsall(distmat, q_pids, max_rank=50, chunk_size=None):
+    """Evaluation with one vs all on query set.
+
+    The queries are ranked in chunks of ``chunk_size`` rows of ``distmat``,
+    so that only the sort and matches of a chunk are held in memory. The
+    default chunk size keeps them to about 256 MB. The results do not depend
+    on the chunk size.
+
+    Example:
+        >>> import numpy as np
+        >>> from wbia_pie_v2.metrics import eval_onevsall
+        >>> positions = np.array([0, 1, 3, 10, 4])
+        >>> distmat = np.abs(positions[:, None] - positions[None, :]).astype(float)
+        >>> q_pids = np.array([0, 0, 1, 1, 2])
+        >>> for chunk_size in [None, 1, 2]:
+        >>>     cmc, mAP = eval_onevsall(distmat, q_pids, chunk_size=chunk_size)
+        >>>     assert cmc.tolist() == [0.5, 0.75, 0.75, 1.0]
+        >>>     assert mAP == (1 + 1 + 0.25 + 0.5) / 4
+    """
+    num_q, num_g = distmat.shape
 
     if num_q < max_rank:
         max_rank = num_q
         print('Note: number of gallery samples is quite small, got {}'.format(num_q))
 
-    indices = np.argsort(distmat, axis=1)
-    #    print('indices\n', indices)
-
-    matches = (q_pids[indices] == q_pids[:, np.newaxis]).astype(np.int32)
-    #    print('matches\n', matches)
+    if chunk_size is None:
+        chunk_size = max(1, 2 ** 28 // (32 * num_g))
 
-    # compute cmc curve for each query
-    all_cmc = []
+    cmc_counts = np.zeros(max(0, min(max_rank, num_g - 1)), dtype=np.int64)
     all_AP = []
     num_valid_q = 0.0  # number of valid query
+    ranks = np.arange(1.0, num_g)
 
-    for q_idx in range(num_q):
-        # remove the query itself
-        order = indices[q_idx]
-        keep = order != q_idx
+    for start in range(0, num_q, chunk_size):
+        q_idxs = np.arange(start, min(start + chunk_size, num_q))
+        indices = np.argsort(np.asarray(distmat[q_idxs]), axis=1)
+        matches = (q_pids[indices] == q_pids[q_idxs, np.newaxis]).astype(np.int32)
 
-        # compute cmc curve
-        raw_cmc = matches[q_idx][
-            keep
-        ]  # binary vector, positions with value 1 are correct matches
-        if not np.any(raw_cmc):
-            # this condition is true when query identity has only one example
-            # => cannot evaluate retrieval
-            continue
+        # remove the query itself, present once in every row
+        keep = indices != q_idxs[:, np.newaxis]
+        raw_cmc = matches[keep].reshape(len(q_idxs), num_g - 1)
 
-        cmc = raw_cmc.cumsum()
-        cmc[cmc > 1] = 1
+        # this condition is false when query identity has only one example
+        # => cannot evaluate retrieval
+        is_valid = raw_cmc.any(axis=1)
+        raw_cmc = raw_cmc[is_valid]
+        num_valid_q += float(len(raw_cmc))
 
-        all_cmc.append(cmc[:max_rank])
-        num_valid_q += 1.0
+        # compute cmc curve
+        cmc = raw_cmc.cumsum(axis=1)
+        cmc_counts += (cmc[:, :max_rank] > 0).sum(axis=0)
 
         # compute average precision
         # reference: https://en.wikipedia.org/wiki/Evaluation_measures_(information_retrieval)#Average_precision
-        num_rel = raw_cmc.sum()
-        tmp_cmc = raw_cmc.cumsum()
-        tmp_cmc = [x / (i + 1.0) for i, x in enumerate(tmp_cmc)]
-        tmp_cmc = np.asarray(tmp_cmc) * raw_cmc
-        AP = tmp_cmc.sum() / num_rel
-        all_AP.append(AP)
+        num_rel = raw_cmc.sum(axis=1)
+        tmp_cmc = (cmc / ranks) * raw_cmc
+        all_AP.append(tmp_cmc.sum(axis=1) / num_rel)
 
-    print('Computed metrics on {} examples'.format(len(all_cmc)))
+    print('Computed metrics on {} examples'.format(int(num_valid_q)))
 
     assert num_valid_q > 0, 'Error: all query identities have one example'
 
-    all_cmc = np.asarray(all_cmc).astype(np.float32)
-    all_cmc = all_cmc.sum(0) / num_valid_q
-    mAP = np.mean(all_AP)
+    all_cmc = cmc_counts.astype(np.float32) / num_valid_q
+    mAP = np.mean(np.concatenate(all_AP))
 
     return all_cmc, mAP
@@ -0,0 +1,225 @@
+# -*- coding: utf-8 -*-
+from __future__ import division, print_function, absolute_import
+import numpy as np
+
+from .knn import NameIndex
+
+
+__all__ = ['streaming_topk', 'streaming_cmc']
+
+
+def _block_sizes(num_q, num_db, memory_bytes, row_bytes=0):
+    """Rows of queries and of gallery embeddings per block, such that a block
+    of float32 distances and its temporaries, about 16 bytes per distance,
+    plus ``row_bytes`` of state per query fit in ``memory_bytes``."""
+    q_rows = max(1, min(num_q, 1024, memory_bytes // (2 * max(row_bytes, 1))))
+    db_rows = max(1, min(num_db, memory_bytes // (32 * q_rows)))
+    return q_rows, db_rows
+
+
+def _distance_block(query_embs, query_sqnorms, db_block):
+    """Float32 euclidean distances of queries to a block of the gallery."""
+    db_block = np.asarray(db_block, dtype=np.float32)
+    dist = query_embs @ db_block.T
+    dist *= -2
+    dist += query_sqnorms[:, None]
+    dist += np.einsum('ij,ij->i', db_block, db_block)[None, :]
+    np.maximum(dist, 0, out=dist)
+    return np.sqrt(dist, out=dist)
+
+
+def streaming_topk(
+    query_embs,
+    db_embs,
+    k,
+    db_labels=None,
+    reduce='min',
+    exclude_self=False,
+    memory_bytes=2 ** 28,
+):
+    """Exact k nearest gallery embeddings (or names) of the queries, in bounded memory.
+
+    Queries and gallery are walked in blocks sized to ``memory_bytes``. The
+    distances of a block are computed with a float32 matrix product and merged
+    into a running top-k of every query, so the full distance matrix is never
+    held in memory. The gallery is read one contiguous block at a time, so it
+    can be a ``np.memmap`` of embeddings larger than memory.
+
+    With ``db_labels``, the running state of a query is instead its distance
+    to every name, the minimum (or mean) of its distances to the annotations
+    of the name, and the k nearest names are returned.
+
+    Args:
+        query_embs (float array): of shape (num_q, emb_size).
+        db_embs (float array or np.memmap): of shape (num_emb, emb_size).
+        k (int): number of neighbours.
+        db_labels (array or NameIndex, optional): gallery labels, for a search
+            of the k nearest names.
+        reduce (str, optional): ``min`` or ``mean``, the distance of a query to
+            a name. Default is ``min``.
+        exclude_self (bool, optional): the queries are the gallery, and query
+            ``i`` does not match gallery embedding ``i``. Default is False.
+        memory_bytes (int, optional): memory budget of the search. Default is
+            256 MB.
+
+    Returns:
+        tuple: gallery indices (or names) of shape (num_q, k'), where k' is
+        ``k`` capped to the gallery (or name) count, and their float32
+        euclidean distances, in increasing order of distance.
+
+    Example:
+        >>> import numpy as np
+        >>> from wbia_pie_v2.metrics.streaming import streaming_topk
+        >>> rng = np.random.RandomState(0)
+        >>> embs = rng.rand(500, 16).astype(np.float32)
+        >>> labels = rng.randint(0, 60, 500)
+        >>> full = np.linalg.norm(embs[:, None] - embs[None], axis=2)
+        >>> np.fill_diagonal(full, np.inf)
+        >>> neigh, dist = streaming_topk(embs, embs, 10, exclude_self=True, memory_bytes=2 ** 16)
+        >>> assert (neigh == np.argsort(full, axis=1)[:, :10]).mean() > 0.999
+        >>> assert np.allclose(dist, np.sort(full, axis=1)[:, :10], atol=1e-5)
+        >>> queries = rng.rand(50, 16).astype(np.float32)
+        >>> full = np.linalg.norm(queries[:, None] - embs[None], axis=2)
+        >>> names, dist = streaming_topk(queries, embs, 5, db_labels=labels, memory_bytes=2 ** 16)
+        >>> name_dist = np.stack([full[:, labels == name].min(axis=1) for name in np.unique(labels)], 1)
+        >>> assert np.allclose(dist, np.sort(name_dist, axis=1)[:, :5], atol=1e-5)
+        >>> names, dist = streaming_topk(queries, embs, 5, db_labels=labels, reduce='mean', memory_bytes=2 ** 16)
+        >>> name_dist = np.stack([full[:, labels == name].mean(axis=1) for name in np.unique(labels)], 1)
+        >>> assert np.allclose(dist, np.sort(name_dist, axis=1)[:, :5], atol=1e-5)
+        >>> assert np.all(np.unique(labels)[np.argsort(name_dist, axis=1)[:, 0]] == names[:, 0])
+    """
+    if reduce not in ('min', 'mean'):
+        raise ValueError('Unknown name reduction {!r}'.format(reduce))
+    query_embs = np.asarray(query_embs, dtype=np.float32)
+    num_q, num_db = len(query_embs), len(db_embs)
+    index = None
+    if db_labels is not None:
+        index = db_labels if isinstance(db_labels, NameIndex) else NameIndex(db_labels)
+        k = min(k, len(index.names))
+    else:
+        k = min(k, num_db - int(exclude_self))
+
+    out_neigh = np.full((num_q, max(k, 0)), -1, dtype=np.int64)
+    out_dist = np.full((num_q, max(k, 0)), np.inf, dtype=np.float32)
+    if num_q == 0 or k <= 0:
+        return (out_neigh if index is None else index.names[out_neigh]), out_dist
+
+    row_bytes = 0 if index is None else 8 * len(index.names)
+    q_rows, db_rows = _block_sizes(num_q, num_db, memory_bytes, row_bytes)
+    for q_start in range(0, num_q, q_rows):
+        queries = query_embs[q_start : q_start + q_rows]
+        query_sqnorms = np.einsum('ij,ij->i', queries, queries)
+        rows = np.arange(len(queries))
+        if index is None:
+            best_dist = np.full((len(queries), k), np.inf, dtype=np.float32)
+            best_neigh = np.full((len(queries), k), -1, dtype=np.int64)
+        else:
+            name_dist = np.full((len(queries), len(index.names)), np.inf, np.float32)
+            if reduce == 'mean':
+                name_dist[:] = 0
+
+        for db_start in range(0, num_db, db_rows):
+            db_stop = min(db_start + db_rows, num_db)
+            dist = _distance_block(queries, query_sqnorms, db_embs[db_start:db_stop])
+            if exclude_self:
+                self_idx = q_start + rows - db_start
+                is_self = (self_idx >= 0) & (self_idx < len(dist[0]))
+                # Excluded from the minimum, or from the sum of the mean
+                excluded = 0 if index is not None and reduce == 'mean' else np.inf
+                dist[rows[is_self], self_idx[is_self]] = excluded
+
+            if index is None:
+                # Merge the block into the running top-k
+                cand_dist = np.concatenate([best_dist, dist], axis=1)
+                top = np.argpartition(cand_dist, k - 1, axis=1)[:, :k]
+                best_dist = np.take_along_axis(cand_dist, top, axis=1)
+                best_neigh = np.where(
+                    top < k,
+                    np.take_along_axis(best_neigh, np.minimum(top, k - 1), axis=1),
+                    top - k + db_start,
+                )
+            else:
+                # Reduce the block to the names it holds
+                codes = index.codes[db_start:db_stop]
+                order = np.argsort(codes, kind='stable')
+                block_names, offsets = np.unique(codes[order], return_index=True)
+                dist = dist[:, order]
+                if reduce == 'min':
+                    block_dist = np.minimum.reduceat(dist, offsets, axis=1)
+                    name_dist[:, block_names] = np.minimum(
+                        name_dist[:, block_names], block_dist
+                    )
+                else:
+                    name_dist[:, block_names] += np.add.reduceat(dist, offsets, axis=1)
+
+        if index is not None:
+            if reduce == 'mean':
+                counts = np.tile(index.counts, (len(queries), 1))
+                if exclude_self:
+                    counts[rows, index.codes[q_start + rows]] -= 1
+                name_dist /= np.maximum(counts, 1)
+                name_dist[counts == 0] = np.inf
+            top = np.argpartition(name_dist, k - 1, axis=1)[:, :k]
+            best_dist = np.take_along_axis(name_dist, top, axis=1)
+            best_neigh = top
+
+        sort = np.argsort(best_dist, axis=1, kind='stable')
+        q_stop = q_start + len(queries)
+        out_dist[q_start:q_stop] = np.take_along_axis(best_dist, sort, axis=1)
+        out_neigh[q_start:q_stop] = np.take_along_axis(best_neigh, sort, axis=1)
+
+    if index is not None:
+        return index.names[out_neigh], out_dist
+    return out_neigh, out_dist
+
+
+def streaming_cmc(embs, pids, max_rank=50, memory_bytes=2 ** 28):
+    """One vs all CMC curve of a set of embeddings, in bounded memory.
+
+    Gives the CMC curve of :func:`eval_onevsall` on the euclidean distance
+    matrix of ``embs``, from the ``max_rank`` nearest neighbours of every
+    embedding found by :func:`streaming_topk`, instead of sorting full rows of
+    the distance matrix.
+
+    Args:
+        embs (float array or np.memmap): of shape (num_emb, emb_size).
+        pids (int array): identity of every embedding.
+        max_rank (int, optional): length of the curve. Default is 50.
+        memory_bytes (int, optional): memory budget. Default is 256 MB.
+
+    Returns:
+        float32 array: fraction of queries with a match within each rank,
+        over the queries whose identity has another example.
+
+    Example:
+        >>> import numpy as np
+        >>> from scipy.spatial import distance_matrix
+        >>> from wbia_pie_v2.metrics import eval_onevsall
+        >>> from wbia_pie_v2.metrics.streaming import streaming_cmc
+        >>> rng = np.random.RandomState(0)
+        >>> embs = rng.rand(400, 8).astype(np.float32)
+        >>> pids = rng.randint(0, 100, 400)
+        >>> cmc = streaming_cmc(embs, pids, memory_bytes=2 ** 16)
+        >>> expected, _ = eval_onevsall(distance_matrix(embs, embs), pids)
+        >>> assert np.allclose(cmc, expected)
+    """
+    pids = np.asarray(pids)
+    num_q = len(pids)
+    if num_q < max_rank:
+        max_rank = num_q
+        print('Note: number of gallery samples is quite small, got {}'.format(num_q))
+
+    neigh, _ = streaming_topk(
+        embs, embs, max_rank, exclude_self=True, memory_bytes=memory_bytes
+    )
+    matches = pids[neigh] == pids[:, None]
+    # Queries whose identity has only one example cannot be evaluated
+    _, inverse, counts = np.unique(pids, return_inverse=True, return_counts=True)
+    is_valid = counts[inverse.reshape(-1)] > 1
+    num_valid_q = float(is_valid.sum())
+    print('Computed metrics on {} examples'.format(int(num_valid_q)))
+
+    assert num_valid_q > 0, 'Error: all query identities have one example'
+
+    all_cmc = np.cumsum(matches[is_valid], axis=1) > 0
+    return all_cmc.astype(np.float32).sum(0) / num_valid_q
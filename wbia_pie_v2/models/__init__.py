@@ -3,6 +3,9 @@
 Adapted from source: https://github.com/KaiyangZhou/deep-person-reid
 """
 from __future__ import absolute_import
+import inspect
+import torch
+import torch.nn as nn
 from .resnet import resnet50_fc512, resnext101_32x8d
 from .efficientnet import efficientnet_b4
 from .efficientnet import efficientnet_b0
@@ -41,3 +44,88 @@ def build_model(name, num_classes, loss="softmax", pretrained=True, use_gpu=True
     return __model_factory[name](
         num_classes=num_classes, loss=loss, pretrained=pretrained, use_gpu=use_gpu
     )
+
+
+def build_inference_model(name, num_classes, state_dict, loss="softmax"):
+    """Builds an eval-mode model straight from fine-tuned weights.
+
+    Unlike :func:`build_model` followed by ``load_pretrained_weights``, no
+    ImageNet weights are downloaded or loaded and no random initialization is
+    run, since all of it would be overwritten by the checkpoint. When torch
+    supports it (>= 2.1) the network is built on the meta device and the
+    checkpoint tensors are assigned in place. Layers missing from the
+    checkpoint, or with a mismatched size, are initialized as usual.
+
+    Args:
+        name (str): model name.
+        num_classes (int): number of training identities.
+        state_dict (dict): fine-tuned weights, see ``utils.read_state_dict``.
+        loss (str, optional): loss the model was trained with. Default is "softmax".
+
+    Returns:
+        nn.Module
+    """
+    avai_models = list(__model_factory.keys())
+    if name not in avai_models:
+        raise KeyError("Unknown model: {}. Must be one of {}".format(name, avai_models))
+
+    def _build():
+        return __model_factory[name](
+            num_classes=num_classes,
+            loss=loss,
+            pretrained=False,
+            use_gpu=False,
+            init_params=False,
+        )
+
+    if not _supports_meta_init():
+        model = _build()
+        missing = _load_matching(model, state_dict)
+        for module_name in missing:
+            _reset_module(model.get_submodule(module_name), device="cpu")
+        return model.eval()
+
+    with torch.device("meta"):
+        model = _build()
+    missing = _load_matching(model, state_dict, assign=True)
+    for module_name in missing:
+        _reset_module(model.get_submodule(module_name), device="cpu")
+    return model.eval()
+
+
+def _supports_meta_init():
+    return hasattr(torch.device, "__enter__") and (
+        "assign" in inspect.signature(nn.Module.load_state_dict).parameters
+    )
+
+
+def _load_matching(model, state_dict, assign=False):
+    """Loads the entries of state_dict that match the model in name and size.
+
+    Returns the names of the modules left with parameters or buffers that were
+    not loaded.
+    """
+    model_dict = model.state_dict()
+    matched = {
+        k: v
+        for k, v in state_dict.items()
+        if k in model_dict and model_dict[k].size() == v.size()
+    }
+    if assign:
+        model.load_state_dict(matched, strict=False, assign=True)
+    else:
+        model.load_state_dict(matched, strict=False)
+
+    missing = [k for k in model_dict.keys() if k not in matched]
+    if len(missing) > 0:
+        print("** The following layers are not in the checkpoint: {}".format(missing))
+    return sorted(set(k.rpartition(".")[0] for k in missing))
+
+
+def _reset_module(module, device):
+    if any(t.is_meta for t in module.parameters(recurse=False)) or any(
+        t.is_meta for t in module.buffers(recurse=False)
+    ):
+        module.to_empty(device=device, recurse=False)
+    if hasattr(module, "reset_parameters"):
+        module.reset_parameters()
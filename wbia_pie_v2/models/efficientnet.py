@@ -25,13 +25,17 @@ class EfficientNetReid(nn.Module):
     """Re-id model with EfficientNet as a convolutional feature extractor.
     Input:
         core_name (string): name of core model, class from torchvision.models
+        pretrained (bool): load ImageNet weights into the core model
     """
 
-    def __init__(self, core_name, num_classes, fc_dims, dropout_p, loss):
+    def __init__(self, core_name, num_classes, fc_dims, dropout_p, loss, pretrained=True):
         super(EfficientNetReid, self).__init__()
         self.loss = loss
 
-        self.core_model = EfficientNet.from_pretrained(core_name)
+        if pretrained:
+            self.core_model = EfficientNet.from_pretrained(core_name)
+        else:
+            self.core_model = EfficientNet.from_name(core_name)
 
         self.global_avgpool = nn.AdaptiveAvgPool2d((1, 1))
         self.fc = self._construct_fc_layer(
@@ -99,6 +103,7 @@ def efficientnet_b4(num_classes, loss="softmax", pretrained=True, **kwargs):
         loss=loss,
         fc_dims=[512],
         dropout_p=None,
+        pretrained=pretrained,
     )
 
     return model
@@ -111,6 +116,7 @@ def efficientnet_b0(num_classes, loss="softmax", pretrained=True, **kwargs):
         loss=loss,
         fc_dims=[512],
         dropout_p=None,
+        pretrained=pretrained,
     )
 
     return model
@@ -180,6 +180,7 @@ class ResNet(nn.Module):
         last_stride=2,
         fc_dims=None,
         dropout_p=None,
+        init_params=True,
         **kwargs
     ):
         super(ResNet, self).__init__()
@@ -225,7 +226,9 @@ class ResNet(nn.Module):
         self.fc = self._construct_fc_layer(fc_dims, 512 * block.expansion, dropout_p)
         self.classifier = nn.Linear(self.feature_dim, num_classes)
 
-        self._init_params()
+        # Skipped when every weight is about to be overwritten by a checkpoint
+        if init_params:
+            self._init_params()
 
         # Zero-initialize the last BN in each residual branch,
         # so that the residual branch starts with zeros, and each residual block behaves like an identity.
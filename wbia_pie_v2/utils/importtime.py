@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+from __future__ import division, print_function, absolute_import
+import sys
+import subprocess
+
+__all__ = ['import_times', 'imported_by']
+
+
+def import_times(statement):
+    """Runs an import statement in a fresh interpreter under ``-X importtime``.
+
+    Args:
+        statement (str): python code, e.g. ``'import wbia_pie_v2'``.
+
+    Returns:
+        list of tuple: ``(module, self seconds, cumulative seconds, depth)`` in
+        the order reported by the interpreter, i.e. every module after the
+        modules it imported.
+
+    Example:
+        >>> from wbia_pie_v2.utils.importtime import import_times, imported_by
+        >>> entries = import_times('import json')
+        >>> modules = imported_by(entries, 'json.decoder')
+        >>> assert 'json.scanner' in modules and 'json.encoder' not in modules
+        >>> assert modules['json.decoder'] >= modules['json.scanner']
+    """
+    proc = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', statement],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+        check=True,
+    )
+    entries = []
+    for line in proc.stderr.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        self_us, cumulative_us, name = line[len('import time:') :].split('|')
+        if not self_us.strip().isdigit():
+            # Header line
+            continue
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        entries.append(
+            (name.strip(), int(self_us) * 1e-6, int(cumulative_us) * 1e-6, depth)
+        )
+    return entries
+
+
+def imported_by(entries, module):
+    """Lists the modules first imported while importing ``module``.
+
+    Args:
+        entries (list): output of :func:`import_times`.
+        module (str): module name.
+
+    Returns:
+        dict: cumulative import time in seconds of ``module`` and of every
+        module in its import subtree. Empty if ``module`` was not imported.
+
+    Example:
+        >>> # Registering the plugin with wbia must not load the deep learning stack
+        >>> from wbia_pie_v2.utils.importtime import import_times, imported_by
+        >>> entries = import_times('import wbia; import wbia_pie_v2')
+        >>> modules = imported_by(entries, 'wbia_pie_v2')
+        >>> heavy = {'torch', 'torchvision', 'skimage', 'tqdm', 'yacs'}
+        >>> assert not heavy & {name.split('.')[0] for name in modules}
+        >>> import subprocess, sys
+        >>> statement = 'import sys, wbia_pie_v2; print("torch" in sys.modules)'
+        >>> output = subprocess.check_output([sys.executable, '-c', statement])
+        >>> assert output.decode().strip() == 'False'
+    """
+    for idx, (name, self_time, cumulative, depth) in enumerate(entries):
+        if name == module:
+            break
+    else:
+        return {}
+
+    subtree = {module: cumulative}
+    for name, self_time, cumulative, child_depth in reversed(entries[:idx]):
+        if child_depth <= depth:
+            break
+        subtree[name] = cumulative
+    return subtree
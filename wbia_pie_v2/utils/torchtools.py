@@ -2,6 +2,7 @@
 from __future__ import division, print_function, absolute_import
 import pickle
 import shutil
+import contextlib
 import os
 import os.path as osp
 import warnings
@@ -18,6 +19,8 @@ __all__ = [
     'open_all_layers',
     'open_specified_layers',
     'load_pretrained_weights',
+    'read_state_dict',
+    'bfloat16_autocast',
 ]
 
 
@@ -204,20 +207,13 @@ def load_pretrained_weights(model, weight_path):
         weight_path (str): path to pretrained weights.
 
     """
-    checkpoint = load_checkpoint(weight_path)
-    if 'state_dict' in checkpoint:
-        state_dict = checkpoint['state_dict']
-    else:
-        state_dict = checkpoint
+    state_dict = read_state_dict(weight_path)
 
     model_dict = model.state_dict()
     new_state_dict = OrderedDict()
     matched_layers, discarded_layers = [], []
 
     for k, v in state_dict.items():
-        if k.startswith('module.'):
-            k = k[7:]  # discard module.
-
         if k in model_dict and model_dict[k].size() == v.size():
             new_state_dict[k] = v
             matched_layers.append(k)
@@ -240,3 +236,52 @@ def load_pretrained_weights(model, weight_path):
                 '** The following layers are discarded '
                 'due to unmatched keys or layer size: {}'.format(discarded_layers)
             )
+
+
+def read_state_dict(weight_path):
+    r"""Reads the model state dict from a checkpoint or weights file.
+
+    Keys are returned without the "module." prefix added by ``DataParallel``.
+
+    Args:
+        weight_path (str): path to checkpoint or weights.
+
+    Returns:
+        OrderedDict
+    """
+    checkpoint = load_checkpoint(weight_path)
+    if 'state_dict' in checkpoint:
+        state_dict = checkpoint['state_dict']
+    else:
+        state_dict = checkpoint
+
+    new_state_dict = OrderedDict()
+    for k, v in state_dict.items():
+        if k.startswith('module.'):
+            k = k[7:]  # discard module.
+        new_state_dict[k] = v
+    return new_state_dict
+
+
+def bfloat16_autocast(device_type, enabled=True):
+    """Context running the ops of a model in bfloat16 under autocast.
+
+    ``torch.autocast`` only exists from torch 1.10, so a disabled context is a
+    no-op that never touches it.
+
+    Args:
+        device_type (str): ``cpu`` or ``cuda``.
+        enabled (bool, optional): whether to autocast. Default is True.
+
+    Example:
+        >>> import torch
+        >>> from wbia_pie_v2.utils.torchtools import bfloat16_autocast
+        >>> x = torch.rand(2, 4)
+        >>> with bfloat16_autocast('cpu', enabled=False):
+        ...     assert torch.mm(x, x.t()).dtype == torch.float32
+        >>> with bfloat16_autocast('cpu'):
+        ...     assert torch.mm(x, x.t()).dtype == torch.bfloat16
+    """
+    if not enabled:
+        return contextlib.nullcontext()
+    return torch.autocast(device_type, dtype=torch.bfloat16)